@@ -9,8 +9,17 @@ def get_data_files():
     """Obtiene la lista de archivos de datos, verificando que existan"""
     files = []
     
+    # Esquema XSD precompilado (se carga en milisegundos en lugar de recompilarlo)
+    try:
+        import sys
+        sys.path.insert(0, str(project_root))
+        import xsd_validator
+        xsd_validator.build_artifact()
+    except Exception as e:
+        print(f"⚠️ ADVERTENCIA: No se pudo precompilar el XSD: {e}")
+
     # Archivos de configuración y estilos (en la raíz)
-    for file in ['styles.qss', 'EsquemaProformas.xsd']:
+    for file in ['styles.qss', 'EsquemaProformas.xsd', 'EsquemaProformas.xsd.pickle']:
         file_path = project_root / file
         if file_path.exists():
             files.append((str(file_path), '.'))
@@ -79,6 +88,25 @@ a = Analysis(
         'modern_dialogs',
         'dialog_shim',
         'offline_queue',
+        'send_engine',
+        'http_client',
+        'connectivity',
+        'invoice_index',
+        'invoice_totals',
+        'multiprocessing',
+        'xsd_validator',
+        'xml_writer',
+        'send_journal',
+        'artifact_store',
+        'runtime_config',
+        'batch_profiler',
+        'send_job',
+        'factunabo',
+        'workbook_cache',
+        'workbook_session',
+        'xlsx_stream',
+        'macro_history',
+        'lxml.etree',
         'xml.etree.ElementTree',
         'xml.etree.cElementTree',
         'unicodedata',
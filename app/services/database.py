@@ -102,6 +102,37 @@ def init_database() -> None:
                 cursor.execute(stmt)
             except sqlite3.OperationalError as e:
                 logger.warning("Error creando índice cola offline: %s", e)
+
+        # Veredictos de validación XSD (ver xsd_validator.py)
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS xsd_validaciones (
+                xml_hash TEXT NOT NULL,
+                xsd_checksum TEXT NOT NULL,
+                valido INTEGER NOT NULL,
+                error TEXT,
+                fecha TEXT NOT NULL,
+                PRIMARY KEY (xml_hash, xsd_checksum)
+            )
+            """
+        )
+        # Diario de envíos (reanudación de lotes interrumpidos, ver send_journal.py)
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS envios_journal (
+                empresa TEXT NOT NULL,
+                external_id TEXT NOT NULL,
+                estado TEXT NOT NULL,
+                status TEXT,
+                respuesta TEXT,
+                filas TEXT,
+                intentos INTEGER NOT NULL DEFAULT 0,
+                fecha_inicio TEXT,
+                fecha_fin TEXT,
+                PRIMARY KEY (empresa, external_id)
+            )
+            """
+        )
         conn.commit()
 
 
@@ -13,18 +13,18 @@ from app.core.logging import get_logger
 from app.services.database import fetch_all
 import macro_adapter
 import prueba
+import artifact_store
+from workbook_session import WorkbookSession
 
 logger = get_logger("services.generador_mmb")
 
 
-def obtener_datos_factura_desde_xml(xml_path: str) -> Optional[Dict]:
-    """Extrae datos de una factura desde su XML guardado"""
+def obtener_datos_factura_desde_xml(xml_data: bytes) -> Optional[Dict]:
+    """Extrae datos de una factura desde su XML guardado (bytes de buscar_xml_factura)"""
     try:
-        if not os.path.exists(xml_path):
+        if not xml_data:
             return None
-        
-        tree = ET.parse(xml_path)
-        root = tree.getroot()
+        root = ET.fromstring(xml_data)
         
         # Buscar datos en el XML
         datos = {}
@@ -132,7 +132,7 @@ def obtener_datos_factura_desde_xml(xml_path: str) -> Optional[Dict]:
         datos['iva_porcentaje'] = iva_porcentaje
         
         # Logging detallado para diagnóstico
-        logger.debug(f"XML {xml_path}: base={base_total}, IVA_importe={iva_total}, IVA_%={iva_porcentaje}, total={total_xml}")
+        logger.debug(f"XML: base={base_total}, IVA_importe={iva_total}, IVA_%={iva_porcentaje}, total={total_xml}")
         # Usar total calculado o el del XML
         datos['total'] = total_xml if total_xml > 0 else (base_total + iva_total)
         
@@ -148,12 +148,20 @@ def obtener_datos_factura_desde_xml(xml_path: str) -> Optional[Dict]:
         
         return datos
     except Exception as e:
-        logger.warning(f"Error leyendo XML {xml_path}: {e}")
+        logger.warning(f"Error leyendo XML: {e}")
         return None
 
 
-def buscar_xml_factura(num_factura: str, empresa: str, logs_dir: str = "logs", responses_dir: str = "responses") -> Optional[str]:
-    """Busca el archivo XML de una factura en los directorios de logs y responses"""
+def buscar_xml_factura(num_factura: str, empresa: str, logs_dir: str = "logs",
+                       responses_dir: str = "responses") -> Optional[bytes]:
+    """
+    Devuelve los bytes del XML de una factura: primero del almacén de artefactos
+    y después de los ficheros de los directorios de logs y responses
+    """
+    xml_bytes = artifact_store.find_xml(num_factura, empresa)
+    if xml_bytes:
+        return xml_bytes
+
     # Normalizar nombre de empresa para búsqueda
     empresa_safe = str(empresa).replace(" ", "_").replace(".", "")
     num_safe = str(num_factura).replace("/", "_")
@@ -162,17 +170,26 @@ def buscar_xml_factura(num_factura: str, empresa: str, logs_dir: str = "logs", r
     if os.path.exists(logs_dir):
         for archivo in os.listdir(logs_dir):
             if archivo.endswith(".xml") and empresa_safe in archivo and num_safe in archivo:
-                return os.path.join(logs_dir, archivo)
+                return _leer_fichero(os.path.join(logs_dir, archivo))
     
     # Buscar en responses
     if os.path.exists(responses_dir):
         for archivo in os.listdir(responses_dir):
             if archivo.endswith(".xml") and num_safe in archivo:
-                return os.path.join(responses_dir, archivo)
+                return _leer_fichero(os.path.join(responses_dir, archivo))
     
     return None
 
 
+def _leer_fichero(path: str) -> Optional[bytes]:
+    try:
+        with open(path, "rb") as f:
+            return f.read()
+    except OSError as e:
+        logger.warning(f"Error leyendo XML {path}: {e}")
+        return None
+
+
 def obtener_codigo_cliente_contable(cliente_nif: str) -> str:
     """
     Genera o busca el código de cliente contable basado en el NIF.
@@ -538,13 +555,15 @@ def generar_registro_mmb(factura_data: Dict, config: Optional[Dict] = None) -> s
     return registro
 
 
-def obtener_cuenta_contable_desde_excel(excel_path: str, empresa_nombre: str) -> Optional[str]:
+def obtener_cuenta_contable_desde_excel(excel_path: str, empresa_nombre: str,
+                                        session: Optional[WorkbookSession] = None) -> Optional[str]:
     """
     Obtiene el código de cliente contable (430...) de una empresa desde la hoja CLIENTES del Excel.
     
     Args:
         excel_path: Ruta del archivo Excel
         empresa_nombre: Nombre de la empresa (normalizado, sin tildes)
+        session: Sesión del mismo Excel para no volver a abrirlo en cada búsqueda
     
     Returns:
         Código de cliente contable (430...) o None si no se encuentra
@@ -554,7 +573,7 @@ def obtener_cuenta_contable_desde_excel(excel_path: str, empresa_nombre: str) ->
     
     try:
         # Leer hoja CLIENTES
-        df_clientes = macro_adapter._read_clientes_df_from_same_book(excel_path)
+        df_clientes = macro_adapter._read_clientes_df_from_same_book(excel_path, session=session)
         if df_clientes.empty:
             return None
         
@@ -653,7 +672,8 @@ def generar_archivo_mmb(
     responses_dir: str = "responses",
     excel_path: Optional[str] = None,
     facturas_ids: Optional[List[int]] = None,
-    config: Optional[Dict] = None
+    config: Optional[Dict] = None,
+    session: Optional[WorkbookSession] = None
 ) -> str:
     """
     Genera un archivo .mmb con las facturas emitidas
@@ -668,6 +688,7 @@ def generar_archivo_mmb(
         excel_path: Ruta del Excel para leer cuenta contable (si no se proporciona, se busca en la BD)
         facturas_ids: Lista de IDs de facturas específicas a exportar (tiene prioridad sobre filtros)
         config: Configuración adicional (códigos contables, etc.)
+        session: WorkbookSession del Excel ya leída (p. ej. la de la adaptación de la Macro)
     
     Returns:
         Ruta del archivo generado
@@ -718,6 +739,15 @@ def generar_archivo_mmb(
     # Cache para cuentas contables por empresa
     cuentas_contables_cache = {}
     
+    # Una sesión por Excel: la hoja CLIENTES se lee una sola vez para todos los clientes
+    sesiones_excel = {session.path: session} if session is not None else {}
+    
+    def _sesion_excel(path: str) -> WorkbookSession:
+        clave = os.path.abspath(path)
+        if clave not in sesiones_excel:
+            sesiones_excel[clave] = WorkbookSession(path)
+        return sesiones_excel[clave]
+    
     # Determinar ruta del Excel a usar
     excel_path_a_usar = excel_path
     if not excel_path_a_usar and facturas:
@@ -755,7 +785,9 @@ def generar_archivo_mmb(
             if cache_key not in cuentas_contables_cache:
                 if excel_para_buscar and os.path.exists(excel_para_buscar):
                     logger.info(f"Buscando código de cliente para CLIENTE '{cliente_nombre_bd}' en Excel: {excel_para_buscar}")
-                    codigo_cliente = obtener_cuenta_contable_desde_excel(excel_para_buscar, cliente_nombre_bd)
+                    codigo_cliente = obtener_cuenta_contable_desde_excel(
+                        excel_para_buscar, cliente_nombre_bd, session=_sesion_excel(excel_para_buscar)
+                    )
                     if codigo_cliente:
                         cuentas_contables_cache[cache_key] = codigo_cliente
                         logger.info(f"✓ Código de cliente encontrado para CLIENTE '{cliente_nombre_bd}': {codigo_cliente}")
@@ -772,9 +804,9 @@ def generar_archivo_mmb(
             logger.warning(f"Factura {num_factura}: No hay nombre de cliente en la BD. Se generará código automático basado en el NIF.")
         
         # Intentar obtener datos adicionales desde XML
-        xml_path = buscar_xml_factura(num_factura, empresa_db, logs_dir, responses_dir)
-        if xml_path:
-            datos_xml = obtener_datos_factura_desde_xml(xml_path)
+        xml_data = buscar_xml_factura(num_factura, empresa_db, logs_dir, responses_dir)
+        if xml_data:
+            datos_xml = obtener_datos_factura_desde_xml(xml_data)
             if datos_xml:
                 # Si el importe de la BD es 0 pero tenemos datos del XML, usar los del XML
                 if (not factura_data.get('importe') or float(factura_data.get('importe', 0) or 0) == 0):
@@ -794,7 +826,9 @@ def generar_archivo_mmb(
                         cache_key_xml = f"{cliente_xml}|{excel_para_buscar}"
                         if cache_key_xml not in cuentas_contables_cache:
                             logger.info(f"Buscando código de cliente para CLIENTE '{cliente_xml}' (desde XML) en Excel: {excel_para_buscar}")
-                            codigo_cliente = obtener_cuenta_contable_desde_excel(excel_para_buscar, cliente_xml)
+                            codigo_cliente = obtener_cuenta_contable_desde_excel(
+                                excel_para_buscar, cliente_xml, session=_sesion_excel(excel_para_buscar)
+                            )
                             if codigo_cliente:
                                 cuentas_contables_cache[cache_key_xml] = codigo_cliente
                                 factura_data['codigo_cliente'] = codigo_cliente
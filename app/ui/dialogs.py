@@ -77,7 +77,7 @@ class HealthCheckDialog(QDialog):
 
 
 class JsonViewerDialog(QDialog):
-    def __init__(self, json_path: Path, parent: Optional[QWidget] = None):
+    def __init__(self, json_path: Path, parent: Optional[QWidget] = None, content: Optional[str] = None):
         super().__init__(parent)
         self.setWindowTitle(json_path.name)
         self.setMinimumSize(600, 500)
@@ -101,7 +101,8 @@ class JsonViewerDialog(QDialog):
         layout.addWidget(button_box)
 
         try:
-            data = json.loads(json_path.read_text(encoding="utf-8"))
+            # content: JSON ya leído (p. ej. del almacén de artefactos); si no, se lee json_path
+            data = json.loads(content if content is not None else json_path.read_text(encoding="utf-8"))
             formatted = json.dumps(data, indent=2, ensure_ascii=False)
             self.text_edit.setPlainText(formatted)
         except Exception as exc:
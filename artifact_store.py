@@ -0,0 +1,352 @@
+# -*- coding: utf-8 -*-
+"""
+Módulo con el almacén de artefactos de envío (XML enviados y respuestas de la API).
+
+En lugar de un fichero suelto por XML y por respuesta en logs/ y responses/,
+los artefactos se añaden (sin reescribir nunca) a una tabla SQLite con el
+contenido comprimido con zlib e índices por factura y emisor, de modo que
+encontrar el último XML de una factura es una consulta indexada y no un
+recorrido de carpetas con miles de ficheros.
+
+Modos de escritura (FACTUNABO_ARTIFACTS):
+    store  sólo el almacén (por defecto)
+    both   almacén y ficheros sueltos como antes
+    files  sólo ficheros sueltos
+
+Los lectores consultan primero el almacén y, si no está ahí, buscan en los
+ficheros sueltos (envíos anteriores a este almacén).
+
+El contenido se guarda una sola vez por hash SHA-256 (tabla contenidos): un
+reintento con el mismo XML sólo añade una fila de referencia. En modo files o
+both la copia de responses/ es un enlace duro al fichero de logs/ y no una
+segunda escritura. dedup_directories() sustituye por enlaces duros los
+ficheros repetidos de logs/ y responses/:
+
+    python artifact_store.py --dedup logs responses
+
+Variables de entorno:
+    FACTUNABO_ARTIFACTS     store, both o files
+    FACTUNABO_ARTIFACT_DB   ruta del almacén (por defecto responses/artifacts.db)
+"""
+import argparse
+import hashlib
+import logging
+import os
+import re
+import sqlite3
+import threading
+import unicodedata
+import zlib
+from datetime import datetime
+from typing import Dict, Iterable, Iterator, NamedTuple, Optional
+
+logger = logging.getLogger("artifact_store")
+
+KIND_XML = "xml"
+KIND_API = "api"
+
+MODE_STORE = "store"
+MODE_BOTH = "both"
+MODE_FILES = "files"
+
+DEFAULT_DB_PATH = os.path.join("responses", "artifacts.db")
+COMPRESSION_LEVEL = 6
+
+_SCHEMA = (
+    """
+    CREATE TABLE IF NOT EXISTS contenidos (
+        hash TEXT PRIMARY KEY,
+        tamano INTEGER NOT NULL,
+        datos BLOB NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS artefactos (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        tipo TEXT NOT NULL,
+        external_id TEXT NOT NULL,
+        clave TEXT NOT NULL,
+        clave_original TEXT,
+        empresa TEXT,
+        empresa_clave TEXT,
+        fecha TEXT NOT NULL,
+        hash TEXT NOT NULL REFERENCES contenidos (hash)
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_artefactos_clave ON artefactos (tipo, clave)",
+    "CREATE INDEX IF NOT EXISTS idx_artefactos_original ON artefactos (tipo, clave_original)",
+)
+
+_SELECT = ("SELECT a.id, a.tipo, a.external_id, a.empresa, a.fecha, c.datos, a.hash "
+           "FROM artefactos a JOIN contenidos c ON c.hash = a.hash ")
+
+
+class Artifact(NamedTuple):
+    id: int
+    tipo: str
+    external_id: str
+    empresa: str
+    fecha: str
+    data: bytes
+    hash: str
+
+    @property
+    def name(self) -> str:
+        """Nombre equivalente al del antiguo fichero suelto (para mostrar al usuario)."""
+        stamp = self.fecha.replace("-", "").replace(":", "").replace(" ", "_")
+        ext = "json" if self.tipo == KIND_API else "xml"
+        return f"{self.tipo}_{safe_id(self.external_id)}_{stamp}.{ext}"
+
+
+def get_mode() -> str:
+    value = os.getenv("FACTUNABO_ARTIFACTS", "").strip().lower()
+    return value if value in (MODE_STORE, MODE_BOTH, MODE_FILES) else MODE_STORE
+
+
+def writes_files() -> bool:
+    return get_mode() in (MODE_BOTH, MODE_FILES)
+
+
+def writes_store() -> bool:
+    return get_mode() in (MODE_STORE, MODE_BOTH)
+
+
+def normalize_id(value) -> str:
+    """Id de factura como texto, sin ".0" final en los números enteros."""
+    s = str(value if value is not None else "").strip()
+    if re.fullmatch(r"\d+\.0+", s):
+        s = s.split(".", 1)[0]
+    return s
+
+
+def safe_id(value) -> str:
+    return normalize_id(value).replace("/", "_")
+
+
+def content_hash(data) -> str:
+    """SHA-256 en hexadecimal del contenido (la clave del almacén y del diario de envíos)."""
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    return hashlib.sha256(data or b"").hexdigest()
+
+
+def empresa_key(empresa) -> str:
+    """Como los nombres de fichero de logs/ (espacios a _, sin puntos), además sin tildes ni mayúsculas."""
+    s = unicodedata.normalize("NFKD", str(empresa or "").strip())
+    s = "".join(c for c in s if not unicodedata.combining(c))
+    return re.sub(r"\s+", "_", s).replace(".", "").lower()
+
+
+class ArtifactStore:
+    """Tabla de artefactos de sólo añadido; una conexión por hilo."""
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._local = threading.local()
+        folder = os.path.dirname(os.path.abspath(db_path))
+        os.makedirs(folder, exist_ok=True)
+        conn = self._connection()
+        for sql in _SCHEMA:
+            conn.execute(sql)
+        conn.commit()
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=10)
+            # Fichero propio del almacén: WAL permite escribir desde varios carriles sin bloquear lecturas
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def put(self, tipo: str, external_id, empresa, data: bytes, num_original=None,
+            digest: Optional[str] = None) -> int:
+        """Añade un artefacto y devuelve su id; el contenido sólo se escribe si su hash es nuevo."""
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        digest = digest or content_hash(data)
+        conn = self._connection()
+        known = conn.execute("SELECT 1 FROM contenidos WHERE hash = ?", (digest,)).fetchone()
+        if known is None:
+            conn.execute(
+                "INSERT OR IGNORE INTO contenidos (hash, tamano, datos) VALUES (?, ?, ?)",
+                (digest, len(data), sqlite3.Binary(zlib.compress(data, COMPRESSION_LEVEL))),
+            )
+        cur = conn.execute(
+            """
+            INSERT INTO artefactos (tipo, external_id, clave, clave_original, empresa, empresa_clave, fecha, hash)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            (tipo, str(external_id), normalize_id(external_id),
+             normalize_id(num_original) if num_original is not None else None,
+             str(empresa or ""), empresa_key(empresa), datetime.now().strftime("%Y-%m-%d %H:%M:%S"), digest),
+        )
+        conn.commit()
+        return cur.lastrowid
+
+    @staticmethod
+    def _artifact(row) -> Artifact:
+        return Artifact(row[0], row[1], row[2], row[3], row[4], zlib.decompress(row[5]), row[6])
+
+    def has_content(self, digest: str) -> bool:
+        """Si ya hay algún artefacto con ese contenido (p. ej. el mismo XML ya enviado)."""
+        return self._connection().execute(
+            "SELECT 1 FROM contenidos WHERE hash = ?", (digest,)).fetchone() is not None
+
+    def find(self, tipo: str, invoice_id, empresa=None) -> Optional[Artifact]:
+        """Último artefacto de la factura (por external_id o nº original), del emisor si se indica."""
+        clave = normalize_id(invoice_id)
+        if not clave:
+            return None
+        sql = _SELECT + "WHERE a.tipo = ? AND (a.clave = ? OR a.clave_original = ?)"
+        params = [tipo, clave, clave]
+        if empresa:
+            sql += " AND a.empresa_clave = ?"
+            params.append(empresa_key(empresa))
+        sql += " ORDER BY a.id DESC LIMIT 1"
+        row = self._connection().execute(sql, params).fetchone()
+        return self._artifact(row) if row else None
+
+    def latest(self, tipo: str) -> Optional[Artifact]:
+        row = self._connection().execute(
+            _SELECT + "WHERE a.tipo = ? ORDER BY a.id DESC LIMIT 1",
+            (tipo,),
+        ).fetchone()
+        return self._artifact(row) if row else None
+
+    def iter_recent(self, tipo: str, limit: int = 500) -> Iterator[Artifact]:
+        """Artefactos de un tipo, del más reciente al más antiguo."""
+        rows = self._connection().execute(
+            _SELECT + "WHERE a.tipo = ? ORDER BY a.id DESC LIMIT ?",
+            (tipo, limit),
+        ).fetchall()
+        for row in rows:
+            yield self._artifact(row)
+
+
+def write_copies(data: bytes, paths: Iterable[str]) -> None:
+    """
+    Escribe data en la primera ruta y enlaza las demás a ella con enlaces duros
+    (o las copia si el sistema de ficheros no los admite).
+    """
+    paths = list(paths)
+    first = paths[0]
+    os.makedirs(os.path.dirname(os.path.abspath(first)), exist_ok=True)
+    with open(first, "wb") as f:
+        f.write(data)
+    for path in paths[1:]:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        try:
+            os.link(first, path)
+        except OSError:
+            with open(path, "wb") as f:
+                f.write(data)
+
+
+def _file_hash(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def dedup_directories(directories: Iterable[str], extensions=(".xml", ".json")) -> Dict[str, int]:
+    """
+    Sustituye los ficheros con el mismo contenido de las carpetas indicadas por
+    enlaces duros al primero encontrado. Los nombres no cambian; sólo se libera
+    el espacio repetido. Devuelve ficheros revisados, enlazados y bytes liberados.
+    """
+    by_size: Dict[int, list] = {}
+    for directory in directories:
+        if not os.path.isdir(directory):
+            continue
+        for entry in os.scandir(directory):
+            if entry.is_file(follow_symlinks=False) and entry.name.lower().endswith(tuple(extensions)):
+                by_size.setdefault(entry.stat().st_size, []).append(entry.path)
+
+    stats = {"ficheros": sum(len(v) for v in by_size.values()), "enlazados": 0, "bytes_liberados": 0}
+    for size, paths in by_size.items():
+        if len(paths) < 2:
+            continue
+        originals: Dict[str, tuple] = {}
+        for path in sorted(paths):
+            try:
+                digest = _file_hash(path)
+                st = os.stat(path)
+            except OSError as e:
+                logger.warning(f"No se pudo leer {path}: {e}")
+                continue
+            original = originals.get(digest)
+            if original is None:
+                originals[digest] = (path, st)
+                continue
+            original_path, original_st = original
+            if (st.st_dev, st.st_ino) == (original_st.st_dev, original_st.st_ino):
+                continue
+            tmp_path = path + ".dedup"
+            try:
+                os.link(original_path, tmp_path)
+                os.replace(tmp_path, path)
+            except OSError as e:
+                logger.warning(f"No se pudo enlazar {path}: {e}")
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                continue
+            # El enlace no debe cambiar la fecha que usan los listados por antigüedad
+            os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+            stats["enlazados"] += 1
+            if st.st_nlink == 1:
+                stats["bytes_liberados"] += size
+    return stats
+
+
+_STORES = {}
+_STORES_LOCK = threading.Lock()
+
+
+def get_store(db_path: Optional[str] = None) -> ArtifactStore:
+    """Almacén compartido por proceso para cada ruta."""
+    path = os.path.abspath(db_path or os.getenv("FACTUNABO_ARTIFACT_DB", "").strip() or DEFAULT_DB_PATH)
+    store = _STORES.get(path)
+    if store is None:
+        with _STORES_LOCK:
+            store = _STORES.get(path)
+            if store is None:
+                store = _STORES[path] = ArtifactStore(path)
+    return store
+
+
+def find_xml(invoice_id, empresa=None, db_path: Optional[str] = None) -> Optional[bytes]:
+    """Bytes del último XML guardado de la factura, o None (también si no hay almacén)."""
+    path = os.path.abspath(db_path or os.getenv("FACTUNABO_ARTIFACT_DB", "").strip() or DEFAULT_DB_PATH)
+    if not os.path.exists(path):
+        return None
+    try:
+        found = get_store(path).find(KIND_XML, invoice_id, empresa)
+    except sqlite3.Error as e:
+        logger.warning(f"No se pudo leer el almacén de artefactos: {e}")
+        return None
+    return found.data if found else None
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="Mantenimiento del almacén de artefactos")
+    parser.add_argument("--dedup", nargs="*", metavar="CARPETA",
+                        help="enlaza los ficheros repetidos de estas carpetas (por defecto logs y responses)")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    if args.dedup is not None:
+        stats = dedup_directories(args.dedup or ["logs", "responses"])
+        print(f"{stats['ficheros']} ficheros, {stats['enlazados']} enlazados, "
+              f"{stats['bytes_liberados'] / 1024:.1f} KB liberados")
+
+
+__all__ = ["KIND_XML", "KIND_API", "Artifact", "ArtifactStore", "get_store", "get_mode",
+           "writes_files", "writes_store", "find_xml", "normalize_id", "safe_id", "empresa_key",
+           "content_hash", "write_copies", "dedup_directories"]
+
+
+if __name__ == "__main__":
+    main()
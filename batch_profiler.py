@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+Módulo con la medición de tiempos por etapa de un lote de envío.
+
+prueba.main() abre un perfilador al empezar y, al terminar, escribe
+responses/perf_report.json y resume en el log dónde se fue el tiempo. Las
+etapas se miden con span() allí donde ocurren:
+
+    lectura     macro_adapter.adapt_from_macro
+    xml         generación del XML de cada factura
+    xsd         validación XSD de cada factura
+    escritura   guardado del XML (almacén de artefactos o ficheros)
+    envio       petición HTTP a Facturantia (una factura o un lote)
+    macro       mark_rows_in_macro / delete_ok_rows_in_macro
+    pdf         descarga de cada PDF
+
+Sin perfilador activo span() no hace nada. En los procesos del pipeline las
+mediciones se recogen con collect() y se suman en el proceso principal con
+merge().
+
+Variable de entorno:
+    FACTUNABO_PROFILE  0 para no medir ni escribir el informe
+"""
+import json
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+REPORT_FILENAME = "perf_report.json"
+SLOWEST_INVOICES = 10
+
+Sample = Tuple[str, float, Optional[str]]
+
+
+def is_enabled() -> bool:
+    return os.getenv("FACTUNABO_PROFILE", "1").strip() != "0"
+
+
+def percentile(values: Sequence[float], pct: float) -> float:
+    """Percentil por rango más cercano (0 si no hay valores)."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, math.ceil(pct / 100.0 * len(ordered)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+class BatchProfiler:
+    """Duraciones por etapa y por factura de un lote (seguro entre hilos)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._samples: List[Sample] = []
+        self._started = time.perf_counter()
+        self._fecha = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+    def record(self, stage: str, seconds: float, factura=None) -> None:
+        with self._lock:
+            self._samples.append((stage, seconds, str(factura) if factura is not None else None))
+
+    def samples(self) -> List[Sample]:
+        with self._lock:
+            return list(self._samples)
+
+    def report(self, slowest: int = SLOWEST_INVOICES) -> dict:
+        """Conteo, total, p50/p95/máximo por etapa y las facturas más lentas."""
+        por_etapa: Dict[str, List[float]] = {}
+        por_factura: Dict[str, Dict[str, float]] = {}
+        for stage, seconds, factura in self.samples():
+            por_etapa.setdefault(stage, []).append(seconds)
+            if factura is not None:
+                etapas = por_factura.setdefault(factura, {})
+                etapas[stage] = etapas.get(stage, 0.0) + seconds
+
+        lentas = sorted(por_factura.items(), key=lambda kv: sum(kv[1].values()), reverse=True)[:slowest]
+        return {
+            "fecha": self._fecha,
+            "duracion_s": round(time.perf_counter() - self._started, 3),
+            "etapas": {
+                stage: {
+                    "count": len(values),
+                    "total_s": round(sum(values), 3),
+                    "p50_ms": round(percentile(values, 50) * 1000, 2),
+                    "p95_ms": round(percentile(values, 95) * 1000, 2),
+                    "max_ms": round(max(values) * 1000, 2),
+                }
+                for stage, values in por_etapa.items()
+            },
+            "facturas_mas_lentas": [
+                {
+                    "factura": factura,
+                    "total_ms": round(sum(etapas.values()) * 1000, 2),
+                    "etapas_ms": {stage: round(s * 1000, 2) for stage, s in etapas.items()},
+                }
+                for factura, etapas in lentas
+            ],
+        }
+
+
+_active: Optional[BatchProfiler] = None
+
+
+def start() -> Optional[BatchProfiler]:
+    """Abre un perfilador nuevo (sustituye al activo); None si FACTUNABO_PROFILE=0."""
+    global _active
+    _active = BatchProfiler() if is_enabled() else None
+    return _active
+
+
+def active() -> Optional[BatchProfiler]:
+    return _active
+
+
+def stop() -> Optional[BatchProfiler]:
+    global _active
+    profiler, _active = _active, None
+    return profiler
+
+
+@contextmanager
+def span(stage: str, factura=None) -> Iterator[None]:
+    """Mide el bloque como una muestra de stage (de la factura indicada)."""
+    profiler = _active
+    if profiler is None:
+        yield
+        return
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        profiler.record(stage, time.perf_counter() - t0, factura)
+
+
+@contextmanager
+def collect() -> Iterator[List[Sample]]:
+    """
+    Recoge en una lista las muestras del bloque (para devolverlas desde un
+    proceso hijo) y restaura después el perfilador anterior del proceso.
+    """
+    global _active
+    anterior = _active
+    profiler = BatchProfiler() if is_enabled() else None
+    _active = profiler
+    muestras: List[Sample] = []
+    try:
+        yield muestras
+    finally:
+        _active = anterior
+        if profiler is not None:
+            muestras.extend(profiler.samples())
+
+
+def merge(samples: Optional[Sequence[Sample]], factura=None) -> None:
+    """Suma al perfilador activo muestras recogidas en otro proceso, asignándolas a factura."""
+    profiler = _active
+    if profiler is None or not samples:
+        return
+    for stage, seconds, origen in samples:
+        profiler.record(stage, seconds, factura if factura is not None else origen)
+
+
+def finish(directory: str) -> Optional[dict]:
+    """Cierra el perfilador activo y escribe su informe en directory/perf_report.json."""
+    profiler = stop()
+    if profiler is None:
+        return None
+    report = profiler.report()
+    os.makedirs(directory, exist_ok=True)
+    report["ruta"] = os.path.join(directory, REPORT_FILENAME)
+    with open(report["ruta"], "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=4, ensure_ascii=False)
+    return report
+
+
+def summary_lines(report: Optional[dict]) -> List[str]:
+    """Resumen corto del informe para el log de la página de envío."""
+    if not report:
+        return []
+    etapas = sorted(report["etapas"].items(), key=lambda kv: kv[1]["total_s"], reverse=True)
+    partes = [f"{stage} {d['total_s']:.2f} s ({d['count']}×, p95 {d['p95_ms']:.0f} ms)" for stage, d in etapas]
+    lines = [f"⏱️ Tiempos del lote ({report['duracion_s']:.1f} s): " + " · ".join(partes)]
+    if report["facturas_mas_lentas"]:
+        lenta = report["facturas_mas_lentas"][0]
+        detalle = ", ".join(f"{stage} {ms:.0f} ms" for stage, ms in lenta["etapas_ms"].items())
+        lines.append(f"🐢 Factura más lenta: {lenta['factura']} ({lenta['total_ms']:.0f} ms: {detalle})")
+    if report.get("ruta"):
+        lines.append(f"📄 Informe de tiempos en: {report['ruta']}")
+    return lines
+
+
+__all__ = ["BatchProfiler", "percentile", "is_enabled", "start", "active", "stop", "span", "collect",
+           "merge", "finish", "summary_lines"]
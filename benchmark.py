@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+"""
+Módulo con el banco de pruebas de rendimiento del envío de proformas.
+
+Genera una Macro sintética, levanta el receptor local de facturantia_stub y
+ejecuta prueba.main() completo contra él. Informa de:
+
+    - facturas por segundo del lote completo
+    - p50/p95 por etapa (lectura, xml, xsd, escritura, envio, macro), del
+      informe responses/perf_report.json que escribe prueba.main()
+    - memoria máxima (RSS) del proceso y de sus procesos hijos
+
+Uso:
+    python benchmark.py --facturas 500 --emisores 4 --latency 0.05 --json bench.json
+
+Todo se ejecuta en una carpeta temporal (logs/ y responses/ incluidos) y sin
+guardar veredictos XSD ni diario de envíos en factunabo_history.db.
+"""
+import argparse
+import datetime
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+from typing import Dict, Optional
+
+from batch_profiler import REPORT_FILENAME
+from facturantia_stub import FacturantiaStub, StubConfig
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Columnas de la hoja CLIENTES que lee macro_adapter
+CLIENTES_HEADER = ["tipo_persona", "empresa_nombre", "cif_aliases", "cif", "iban_defecto", "bic",
+                   "unidad_medida_defecto", "series_retencion", "API_URL", "API_TOKEN", "API_EMAIL",
+                   "cuenta_contable"]
+
+
+def build_workbook(path: str, facturas: int, emisores: int, api_url: str, seed: int = 1) -> None:
+    """Macro sintética con facturas normales, intracomunitarias e intereses repartidas entre emisores."""
+    from openpyxl import Workbook
+    from macro_adapter import EXCEL_COLS, excel_col_to_idx
+
+    rnd = random.Random(seed)
+    col = {key: excel_col_to_idx(letter) for key, letter in EXCEL_COLS.items()}
+    width = max(col.values()) + 1
+
+    wb = Workbook()
+    ws = wb.active
+    ws.title = "Macro"
+    cabecera = [None] * width
+    cabecera[col["num_factura"]] = "nº Factura"
+    cabecera[col["fecha_emision"]] = "Fecha"
+    ws.append(cabecera)
+
+    cifs = [(f"B{9100000 + i:07d}", f"Emisora Benchmark {i} S.L.") for i in range(max(1, emisores))]
+    clientes = wb.create_sheet("CLIENTES")
+    clientes.append(CLIENTES_HEADER)
+    for cif, nombre in cifs:
+        clientes.append(["J", nombre, f"CIF {cif}", cif, "ES8520803509113040096171", "CAGLESMMXXX",
+                         "01", "", api_url, "token-benchmark", "benchmark@example.com", 4300001])
+
+    historico = wb.create_sheet("Numeración Hist")
+    historico.append(cabecera)
+    for k in range(facturas):
+        cif, _ = cifs[k % len(cifs)]
+        prefijo = rnd.choice(["", "", "", "A", "Int25_"])
+        num = f"{prefijo}{25000 + k}" if prefijo else 25000 + k
+        row = [None] * width
+        row[col["num_factura"]] = num
+        row[col["fecha_emision"]] = datetime.datetime(2025, 1 + k % 12, 1 + k % 27)
+        row[col["cif_emisor"]] = f"CIF {cif}"
+        row[col["cliente_nombre"]] = f"Cliente {k}"
+        row[col["cliente_nif"]] = "ESB91938662" if prefijo == "A" else "B91938662"
+        row[col["cliente_dir"]] = "C/ Falsa 123"
+        row[col["cliente_cp_prov"]] = "41004 Sevilla"
+        base = 0.0
+        for i in range(1, 9):
+            if rnd.random() < 0.6:
+                row[col[f"desc_{i}"]] = f"Concepto {i} factura {k}"
+                if rnd.random() < 0.7:
+                    row[col[f"imp_{i}"]] = round(rnd.uniform(10, 1000), 2)
+                    base += row[col[f"imp_{i}"]]
+        if row[col["imp_1"]] is None:
+            row[col["desc_1"]] = "Servicios profesionales"
+            row[col["imp_1"]] = 100.0
+            base += 100.0
+        row[col["suplidos_aa"]] = rnd.choice([None, 0, 12.5])
+        row[col["base_ad"]] = base
+        row[col["total_ah"]] = base * 1.21 + (row[col["suplidos_aa"]] or 0)
+        ws.append(row)
+        historico.append(list(row))
+    wb.save(path)
+
+
+# --- Medición ---
+def peak_rss_mb() -> Dict[str, Optional[float]]:
+    """Memoria máxima (MB) del proceso y de sus hijos ya terminados, si el sistema lo permite."""
+    try:
+        import resource
+        # Linux da KB; macOS, bytes
+        scale = 1024.0 * 1024.0 if sys.platform == "darwin" else 1024.0
+        return {
+            "self": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale,
+            "children": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale,
+        }
+    except ImportError:
+        pass
+    try:
+        import psutil
+        mem = psutil.Process().memory_info()
+        return {"self": getattr(mem, "peak_wset", mem.rss) / 1048576.0, "children": None}
+    except ImportError:
+        pass
+    if sys.platform == "win32":
+        try:
+            import ctypes
+            from ctypes import wintypes
+
+            class _Counters(ctypes.Structure):
+                _fields_ = [("cb", wintypes.DWORD), ("PageFaultCount", wintypes.DWORD),
+                            ("PeakWorkingSetSize", ctypes.c_size_t), ("WorkingSetSize", ctypes.c_size_t),
+                            ("QuotaPeakPagedPoolUsage", ctypes.c_size_t), ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                            ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t), ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                            ("PagefileUsage", ctypes.c_size_t), ("PeakPagefileUsage", ctypes.c_size_t)]
+
+            counters = _Counters()
+            counters.cb = ctypes.sizeof(counters)
+            handle = ctypes.windll.kernel32.GetCurrentProcess()
+            if ctypes.windll.psapi.GetProcessMemoryInfo(handle, ctypes.byref(counters), counters.cb):
+                return {"self": counters.PeakWorkingSetSize / 1048576.0, "children": None}
+        except Exception:
+            pass
+    return {"self": None, "children": None}
+
+
+def run(facturas: int = 200, emisores: int = 4, config: Optional[StubConfig] = None,
+        workdir: Optional[str] = None, seed: int = 1) -> dict:
+    """Ejecuta prueba.main() contra el receptor local y devuelve las métricas."""
+    workdir = os.path.abspath(workdir or tempfile.mkdtemp(prefix="factunabo_bench_"))
+    os.makedirs(workdir, exist_ok=True)
+    os.chdir(workdir)  # prueba.py crea logs/ y responses/ en el directorio actual
+    if REPO_DIR not in sys.path:
+        sys.path.insert(0, REPO_DIR)
+
+    stub = FacturantiaStub(config or StubConfig(seed=seed))
+    api_url = stub.start()
+    excel_path = os.path.join(workdir, "benchmark_macro.xlsx")
+    build_workbook(excel_path, facturas, emisores, api_url, seed=seed)
+    os.environ["EXCEL_PATH"] = excel_path
+    os.environ.setdefault("FACTUNABO_XSD_VERDICTS", "0")
+    os.environ.setdefault("FACTUNABO_SEND_JOURNAL", "0")
+
+    import prueba
+
+    # Los mensajes por factura van al log de la carpeta temporal, no a la consola
+    for handler in logging.root.handlers:
+        if isinstance(handler, logging.StreamHandler) and not isinstance(handler, logging.FileHandler):
+            handler.setLevel(logging.WARNING)
+
+    try:
+        t0 = time.perf_counter()
+        prueba.main()
+        elapsed = time.perf_counter() - t0
+    finally:
+        stub.stop()
+
+    # Tiempos por etapa del informe que escribe el propio prueba.main()
+    etapas: Dict[str, dict] = {}
+    try:
+        with open(os.path.join(workdir, prueba.RESPONSE_DIR, REPORT_FILENAME), encoding="utf-8") as f:
+            etapas = json.load(f).get("etapas", {})
+    except (OSError, ValueError):
+        pass
+
+    estados: Dict[str, int] = {}
+    summary_path = os.path.join(workdir, prueba.RESPONSE_DIR, "summary.json")
+    try:
+        with open(summary_path, encoding="utf-8") as f:
+            for fila in json.load(f):
+                estados[fila.get("status", "")] = estados.get(fila.get("status", ""), 0) + 1
+    except (OSError, ValueError):
+        pass
+
+    return {
+        "facturas": facturas,
+        "emisores": emisores,
+        "elapsed_s": round(elapsed, 3),
+        "facturas_por_segundo": round(facturas / elapsed, 2) if elapsed > 0 else None,
+        "etapas": etapas,
+        "peak_rss_mb": {k: (round(v, 1) if v is not None else None) for k, v in peak_rss_mb().items()},
+        "estados": estados,
+        "respuestas_stub": dict(stub.stats),
+        "workdir": workdir,
+    }
+
+
+def _print_report(result: dict) -> None:
+    print(f"Facturas: {result['facturas']} ({result['emisores']} emisores) en {result['elapsed_s']} s "
+          f"-> {result['facturas_por_segundo']} facturas/s")
+    print(f"{'etapa':<10}{'n':>6}{'p50 ms':>12}{'p95 ms':>12}{'total s':>10}")
+    for stage, datos in result["etapas"].items():
+        print(f"{stage:<10}{datos['count']:>6}{datos['p50_ms']:>12}{datos['p95_ms']:>12}{datos['total_s']:>10}")
+    rss = result["peak_rss_mb"]
+    print(f"RSS máximo: {rss['self']} MB (hijos: {rss['children']} MB)")
+    print(f"Estados: {result['estados']}")
+    print(f"Respuestas del receptor: {result['respuestas_stub']}")
+    print(f"Carpeta de trabajo: {result['workdir']}")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Banco de pruebas del envío de proformas contra un receptor local")
+    parser.add_argument("--facturas", type=int, default=200)
+    parser.add_argument("--emisores", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=0.05, help="latencia del receptor en segundos")
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--duplicate-rate", type=float, default=0.0)
+    parser.add_argument("--fecha-rate", type=float, default=0.0)
+    parser.add_argument("--no-json-rate", type=float, default=0.0)
+    parser.add_argument("--http-error-rate", type=float, default=0.0)
+    parser.add_argument("--timeout-rate", type=float, default=0.0)
+    parser.add_argument("--timeout-delay", type=float, default=90.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--workdir", default=None, help="carpeta de trabajo (por defecto, una temporal)")
+    parser.add_argument("--json", dest="json_path", default=None, help="guardar las métricas en este fichero")
+    args = parser.parse_args(argv)
+
+    config = StubConfig(latency=args.latency, jitter=args.jitter, duplicate_rate=args.duplicate_rate,
+                        fecha_rate=args.fecha_rate, no_json_rate=args.no_json_rate,
+                        http_error_rate=args.http_error_rate, timeout_rate=args.timeout_rate,
+                        timeout_delay=args.timeout_delay, seed=args.seed)
+    json_path = os.path.abspath(args.json_path) if args.json_path else None
+    result = run(args.facturas, args.emisores, config, workdir=args.workdir, seed=args.seed)
+    _print_report(result)
+    if json_path:
+        with open(json_path, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+    return 0
+
+
+__all__ = ["build_workbook", "peak_rss_mb", "run"]
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+Módulo para conocer el estado de la conexión con Facturantia.
+
+En lugar de sondear la web antes de cada factura, el monitor aprende de los
+envíos reales (respuestas, errores de conexión, timeouts) y sólo lanza un
+sondeo en segundo plano cuando el estado es desconocido o ha caducado.
+
+Estados:
+    online    la última respuesta fue correcta
+    degraded  timeouts, HTTP 5xx o algún error de conexión aislado
+    offline   varios errores de conexión seguidos (o el sondeo falló)
+    unknown   sin información reciente (TTL vencido)
+
+Variables de entorno:
+    FACTUNABO_CONNECTIVITY_TTL        segundos que se confía en el estado (por defecto 60)
+    FACTUNABO_CONNECTIVITY_PROBE_URL  URL del sondeo (por defecto https://www.facturantia.com)
+"""
+import os
+import threading
+import time
+import logging
+from typing import Optional
+
+logger = logging.getLogger("connectivity")
+
+ONLINE = "online"
+DEGRADED = "degraded"
+OFFLINE = "offline"
+UNKNOWN = "unknown"
+
+DEFAULT_TTL = 60.0
+DEFAULT_PROBE_URL = "https://www.facturantia.com"
+PROBE_TIMEOUT = 5
+OFFLINE_AFTER_FAILURES = 3  # errores de conexión seguidos para pasar a offline
+
+
+class ConnectivityMonitor:
+    """Estado de conectividad compartido entre hilos, con caducidad (TTL)."""
+
+    def __init__(self, ttl: Optional[float] = None, probe_url: Optional[str] = None):
+        if ttl is None:
+            try:
+                ttl = float(os.getenv("FACTUNABO_CONNECTIVITY_TTL", "") or DEFAULT_TTL)
+            except ValueError:
+                ttl = DEFAULT_TTL
+        self.ttl = max(1.0, ttl)
+        self.probe_url = probe_url or os.getenv("FACTUNABO_CONNECTIVITY_PROBE_URL", "") or DEFAULT_PROBE_URL
+        self._lock = threading.Lock()
+        self._state = UNKNOWN
+        self._updated_at = 0.0
+        self._consecutive_failures = 0
+        self._probe_thread = None
+
+    # --- Observaciones de envíos reales ---
+    def _set(self, state: str) -> None:
+        if state != self._state:
+            logger.info(f"Conectividad: {self._state} -> {state}")
+        self._state = state
+        self._updated_at = time.monotonic()
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._consecutive_failures = 0
+            self._set(ONLINE)
+
+    def record_degraded(self) -> None:
+        """El servidor contesta mal o tarde (timeout, 5xx) pero hay red."""
+        with self._lock:
+            self._consecutive_failures = 0
+            self._set(DEGRADED)
+
+    def record_failure(self) -> None:
+        """Error de conexión (DNS, conexión rechazada/reseteada...)."""
+        with self._lock:
+            self._consecutive_failures += 1
+            self._set(OFFLINE if self._consecutive_failures >= OFFLINE_AFTER_FAILURES else DEGRADED)
+
+    def record_response(self, status_code: int) -> None:
+        if status_code >= 500:
+            self.record_degraded()
+        else:
+            self.record_success()
+
+    # --- Consulta ---
+    def _current(self) -> str:
+        if self._state != UNKNOWN and time.monotonic() - self._updated_at > self.ttl:
+            return UNKNOWN
+        return self._state
+
+    def get_state(self) -> str:
+        """Estado actual sin bloquear; si es desconocido lanza un sondeo en segundo plano."""
+        with self._lock:
+            state = self._current()
+        if state == UNKNOWN:
+            self.probe_async()
+        return state
+
+    def is_offline(self) -> bool:
+        return self.get_state() == OFFLINE
+
+    def check(self, timeout: float = PROBE_TIMEOUT) -> str:
+        """Estado actual; si es desconocido sondea de forma síncrona (para acciones puntuales del usuario)."""
+        with self._lock:
+            state = self._current()
+        if state != UNKNOWN:
+            return state
+        return self.probe(timeout)
+
+    # --- Sondeo ---
+    def probe(self, timeout: float = PROBE_TIMEOUT) -> str:
+        """Sondeo síncrono; actualiza el estado salvo que un envío real lo haya hecho entretanto."""
+        import http_client
+
+        started = time.monotonic()
+        ok = http_client.probe(self.probe_url, timeout=timeout)
+        with self._lock:
+            # Un envío real ocurrido durante el sondeo es más fiable que el sondeo
+            if self._updated_at <= started:
+                if ok:
+                    self._consecutive_failures = 0
+                    self._set(ONLINE)
+                else:
+                    self._consecutive_failures = OFFLINE_AFTER_FAILURES
+                    self._set(OFFLINE)
+            return self._current()
+
+    def probe_async(self) -> None:
+        with self._lock:
+            if self._probe_thread is not None and self._probe_thread.is_alive():
+                return
+            self._probe_thread = threading.Thread(target=self.probe, name="connectivity-probe", daemon=True)
+            self._probe_thread.start()
+
+
+_MONITOR = None
+_MONITOR_LOCK = threading.Lock()
+
+
+def get_monitor() -> ConnectivityMonitor:
+    """Monitor compartido por todo el proceso."""
+    global _MONITOR
+    if _MONITOR is None:
+        with _MONITOR_LOCK:
+            if _MONITOR is None:
+                _MONITOR = ConnectivityMonitor()
+    return _MONITOR
+
+
+__all__ = ["ONLINE", "DEGRADED", "OFFLINE", "UNKNOWN", "ConnectivityMonitor", "get_monitor"]
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""
+Módulo con la línea de comandos de FactuNabo, sin Qt (servidor de lotes, tareas
+programadas, CI).
+
+Uso:
+    python -m factunabo send --excel Macro.xlsm [--post-action MARK|DELETE_OK|NONE]
+                             [--resume] [--download-pdfs --pdf-dest DIR --browser chrome]
+    python -m factunabo queue [--limit 50]
+    python -m factunabo pdfs [--pdf-dest DIR --browser chrome]
+
+Los mensajes van a stderr y el resultado, en JSON, a stdout. Códigos de salida:
+    0  todo correcto
+    1  alguna factura, reenvío o descarga con error
+    2  no se pudo ejecutar (Excel inexistente, error general, sin conexión)
+
+Sólo se importa lo necesario para cada orden (pandas, openpyxl... al ejecutar,
+Selenium sólo al descargar PDFs), de modo que arrancar y validar argumentos es
+inmediato.
+"""
+import argparse
+import contextlib
+import json
+import os
+import sys
+import time
+
+EXIT_OK = 0
+EXIT_FAILURES = 1
+EXIT_ERROR = 2
+
+SUMMARY_PATH = os.path.join("responses", "summary.json")
+
+
+def _print_json(data: dict) -> None:
+    json.dump(data, sys.stdout, ensure_ascii=False, indent=2, default=str)
+    sys.stdout.write("\n")
+    sys.stdout.flush()
+
+
+def _new_job(args):
+    from send_job import SendJob
+
+    job = SendJob()
+    job.set_download_options(bool(getattr(args, "download_pdfs", False)), args.pdf_dest, args.browser,
+                             headless=not args.show_browser)
+    return job
+
+
+def _pdf_result(pdfs) -> dict:
+    if pdfs is None:
+        return {"total": 0, "ok": 0, "fallidas": 0}
+    return {**pdfs, "fallidas": pdfs["total"] - pdfs["ok"]}
+
+
+def cmd_send(args) -> int:
+    excel = os.path.abspath(args.excel)
+    if not os.path.exists(excel):
+        _print_json({"comando": "send", "ok": False, "error": f"No existe el Excel: {excel}"})
+        return EXIT_ERROR
+    if args.resume:
+        os.environ["FACTUNABO_RESUME"] = "1"
+
+    # prueba configura el log (fichero en logs/ y stderr) al importarse
+    import prueba
+    import send_journal
+
+    job = _new_job(args)
+    job.set_excel_path(excel)
+    job.set_post_macro_action(args.post_action)
+
+    inicio = time.time()
+    # Cualquier print de los módulos de envío va a stderr: stdout queda para el JSON
+    with contextlib.redirect_stdout(sys.stderr):
+        resultado = job.process()
+
+    filas = []
+    if os.path.exists(SUMMARY_PATH) and os.path.getmtime(SUMMARY_PATH) >= inicio - 1:
+        with open(SUMMARY_PATH, encoding="utf-8") as f:
+            filas = json.load(f)
+    elif resultado["ok"]:
+        resultado = {**resultado, "ok": False, "error": "El envío no generó responses/summary.json (ver log)"}
+
+    estados = {}
+    for fila in filas:
+        status = str(fila.get("status", "")).upper()
+        estados[status] = estados.get(status, 0) + 1
+    correctas = sum(n for s, n in estados.items() if s in send_journal.STATUS_CONFIRMADOS)
+    en_cola = sum(n for s, n in estados.items() if s in send_journal.STATUS_EN_COLA)
+    fallidas = len(filas) - correctas - en_cola
+    pdfs = _pdf_result(resultado.get("pdfs")) if args.download_pdfs else None
+    informe = os.path.join(prueba.RESPONSE_DIR, "perf_report.json")
+
+    _print_json({
+        "comando": "send",
+        "ok": resultado["ok"],
+        "error": resultado.get("error"),
+        "excel": excel,
+        "post_action": args.post_action.upper(),
+        "facturas": len(filas),
+        "correctas": correctas,
+        "en_cola": en_cola,
+        "fallidas": fallidas,
+        "estados": estados,
+        "pdfs": pdfs,
+        "summary": os.path.abspath(SUMMARY_PATH) if filas else None,
+        "informe_tiempos": os.path.abspath(informe) if os.path.exists(informe) else None,
+        "duracion_s": round(time.time() - inicio, 3),
+    })
+    if not resultado["ok"]:
+        return EXIT_ERROR
+    return EXIT_FAILURES if fallidas or (pdfs and pdfs["fallidas"]) else EXIT_OK
+
+
+def cmd_queue(args) -> int:
+    import connectivity
+    import prueba
+
+    monitor = connectivity.get_monitor()
+    if monitor.check(timeout=5) == connectivity.OFFLINE and monitor.probe(timeout=5) == connectivity.OFFLINE:
+        _print_json({"comando": "queue", "ok": False, "error": "Sin conexión con Facturantia"})
+        return EXIT_ERROR
+    with contextlib.redirect_stdout(sys.stderr):
+        resultado = prueba.process_offline_queue(limit=args.limit)
+    _print_json({"comando": "queue", "ok": True, **resultado})
+    return EXIT_FAILURES if resultado["fallidas"] else EXIT_OK
+
+
+def cmd_pdfs(args) -> int:
+    import prueba  # noqa: F401  (configura el log)
+
+    if not os.path.exists(SUMMARY_PATH):
+        _print_json({"comando": "pdfs", "ok": False, "error": f"No existe {SUMMARY_PATH}"})
+        return EXIT_ERROR
+    job = _new_job(args)
+    with contextlib.redirect_stdout(sys.stderr):
+        pdfs = _pdf_result(job.download_pdfs())
+    _print_json({"comando": "pdfs", "ok": True, **pdfs})
+    return EXIT_FAILURES if pdfs["fallidas"] else EXIT_OK
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="python -m factunabo", description="FactuNabo sin interfaz gráfica")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    def _pdf_options(p, with_flag: bool):
+        if with_flag:
+            p.add_argument("--download-pdfs", action="store_true", help="descargar los PDFs al terminar")
+        p.add_argument("--pdf-dest", default=None, help="carpeta de destino de los PDFs")
+        p.add_argument("--browser", default=None, choices=("chrome", "edge"),
+                       help="navegador para las descargas (por defecto, el que se detecte)")
+        p.add_argument("--show-browser", action="store_true", help="no usar el modo headless")
+
+    send = sub.add_parser("send", help="enviar las proformas de una Macro")
+    send.add_argument("--excel", required=True, help="ruta de la Macro (.xlsm/.xlsx)")
+    send.add_argument("--post-action", default="MARK", type=str.upper, choices=("MARK", "DELETE_OK", "NONE"),
+                      help="qué hacer en la Macro tras el envío (por defecto MARK)")
+    send.add_argument("--resume", action="store_true", help="no reenviar lo ya confirmado en el diario de envíos")
+    _pdf_options(send, with_flag=True)
+    send.set_defaults(func=cmd_send)
+
+    queue = sub.add_parser("queue", help="reenviar la cola offline")
+    queue.add_argument("--limit", type=int, default=50)
+    queue.set_defaults(func=cmd_queue)
+
+    pdfs = sub.add_parser("pdfs", help="descargar los PDFs de responses/summary.json")
+    _pdf_options(pdfs, with_flag=False)
+    pdfs.set_defaults(func=cmd_pdfs)
+    return parser
+
+
+def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+    try:
+        return args.func(args)
+    except KeyboardInterrupt:
+        return EXIT_ERROR
+    except Exception as e:
+        _print_json({"comando": args.command, "ok": False, "error": str(e)})
+        return EXIT_ERROR
+
+
+__all__ = ["EXIT_OK", "EXIT_FAILURES", "EXIT_ERROR", "build_parser", "main"]
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""
+Módulo con un servidor local que imita proformas_receptor.php de Facturantia.
+
+Sirve para medir y probar el envío sin tocar producción. Devuelve las mismas
+formas de respuesta que interpreta prueba.send_proforma:
+
+    correcto   estado_envio_facturantia=CORRECTO con proformas_procesadas,
+               numeros_facturas y enlaces_qr
+    duplicado  mensaje_atencion (también al reenviar un external_id ya aceptado)
+    fecha      mensaje_error de fecha de emisión posterior
+    no_json    cuerpo HTML con HTTP 200
+    http_500   error del servidor
+    timeout    no contesta hasta pasados timeout_delay segundos
+
+Una petición puede llevar varias proformas en <proformas>: si es correcta se
+devuelven todas en proformas_procesadas; cualquier otro resultado se aplica
+a la petición entera.
+
+Uso:
+    python facturantia_stub.py --port 8765 --latency 0.05 --duplicate-rate 0.02
+
+y en la hoja CLIENTES (API_URL) o en api_url: http://127.0.0.1:8765/API/proformas_receptor.php
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional, Tuple
+
+RECEPTOR_PATH = "/API/proformas_receptor.php"
+OUTCOMES = ("correcto", "duplicado", "fecha", "no_json", "http_500", "timeout")
+
+_EXTERNAL_ID_RE = re.compile(rb"<external_id>([^<]*)</external_id>")
+
+
+class StubConfig:
+    """Latencia y probabilidad de cada tipo de respuesta (el resto son correctas)."""
+
+    def __init__(self, latency: float = 0.05, jitter: float = 0.0,
+                 duplicate_rate: float = 0.0, fecha_rate: float = 0.0, no_json_rate: float = 0.0,
+                 http_error_rate: float = 0.0, timeout_rate: float = 0.0, timeout_delay: float = 90.0,
+                 seed: Optional[int] = None):
+        self.latency = max(0.0, latency)
+        self.jitter = max(0.0, jitter)
+        self.duplicate_rate = duplicate_rate
+        self.fecha_rate = fecha_rate
+        self.no_json_rate = no_json_rate
+        self.http_error_rate = http_error_rate
+        self.timeout_rate = timeout_rate
+        self.timeout_delay = timeout_delay
+        self.seed = seed
+
+
+class FacturantiaStub:
+    """Servidor HTTP en un hilo; start() devuelve la URL del receptor."""
+
+    def __init__(self, config: Optional[StubConfig] = None, host: str = "127.0.0.1", port: int = 0):
+        self.config = config or StubConfig()
+        self.host = host
+        self.port = port
+        self.stats: Counter = Counter()
+        self._accepted = set()
+        self._lock = threading.Lock()
+        self._rnd = random.Random(self.config.seed)
+        self._server: Optional[ThreadingHTTPServer] = None
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}{RECEPTOR_PATH}"
+
+    def start(self) -> str:
+        self._server = ThreadingHTTPServer((self.host, self.port), self._make_handler())
+        self._server.daemon_threads = True
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, name="facturantia-stub", daemon=True)
+        self._thread.start()
+        return self.url
+
+    def stop(self) -> None:
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    # --- Respuestas ---
+    def _choose(self, ids) -> Tuple[str, float]:
+        cfg = self.config
+        with self._lock:
+            r = self._rnd.random()
+            delay = cfg.latency + (self._rnd.uniform(0, cfg.jitter) if cfg.jitter else 0.0)
+            # Como un lote con alguna proforma ya aceptada se rechaza entero
+            if any(i in self._accepted for i in ids):
+                outcome = "duplicado"
+            else:
+                outcome = "correcto"
+                for name, rate in (("timeout", cfg.timeout_rate), ("http_500", cfg.http_error_rate),
+                                   ("no_json", cfg.no_json_rate), ("fecha", cfg.fecha_rate),
+                                   ("duplicado", cfg.duplicate_rate)):
+                    if r < rate:
+                        outcome = name
+                        break
+                    r -= rate
+            if outcome == "correcto":
+                self._accepted.update(ids)
+            self.stats[outcome] += 1
+            self.stats["proformas"] += len(ids)
+        return outcome, delay
+
+    @staticmethod
+    def _body(outcome: str, ids) -> Tuple[int, str, bytes]:
+        if outcome == "correcto":
+            payload = {
+                "estado_envio_facturantia": "CORRECTO",
+                "proformas_procesadas": [
+                    {"external_id": i, "status": "ok", "message": "Proforma creada",
+                     "pdf": f"http://127.0.0.1/pdf/{i}.pdf"} for i in ids
+                ],
+                "numeros_facturas": {i: f"F-{i}" for i in ids},
+                "enlaces_qr": {i: f"http://127.0.0.1/qr/{i}" for i in ids},
+            }
+        elif outcome == "duplicado":
+            payload = {"mensaje_atencion": "<b>Atención:</b> ya existe una proforma con el external_id "
+                                           + ", ".join(ids)}
+        elif outcome == "fecha":
+            payload = {"mensaje_error": "<p>Existen facturas emitidas en la serie con fecha de emisión "
+                                        "posterior a la de esta proforma.</p>"}
+        elif outcome == "no_json":
+            return 200, "text/html; charset=utf-8", "<html><body>Error interno del receptor</body></html>".encode("utf-8")
+        else:  # http_500
+            return 500, "text/html; charset=utf-8", b"<html><body>500 Internal Server Error</body></html>"
+        return 200, "application/json; charset=utf-8", json.dumps(payload, ensure_ascii=False).encode("utf-8")
+
+    def _make_handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Cabeceras y cuerpo en un solo segmento: sin esperas de Nagle/ACK retardado
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, status: int, content_type: str, body: bytes) -> None:
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                # Sondeo de conectividad
+                self._reply(200, "text/plain", b"ok")
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0) or 0)
+                data = self.rfile.read(length)
+                if not self.headers.get("X-Token"):
+                    self._reply(200, "application/json", json.dumps({"mensaje_error": "Token no válido"}).encode("utf-8"))
+                    return
+                ids = [m.decode("utf-8", "replace") for m in _EXTERNAL_ID_RE.findall(data)]
+                outcome, delay = stub._choose(ids)
+                if outcome == "timeout":
+                    time.sleep(stub.config.timeout_delay)
+                    self.close_connection = True
+                    return
+                time.sleep(delay)
+                self._reply(*stub._body(outcome, ids))
+
+        return Handler
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="Servidor local que imita el receptor de proformas de Facturantia")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.05, help="segundos por respuesta")
+    parser.add_argument("--jitter", type=float, default=0.0, help="segundos aleatorios añadidos a la latencia")
+    parser.add_argument("--duplicate-rate", type=float, default=0.0)
+    parser.add_argument("--fecha-rate", type=float, default=0.0)
+    parser.add_argument("--no-json-rate", type=float, default=0.0)
+    parser.add_argument("--http-error-rate", type=float, default=0.0)
+    parser.add_argument("--timeout-rate", type=float, default=0.0)
+    parser.add_argument("--timeout-delay", type=float, default=90.0)
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args(argv)
+    config = StubConfig(latency=args.latency, jitter=args.jitter, duplicate_rate=args.duplicate_rate,
+                        fecha_rate=args.fecha_rate, no_json_rate=args.no_json_rate,
+                        http_error_rate=args.http_error_rate, timeout_rate=args.timeout_rate,
+                        timeout_delay=args.timeout_delay, seed=args.seed)
+    stub = FacturantiaStub(config, host=args.host, port=args.port)
+    print(f"Receptor de pruebas en {stub.start()}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        stub.stop()
+
+
+__all__ = ["RECEPTOR_PATH", "OUTCOMES", "StubConfig", "FacturantiaStub"]
+
+
+if __name__ == "__main__":
+    main()
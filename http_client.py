@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+"""
+Módulo con el cliente HTTP compartido para hablar con Facturantia.
+
+Todas las peticiones reutilizan un único pool de conexiones keep-alive por
+host (el HTTPAdapter de urllib3 es seguro entre hilos), de modo que cada
+factura no paga un nuevo handshake TCP/TLS. Cada hilo usa su propia
+requests.Session montada sobre ese adaptador compartido.
+
+Los fallos transitorios se reintentan con backoff exponencial y jitter. Un
+POST (el envío de proformas) sólo se reintenta si la petición no llegó al
+servidor (timeout o rechazo al conectar) o con HTTP 503; una conexión cortada
+a mitad, un timeout de lectura o un 502/504 pueden llegar con la proforma ya
+procesada y reintentarlos duplicaría la factura. Las demás peticiones (GET de
+PDFs, sondeo) se reintentan también con cualquier error de conexión y con
+502/503/504.
+
+Variables de entorno:
+    FACTUNABO_HTTP_CONNECT_TIMEOUT  segundos para conectar (por defecto min(timeout, 30))
+    FACTUNABO_HTTP_READ_TIMEOUT     segundos para leer (por defecto el timeout de la API)
+    FACTUNABO_HTTP_RETRIES          reintentos adicionales (por defecto 3)
+    FACTUNABO_HTTP_BACKOFF          base del backoff en segundos (por defecto 0.5)
+    FACTUNABO_HTTP_POOL             conexiones por host en el pool (por defecto 16)
+"""
+import os
+import random
+import threading
+import time
+import logging
+from typing import Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+logger = logging.getLogger("http_client")
+
+RETRY_STATUS = (502, 503, 504)
+POST_RETRY_STATUS = (503,)
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF = 0.5
+MAX_BACKOFF = 8.0
+DEFAULT_POOL = 16
+MAX_CONNECT_TIMEOUT = 30
+
+_ADAPTER = None
+_ADAPTER_LOCK = threading.Lock()
+_LOCAL = threading.local()
+
+
+def _env_float(name: str, default: Optional[float]) -> Optional[float]:
+    raw = os.getenv(name, "").strip()
+    if not raw:
+        return default
+    try:
+        value = float(raw)
+    except ValueError:
+        return default
+    return value if value > 0 else default
+
+
+def _env_int(name: str, default: int) -> int:
+    raw = os.getenv(name, "").strip()
+    try:
+        return max(0, int(raw)) if raw else default
+    except ValueError:
+        return default
+
+
+def _get_adapter() -> HTTPAdapter:
+    global _ADAPTER
+    if _ADAPTER is None:
+        with _ADAPTER_LOCK:
+            if _ADAPTER is None:
+                pool = max(1, _env_int("FACTUNABO_HTTP_POOL", DEFAULT_POOL))
+                # max_retries=0: los reintentos se gestionan aquí para aplicar backoff con jitter
+                _ADAPTER = HTTPAdapter(pool_connections=4, pool_maxsize=pool, max_retries=0, pool_block=False)
+    return _ADAPTER
+
+
+def get_session() -> requests.Session:
+    """Devuelve la sesión del hilo actual, montada sobre el pool compartido."""
+    session = getattr(_LOCAL, "session", None)
+    if session is None:
+        session = requests.Session()
+        adapter = _get_adapter()
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        _LOCAL.session = session
+    return session
+
+
+def get_timeouts(api_timeout: float) -> Tuple[float, float]:
+    """Tupla (connect, read) a partir del timeout de la API y las variables de entorno."""
+    read_timeout = _env_float("FACTUNABO_HTTP_READ_TIMEOUT", float(api_timeout))
+    connect_timeout = _env_float("FACTUNABO_HTTP_CONNECT_TIMEOUT", min(float(api_timeout), MAX_CONNECT_TIMEOUT))
+    return connect_timeout, read_timeout
+
+
+def _backoff_delay(attempt: int) -> float:
+    base = _env_float("FACTUNABO_HTTP_BACKOFF", DEFAULT_BACKOFF)
+    # Full jitter: espera aleatoria entre 0 y el techo exponencial
+    return random.uniform(0, min(MAX_BACKOFF, base * (2 ** attempt)))
+
+
+def _is_idempotent(method: str) -> bool:
+    return method.upper() != "POST"
+
+
+def _retry_status(method: str) -> Tuple[int, ...]:
+    return RETRY_STATUS if _is_idempotent(method) else POST_RETRY_STATUS
+
+
+def _connection_refused(exc: Exception) -> bool:
+    """Si requests no llegó a abrir la conexión (rechazada, DNS): el cuerpo no se envió."""
+    reason = getattr(exc.args[0], "reason", None) if exc.args else None
+    return isinstance(reason, NewConnectionError)
+
+
+def _is_retryable_exception(exc: Exception, method: str = "GET") -> bool:
+    if isinstance(exc, requests.exceptions.ConnectTimeout):
+        return True  # la petición no llegó a enviarse
+    if isinstance(exc, requests.exceptions.Timeout):
+        return False  # ReadTimeout: el servidor puede haberla procesado
+    if not isinstance(exc, requests.exceptions.ConnectionError):
+        return False
+    # Conexión cortada tras enviar el cuerpo: sólo se repite si la petición es idempotente
+    return _is_idempotent(method) or _connection_refused(exc)
+
+
+def request(method: str, url: str, retries: Optional[int] = None, **kwargs) -> requests.Response:
+    """
+    Lanza la petición por el pool compartido reintentando fallos transitorios.
+
+    Si tras agotar los reintentos el servidor sigue devolviendo un estado
+    reintentable, se devuelve esa última respuesta; si el fallo es de
+    conexión, se propaga la excepción de requests.
+    """
+    if retries is None:
+        retries = _env_int("FACTUNABO_HTTP_RETRIES", DEFAULT_RETRIES)
+    session = get_session()
+    retry_status = _retry_status(method)
+    attempt = 0
+    while True:
+        try:
+            resp = session.request(method, url, **kwargs)
+        except requests.exceptions.RequestException as e:
+            if attempt >= retries or not _is_retryable_exception(e, method):
+                raise
+            delay = _backoff_delay(attempt)
+            logger.warning(f"Reintento {attempt + 1}/{retries} de {method} {url} en {delay:.2f}s: {e}")
+        else:
+            if resp.status_code not in retry_status or attempt >= retries:
+                return resp
+            delay = _backoff_delay(attempt)
+            logger.warning(f"Reintento {attempt + 1}/{retries} de {method} {url} en {delay:.2f}s: HTTP {resp.status_code}")
+            resp.close()
+        attempt += 1
+        time.sleep(delay)
+
+
+def post(url: str, **kwargs) -> requests.Response:
+    return request("POST", url, **kwargs)
+
+
+def get(url: str, **kwargs) -> requests.Response:
+    return request("GET", url, **kwargs)
+
+
+def get_async_client():
+    """Cliente httpx asíncrono con pool keep-alive (uno por lote/bucle de eventos)."""
+    import httpx
+
+    pool = max(1, _env_int("FACTUNABO_HTTP_POOL", DEFAULT_POOL))
+    limits = httpx.Limits(max_connections=pool, max_keepalive_connections=pool)
+    return httpx.AsyncClient(limits=limits)
+
+
+async def async_post(client, url: str, retries: Optional[int] = None, **kwargs):
+    """POST asíncrono con la misma política de reintentos que un POST de request()."""
+    import asyncio
+    import httpx
+
+    if retries is None:
+        retries = _env_int("FACTUNABO_HTTP_RETRIES", DEFAULT_RETRIES)
+    attempt = 0
+    while True:
+        try:
+            resp = await client.post(url, **kwargs)
+        except (httpx.ConnectError, httpx.ConnectTimeout) as e:
+            # Sólo fallos al conectar: un RemoteProtocolError llega con el cuerpo ya enviado
+            if attempt >= retries:
+                raise
+            delay = _backoff_delay(attempt)
+            logger.warning(f"Reintento {attempt + 1}/{retries} de POST {url} en {delay:.2f}s: {e}")
+        else:
+            if resp.status_code not in POST_RETRY_STATUS or attempt >= retries:
+                return resp
+            delay = _backoff_delay(attempt)
+            logger.warning(f"Reintento {attempt + 1}/{retries} de POST {url} en {delay:.2f}s: HTTP {resp.status_code}")
+        attempt += 1
+        await asyncio.sleep(delay)
+
+
+def probe(url: str = "https://www.facturantia.com", timeout: float = 5) -> bool:
+    """Comprueba si el host responde (sin reintentos)."""
+    try:
+        get(url, timeout=timeout, retries=0).close()
+        return True
+    except requests.exceptions.RequestException:
+        return False
+
+
+__all__ = ["get_session", "get_timeouts", "request", "post", "get", "probe", "get_async_client", "async_post"]
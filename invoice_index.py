@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""
+Módulo con el índice de facturas de un lote.
+
+Agrupa una sola vez conceptos, formas de pago y conceptos de texto por
+(NumFactura, empresa_emisora) para que cada factura obtenga sus filas en O(1)
+en lugar de recorrer los DataFrames completos con máscaras booleanas.
+"""
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+KEY_COLS = ["NumFactura", "empresa_emisora"]
+TEXTO_COLS = ["NumFactura", "empresa_emisora", "descripcion", "posicion"]
+
+
+def _group_positions(df: Optional[pd.DataFrame]) -> Dict[Tuple, np.ndarray]:
+    """Posiciones (iloc) de cada factura; las claves nulas se descartan como haría la máscara ==."""
+    if df is None or df.empty or any(c not in df.columns for c in KEY_COLS):
+        return {}
+    return df.groupby(KEY_COLS, sort=False).indices
+
+
+class InvoiceIndex:
+    """Acceso por factura a las filas de conceptos, formas de pago y textos."""
+
+    def __init__(self, df_conceptos: pd.DataFrame, df_forma_pago: pd.DataFrame,
+                 df_conceptos_texto: Optional[pd.DataFrame] = None):
+        self.df_conceptos = df_conceptos
+        self.df_forma_pago = df_forma_pago
+        if df_conceptos_texto is None or df_conceptos_texto.empty:
+            df_conceptos_texto = pd.DataFrame(columns=TEXTO_COLS)
+        self.df_conceptos_texto = df_conceptos_texto
+        self._conceptos = _group_positions(df_conceptos)
+        self._forma_pago = _group_positions(df_forma_pago)
+        self._textos = _group_positions(df_conceptos_texto)
+
+    @staticmethod
+    def _take(df: pd.DataFrame, groups: Dict[Tuple, np.ndarray], num, empresa) -> pd.DataFrame:
+        try:
+            positions = groups.get((num, empresa))
+        except TypeError:  # clave no hashable
+            positions = None
+        if positions is None:
+            return df.iloc[0:0]
+        return df.iloc[positions]
+
+    def conceptos(self, num, empresa) -> pd.DataFrame:
+        return self._take(self.df_conceptos, self._conceptos, num, empresa)
+
+    def forma_pago(self, num, empresa) -> pd.DataFrame:
+        return self._take(self.df_forma_pago, self._forma_pago, num, empresa)
+
+    def textos(self, num, empresa) -> pd.DataFrame:
+        return self._take(self.df_conceptos_texto, self._textos, num, empresa)
+
+
+__all__ = ["InvoiceIndex"]
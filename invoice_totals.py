@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+Módulo con el cálculo de importes de las facturas.
+
+Calcula de una vez, sin recorrer fila a fila, los importes por línea (base,
+IVA, retención y total) y los totales por (NumFactura, empresa_emisora). Es
+la única fuente de los importes que usan tanto summary.json como el XML.
+
+Reglas por línea (las mismas que aplicaba el XML):
+    base      = unidades * base_unidad
+    iva       = base * porcentaje / 100
+    retención = round(base * porcentaje_retenido / 100, 2), sólo si hay
+                tipo_impuesto_retenido y porcentaje_retenido > 0
+    total     = base + iva - retención
+"""
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+KEY_COLS = ["NumFactura", "empresa_emisora"]
+LINE_COLS = ["base_imponible_cal", "importe_iva_cal", "importe_retencion_cal", "importe_total_cal"]
+
+
+def _num_col(df: pd.DataFrame, col: str) -> pd.Series:
+    if col not in df.columns:
+        return pd.Series(0.0, index=df.index)
+    return pd.to_numeric(df[col], errors="coerce").fillna(0.0).astype(float)
+
+
+def add_line_amounts(df_conceptos: pd.DataFrame) -> pd.DataFrame:
+    """Devuelve una copia de df_conceptos con las columnas *_cal calculadas."""
+    df = df_conceptos.copy()
+    if df.empty:
+        for col in LINE_COLS:
+            df[col] = pd.Series(dtype=float)
+        return df
+
+    base = _num_col(df, "unidades") * _num_col(df, "base_unidad")
+    iva = base * (_num_col(df, "porcentaje") / 100.0)
+
+    if "tipo_impuesto_retenido" in df.columns:
+        tipo = df["tipo_impuesto_retenido"].astype(str).str.strip()
+        con_tipo = (tipo != "").to_numpy()
+    else:
+        con_tipo = np.zeros(len(df), dtype=bool)
+    porc_ret = _num_col(df, "porcentaje_retenido")
+    aplica = con_tipo & (porc_ret > 0).to_numpy()
+
+    ret = np.zeros(len(df), dtype=float)
+    if aplica.any():
+        bruto = (base.to_numpy() * (porc_ret.to_numpy() / 100.0))[aplica]
+        # round() de Python para obtener exactamente los mismos céntimos que antes
+        ret[aplica] = [round(float(v), 2) for v in bruto]
+    ret = pd.Series(ret, index=df.index)
+
+    df["base_imponible_cal"] = base
+    df["importe_iva_cal"] = iva
+    df["importe_retencion_cal"] = ret
+    df["importe_total_cal"] = base + iva - ret
+    return df
+
+
+class InvoiceTotals:
+    """Totales por factura calculados en una sola pasada groupby."""
+
+    def __init__(self, df_conceptos: pd.DataFrame):
+        if not all(c in df_conceptos.columns for c in LINE_COLS):
+            df_conceptos = add_line_amounts(df_conceptos)
+        self._totals: Dict[Tuple, Dict[str, float]] = {}
+        if df_conceptos.empty or any(c not in df_conceptos.columns for c in KEY_COLS):
+            return
+        grouped = df_conceptos.groupby(KEY_COLS, sort=False)[LINE_COLS].sum()
+        for key, row in zip(grouped.index, grouped.itertuples(index=False)):
+            self._totals[key] = {
+                "base": float(row.base_imponible_cal),
+                "iva": float(row.importe_iva_cal),
+                "retencion": float(row.importe_retencion_cal),
+                "total": float(row.importe_total_cal),
+            }
+
+    def get(self, num, empresa) -> Dict[str, float]:
+        """Totales de las líneas de la factura (ceros si no tiene conceptos)."""
+        try:
+            found = self._totals.get((num, empresa))
+        except TypeError:
+            found = None
+        return dict(found) if found else {"base": 0.0, "iva": 0.0, "retencion": 0.0, "total": 0.0}
+
+    def importe(self, num, empresa, suplidos: Optional[float] = 0.0) -> float:
+        """Importe total de la factura para el resumen: líneas + suplidos, a 2 decimales."""
+        try:
+            suplidos = float(suplidos or 0.0)
+        except (TypeError, ValueError):
+            suplidos = 0.0
+        if np.isnan(suplidos):
+            suplidos = 0.0
+        return round(self.get(num, empresa)["total"] + suplidos, 2)
+
+
+__all__ = ["LINE_COLS", "add_line_amounts", "InvoiceTotals"]
@@ -8,6 +8,8 @@ import shutil
 from datetime import datetime, timedelta
 from pathlib import Path
 
+import artifact_store
+
 LOG_DIR = "logs"
 COMPRESSED_DIR = os.path.join(LOG_DIR, "compressed")
 DAYS_TO_COMPRESS = 30  # Comprimir logs mayores a 30 días
@@ -44,8 +46,13 @@ def compress_old_logs(days=DAYS_TO_COMPRESS):
     return compressed_count
 
 def compress_old_xmls(days=DAYS_TO_COMPRESS):
-    """Comprime XMLs antiguos en el directorio de logs."""
-    if not os.path.exists(LOG_DIR):
+    """
+    Comprime XMLs antiguos en el directorio de logs.
+
+    Con el almacén de artefactos (FACTUNABO_ARTIFACTS=store, por defecto) no hay
+    XML sueltos: el almacén ya los guarda comprimidos.
+    """
+    if not artifact_store.writes_files() or not os.path.exists(LOG_DIR):
         return 0
     
     os.makedirs(COMPRESSED_DIR, exist_ok=True)
@@ -4,12 +4,17 @@
    (df_factura, df_conceptos, df_forma_pago, df_conceptos_texto)
    [CORREGIDO V7 - ¡LA BUENA!] Mantiene lógica original 100% + cierre seguro con finally wb.close().
 """
-import os, re, unicodedata, numpy as np, pandas as pd
+import functools, os, re, unicodedata, zipfile, numpy as np, pandas as pd
 from openpyxl import load_workbook
 from openpyxl.utils.cell import column_index_from_string
 # Importar Workbook para type hinting (opcional pero bueno)
 from openpyxl.workbook import Workbook
 
+import macro_history
+import workbook_cache
+import workbook_session
+import xlsx_stream
+
 
 def _norm_invoice_id(x: object) -> str:
     s = str(x).strip()
@@ -21,6 +26,7 @@ def _norm_invoice_id(x: object) -> str:
     return s
 
 PREFERRED_SHEETS = ["Macro", "MACRO", "Hoja1", "Resumen"]
+CLIENTES_SHEETS = ["CLIENTES", "Clientes", "clientes", "EMISORES", "EMISOR", "CONFIG", "Config"]
 
 EXCEL_COLS = {
     "num_factura": "A", "fecha_emision": "B", "cif_emisor": "E",
@@ -50,6 +56,9 @@ def excel_col_to_idx(col_letters: str) -> int:
     # Usa la función original de openpyxl que sí existe
     return column_index_from_string(col_letters.strip().upper()) - 1
 
+# Columnas (0-based) de la hoja Macro que usa el adaptador: las únicas que decodifica el lector directo
+MACRO_COLUMNS = sorted({excel_col_to_idx(letter) for letter in EXCEL_COLS.values()})
+
 def clean_nif_cliente(nif: str) -> str:
     if nif is None: return ""
     s = str(nif)
@@ -65,6 +74,13 @@ def normalize_cif_emisor(s: str) -> str:
     s = re.sub(r'[\s\-\._]', '', s)
     return s
 
+def _norm_cif_cell(x):
+    if pd.isna(x): return ""
+    s = str(x).strip()
+    if s == "" or s.lower() in ("none", "nan", "null", "#n/a", "#n/d", "-", "—"):
+        return ""
+    return normalize_cif_emisor(s)
+
 def normalize_series_list(series_str: str) -> list:
     if pd.isna(series_str): return []
     return [p.strip() for p in str(series_str).split(',') if p.strip() != ""]
@@ -128,71 +144,70 @@ def _split_cp_prov(s: str):
         return t[0], " ".join(t[1:]).strip()
     return "", s
 
-# [MODIFICADO] Usar try...finally para asegurar wb.close()
-def _read_sheet_to_df_any(path: str, preferred_names=None):
-    wb: Workbook = None # Definir wb fuera del try
+def _pick_sheet(names, states, preferred_names=None):
+    """Hoja preferida (sin distinguir mayúsculas) o, si no hay, la primera visible."""
+    target = None
+    if preferred_names:
+        low = {n.lower(): n for n in names}
+        for cand in preferred_names:
+            if cand.lower() in low:
+                target = low[cand.lower()]; break
+    if not target:
+        for name in names:
+            if states.get(name, "visible") == "visible": target = name; break
+        if not target: target = names[0]
+    return target
+
+
+def _use_stream_reader(path: str) -> bool:
+    """Lector directo del zip salvo FACTUNABO_XLSX_READER=openpyxl (o si no es un .xlsx/.xlsm)."""
+    if os.getenv("FACTUNABO_XLSX_READER", "stream").strip().lower() == "openpyxl":
+        return False
+    return zipfile.is_zipfile(path)
+
+
+def _stream_sheet_rows(path: str, preferred_names, columns):
+    """Filas (sólo columns) de la hoja elegida con xlsx_stream y el ancho de la hoja."""
+    rows, width = [], 0
+    with xlsx_stream.XlsxReader(path) as reader:
+        sheets = reader.worksheets
+        target = _pick_sheet([s.name for s in sheets], {s.name: s.state for s in sheets}, preferred_names)
+        for chunk in reader.iter_chunks(target, columns):
+            rows.extend(_convert_datetime_cells(chunk.rows))
+            width = max(width, chunk.width)
+    return rows, width
+
+
+# Las filas salen de una WorkbookSession (el libro se abre una sola vez por adaptación)
+# o, con columns, del lector directo xlsx_stream, que sólo decodifica esas columnas
+def _read_sheet_to_df_any(path: str, preferred_names=None, session=None, columns=None):
+    """
+    Hoja preferida como DataFrame sin cabecera. Sin columns, todas las columnas
+    (etiquetas 0..n-1); con columns (índices 0-based), sólo esas, con su índice
+    como etiqueta. Si el lector directo falla se usa openpyxl con todas.
+    """
+    if columns is not None and _use_stream_reader(path):
+        columns = sorted(set(columns))
+        try:
+            rows, width = _stream_sheet_rows(path, preferred_names, columns)
+        except Exception as e:
+            print(f"Advertencia: lectura directa de {path} no disponible ({e}). Se usa openpyxl.")
+        else:
+            if not rows: return pd.DataFrame()
+            keep = [i for i, c in enumerate(columns) if c < width]
+            return pd.DataFrame([[r[i] for i in keep] for r in rows], columns=[columns[i] for i in keep])
+
     try:
-        wb = load_workbook(path, data_only=True, read_only=True)
-        names = [ws.title for ws in wb.worksheets]
-        target = None
-        if preferred_names:
-            low = {n.lower(): n for n in names}
-            for cand in preferred_names:
-                if cand.lower() in low:
-                    target = low[cand.lower()]; break
-        if not target:
-            for ws in wb.worksheets:
-                if ws.sheet_state == "visible": target = ws.title; break
-            if not target: target = wb.worksheets[0].title
-        ws = wb[target]
-        rows_raw = [list(r) for r in ws.iter_rows(values_only=True)]
-        
-        # Convertir objetos datetime a strings de forma segura para evitar problemas de timestamp
-        from datetime import datetime as py_datetime
-        rows = []
-        for row in rows_raw:
-            converted_row = []
-            for cell_val in row:
-                # Si es un objeto datetime de Python, convertir a string de forma segura
-                if isinstance(cell_val, py_datetime):
-                    try:
-                        # NUNCA llamar a strftime() directamente - puede causar overflow
-                        # Usar solo la representación string del objeto
-                        date_repr = str(cell_val)
-                        # Si tiene formato de fecha (YYYY-MM-DD HH:MM:SS o YYYY-MM-DD), extraerlo
-                        if len(date_repr) >= 10 and date_repr[4] == '-' and date_repr[7] == '-':
-                            # Extraer solo la parte de fecha (primeros 10 caracteres)
-                            date_str = date_repr[:10]
-                            # Validar el año desde el string
-                            year = int(date_str[:4])
-                            if 1900 <= year <= 2100:
-                                converted_row.append(date_str)
-                            else:
-                                # Año fuera de rango, usar None
-                                converted_row.append(None)
-                        else:
-                            # No tiene formato de fecha reconocible, usar None
-                            converted_row.append(None)
-                    except (OverflowError, OSError, ValueError, AttributeError, TypeError):
-                        # Si hay cualquier error, usar None
-                        converted_row.append(None)
-                else:
-                    converted_row.append(cell_val)
-            rows.append(converted_row)
+        session = workbook_session.session_for(path, session).load()
+        names = session.worksheet_names
+        target = _pick_sheet(names, {n: session.sheet_state(n) for n in names}, preferred_names)
+        rows = _convert_datetime_cells([list(r) for r in session.rows(target)])
     except Exception as e:
         # Imprimir error pero también propagarlo
         print(f"Error leyendo hoja genérica de {path}: {e}")
         raise # Es importante relanzar el error para que main.py lo capture
-    finally:
-        # ---> AÑADIDO <---
-        if wb: # Solo intentar cerrar si el workbook se llegó a abrir
-            try:
-                wb.close() # <- Cierra el archivo
-            except Exception as close_err:
-                 print(f"Advertencia: Error al intentar cerrar {path} en _read_sheet_to_df_any: {close_err}")
-        # ---> FIN AÑADIDO <---
 
-    # --- El archivo debería estar cerrado aquí ---
+    # --- La sesión cierra el archivo tras leer las hojas ---
     # Lógica original para crear DataFrame (sin tocar)
     if not rows: return pd.DataFrame()
     max_len = max(len(r) for r in rows) if rows else 0
@@ -200,38 +215,58 @@ def _read_sheet_to_df_any(path: str, preferred_names=None):
     return pd.DataFrame(norm_rows)
 
 
-# [MODIFICADO] Usar try...finally para asegurar wb.close()
-def _read_clientes_df_from_same_book(macro_path: str, sheet_name_candidates=None) -> pd.DataFrame:
+def _convert_datetime_cells(rows_raw):
+    """Fechas (datetime) de las filas como 'YYYY-MM-DD' (None si el año está fuera de 1900-2100)."""
+    # Convertir objetos datetime a strings de forma segura para evitar problemas de timestamp
+    from datetime import datetime as py_datetime
+    rows = []
+    for row in rows_raw:
+        converted_row = []
+        for cell_val in row:
+            # Si es un objeto datetime de Python, convertir a string de forma segura
+            if isinstance(cell_val, py_datetime):
+                try:
+                    # NUNCA llamar a strftime() directamente - puede causar overflow
+                    # Usar solo la representación string del objeto
+                    date_repr = str(cell_val)
+                    # Si tiene formato de fecha (YYYY-MM-DD HH:MM:SS o YYYY-MM-DD), extraerlo
+                    if len(date_repr) >= 10 and date_repr[4] == '-' and date_repr[7] == '-':
+                        # Extraer solo la parte de fecha (primeros 10 caracteres)
+                        date_str = date_repr[:10]
+                        # Validar el año desde el string
+                        year = int(date_str[:4])
+                        if 1900 <= year <= 2100:
+                            converted_row.append(date_str)
+                        else:
+                            # Año fuera de rango, usar None
+                            converted_row.append(None)
+                    else:
+                        # No tiene formato de fecha reconocible, usar None
+                        converted_row.append(None)
+                except (OverflowError, OSError, ValueError, AttributeError, TypeError):
+                    # Si hay cualquier error, usar None
+                    converted_row.append(None)
+            else:
+                converted_row.append(cell_val)
+        rows.append(converted_row)
+    return rows
+
+
+def _read_clientes_df_from_same_book(macro_path: str, sheet_name_candidates=None, session=None) -> pd.DataFrame:
     """Lee la hoja CLIENTES (o variantes) del MISMO archivo Excel que Macro (no crea columnas nuevas)."""
     if sheet_name_candidates is None:
-        sheet_name_candidates = ["CLIENTES", "Clientes", "clientes", "EMISORES", "EMISOR", "CONFIG", "Config"]
-    wb: Workbook = None # Definir wb fuera del try
+        sheet_name_candidates = CLIENTES_SHEETS
     try:
-        wb = load_workbook(macro_path, data_only=True, read_only=True)
-        names = [ws.title for ws in wb.worksheets]
-        low = {n.lower(): n for n in names}
-        target = None
-        for cand in sheet_name_candidates:
-            if cand.lower() in low:
-                target = low[cand.lower()]
-                break
+        session = workbook_session.session_for(macro_path, session)
+        target = session.find_sheet(sheet_name_candidates)
         if not target:
             raise ValueError("No se encontró la hoja 'CLIENTES' en el Excel.")
-        ws = wb[target]
-        rows = list(ws.iter_rows(values_only=True))
+        rows = session.rows(target)
     except Exception as e:
         print(f"Error leyendo hoja 'CLIENTES' de {macro_path}: {e}")
         raise # Propagar error
-    finally:
-        # ---> AÑADIDO <---
-        if wb: # Solo cerrar si se abrió
-            try:
-                wb.close() # <- Cierra archivo
-            except Exception as close_err:
-                print(f"Advertencia: Error cerrar {macro_path} en clientes: {close_err}")
-        # ---> FIN AÑADIDO <---
 
-    # --- El archivo debería estar cerrado aquí ---
+    # --- La sesión cierra el archivo tras leer las hojas ---
     # Lógica original para crear DataFrame (sin tocar)
     if not rows:
         return pd.DataFrame()
@@ -351,11 +386,148 @@ def _snap_vat(p):
     return round(p, 2) if not np.isnan(p) else 0.0
 
 # --- adapt_from_macro (lógica principal, SIN CAMBIOS respecto a tu versión original) ---
-def adapt_from_macro(macro_path: str):
-    df_all = _read_sheet_to_df_any(macro_path, preferred_names=PREFERRED_SHEETS)
+N_CONCEPTOS = 8  # parejas desc_i/imp_i de la Macro
+
+
+def _norm_desc(value) -> str:
+    if isinstance(value, float) and np.isnan(value): value = ""
+    return str(value or "").strip()
+
+
+def _coerce_series(series: pd.Series) -> np.ndarray:
+    """coerce_number de toda una columna (directo si ya es numérica)."""
+    if pd.api.types.is_numeric_dtype(series.dtype):
+        return series.astype(float).fillna(0.0).to_numpy()
+    return np.fromiter((coerce_number(v) for v in series), dtype=float, count=len(series))
+
+
+def _melt_conceptos(m_group: pd.DataFrame) -> pd.DataFrame:
+    """
+    Pasa las parejas desc_i/imp_i de cada fila a formato largo: una fila por
+    descripción no vacía, en el mismo orden que el recorrido fila a fila
+    (fila de la Macro y luego i). Columnas: NumFactura, descripcion,
+    base_unidad (importe ya convertido), __col_index (i), posicion (orden de
+    la descripción dentro de su fila) y con_importe (importe distinto de 0).
+    """
+    n = len(m_group)
+    desc = np.empty((n, N_CONCEPTOS), dtype=object)
+    imp = np.zeros((n, N_CONCEPTOS), dtype=float)
+    for i in range(1, N_CONCEPTOS + 1):
+        d_col, i_col = f"desc_{i}", f"imp_{i}"
+        desc[:, i - 1] = [_norm_desc(v) for v in m_group[d_col]] if d_col in m_group.columns else ""
+        if i_col in m_group.columns:
+            imp[:, i - 1] = _coerce_series(m_group[i_col])
+
+    has_desc = desc != ""
+    posicion = np.cumsum(has_desc, axis=1) - 1
+    col_index = np.broadcast_to(np.arange(1, N_CONCEPTOS + 1, dtype=np.int64), (n, N_CONCEPTOS))
+    nums = np.array([_norm_invoice_id(v) for v in m_group["num_factura"]], dtype=object)
+    fila = np.broadcast_to(np.arange(n)[:, None], (n, N_CONCEPTOS))
+
+    # Recorrido en orden C (fila, i): el mismo orden en que se construían los dicts
+    mask = has_desc.ravel()
+    importes = imp.ravel()[mask]
+    return pd.DataFrame({
+        "NumFactura": nums[fila.ravel()[mask]],
+        "descripcion": desc.ravel()[mask],
+        "base_unidad": importes,
+        "__col_index": col_index.ravel()[mask],
+        "posicion": posicion.ravel()[mask].astype(np.int64),
+        "con_importe": importes != 0.0,
+    })
+
+
+# Subir al cambiar la lógica de adaptación: invalida la caché de libros adaptados
+ADAPTER_VERSION = "9"
+
+
+def _cache_inputs() -> tuple:
+    """Entradas distintas del propio libro que influyen en el resultado (para la clave de la caché)."""
+    import sys
+    from datetime import date
+    if getattr(sys, "frozen", False):
+        app_dir = os.path.dirname(sys.executable)
+    else:
+        app_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        st = os.stat(os.path.join(app_dir, "config.ini"))
+        config_stamp = (st.st_size, st.st_mtime_ns)
+    except OSError:
+        config_stamp = None
+    env = tuple(os.environ.get(k, "").strip() for k in ("API_TOKEN", "API_EMAIL", "API_URL"))
+    return (env, config_stamp, date.today().year)
+
+
+def adapt_from_macro(macro_path: str, use_cache: bool = True, session=None, lazy_history: bool = False):
+    """
+    Adapta la Macro a los 6 DataFrames de envío e historial.
+
+    El resultado se guarda en workbook_cache (memoria y disco) por ruta,
+    tamaño, mtime y ADAPTER_VERSION; mientras el libro no cambie, las
+    siguientes llamadas devuelven copias en milisegundos. session (una
+    WorkbookSession del mismo libro) permite reutilizar las hojas ya leídas,
+    p. ej. entre la adaptación y la exportación MMB.
+
+    Con lazy_history=True no se leen las hojas de historial: en lugar de los
+    dos DataFrames de historial se devuelve un macro_history.HistorialMacro
+    que los carga (y consulta su índice) sólo si alguien los pide.
+    """
+    session = workbook_session.session_for(macro_path, session)
+    if use_cache:
+        envio = workbook_cache.get_or_build(
+            macro_path, ADAPTER_VERSION,
+            lambda: _adapt_from_macro_uncached(macro_path, session, con_historial=not lazy_history),
+            extra=_cache_inputs(),
+        )
+    else:
+        envio = _adapt_from_macro_uncached(macro_path, session, con_historial=not lazy_history)
+
+    if lazy_history:
+        historial = macro_history.HistorialMacro(
+            macro_path,
+            cargar=functools.partial(_cargar_historial, macro_path, use_cache),
+            cargar_indice=functools.partial(_cargar_indice_historial, macro_path, use_cache),
+        )
+        return (*envio, historial)
+    df_factura_historico, df_conceptos_historico, _ = _cargar_historial(macro_path, use_cache, session)
+    return (*envio, df_factura_historico, df_conceptos_historico)
+
+
+def _cargar_historial(macro_path: str, use_cache: bool = True, session=None):
+    """(df_factura_historico, df_conceptos_historico, índice), de la caché si el libro no cambió."""
+    if not use_cache:
+        return _leer_historial(macro_path, session)
+    extra = _cache_inputs()
+    historial = workbook_cache.get_or_build(
+        macro_path, ADAPTER_VERSION, lambda: _leer_historial(macro_path, session), extra=extra, namespace="historial"
+    )
+    # El índice va aparte: consultarlo no obliga a deshacer el pickle del historial completo
+    workbook_cache.store(macro_path, ADAPTER_VERSION, (historial[2],), extra=extra, namespace="indice_historial")
+    return historial
+
+
+def _cargar_indice_historial(macro_path: str, use_cache: bool = True):
+    """Índice del historial ya guardado para esta versión del libro, o None."""
+    if not use_cache:
+        return None
+    entrada = workbook_cache.peek(macro_path, ADAPTER_VERSION, extra=_cache_inputs(), namespace="indice_historial")
+    return entrada[0] if entrada else None
+
+
+def _adapt_from_macro_uncached(macro_path: str, session=None, con_historial: bool = True):
+    session = workbook_session.session_for(macro_path, session)
+    df_all = _read_sheet_to_df_any(macro_path, preferred_names=PREFERRED_SHEETS, session=session, columns=MACRO_COLUMNS)
+    # Una sola apertura (openpyxl) para CLIENTES y, si se van a procesar, las hojas
+    # de historial; la Macro ya está leída
+    if con_historial:
+        session.load(exclude=PREFERRED_SHEETS)
+    else:
+        session.load(CLIENTES_SHEETS)
     if df_all.empty or df_all.shape[0] < 2: # Mantener la comprobación original
         raise ValueError("La hoja 'Macro' está vacía o no tiene datos")
 
+    # Posición de cada columna de la hoja en df_all (el lector directo sólo trae MACRO_COLUMNS)
+    positions = {label: i for i, label in enumerate(df_all.columns)}
     # Lógica original para obtener 'df' desde 'df_all'
     df = df_all.iloc[1:].copy().reset_index(drop=True)
     # Asignar nombres de columna desde la primera fila de df_all (lógica original implícita)
@@ -365,7 +537,7 @@ def adapt_from_macro(macro_path: str):
     for key, letter in EXCEL_COLS.items():
         idx = excel_col_to_idx(letter)
         # Lógica original para seleccionar columnas
-        cols[key] = df.iloc[:, idx] if idx < df.shape[1] else pd.Series([np.nan]*len(df))
+        cols[key] = df.iloc[:, positions[idx]] if idx in positions else pd.Series([np.nan]*len(df))
     m = pd.DataFrame(cols)
 
     m["num_factura"] = m["num_factura"].map(_norm_invoice_id)
@@ -516,7 +688,7 @@ def adapt_from_macro(macro_path: str):
 
     # Emisor desde hoja CLIENTES del mismo Excel
     try:
-        df_emisores = _read_clientes_df_from_same_book(macro_path)
+        df_emisores = _read_clientes_df_from_same_book(macro_path, session=session)
         if df_emisores.empty:
             raise ValueError("La hoja CLIENTES está vacía o mal formada")
     except ValueError as e:
@@ -525,13 +697,6 @@ def adapt_from_macro(macro_path: str):
     # --- INICIO REFACTORIZACIÓN PARA MÚLTIPLES EMISORES ---
 
     # 1. Normalizar CIFs en el dataframe principal 'm' para poder agrupar
-    def _norm_cif_cell(x):
-        if pd.isna(x): return ""
-        s = str(x).strip()
-        if s == "" or s.lower() in ("none", "nan", "null", "#n/a", "#n/d", "-", "—"):
-            return ""
-        return normalize_cif_emisor(s)
-
     if 'cif_emisor' not in m.columns:
          raise ValueError("La columna 'cif_emisor' (E) no se encontró en la hoja Macro procesada.")
     m['cif_emisor_norm'] = m['cif_emisor'].apply(_norm_cif_cell)
@@ -620,38 +785,24 @@ def adapt_from_macro(macro_path: str):
             print(f"Advertencia: Falta IBAN para CIF {cif_norm} en filas Excel: {idxs}. Omitiendo estas facturas.")
             continue
 
-        conceptos_rows, textos_rows = [], []
-        for _, row in m_group.iterrows():
-            num = _norm_invoice_id(row["num_factura"])
-            pos = 0
-            for i in range(1, 9):
-                desc = row.get(f"desc_{i}", "")
-                imp  = row.get(f"imp_{i}", np.nan)
-                if isinstance(desc, float) and np.isnan(desc): desc = ""
-                desc = str(desc or "").strip()
-                imp_float = coerce_number(imp)
-                is_valid_imp = not pd.isna(imp_float) and imp_float != 0.0
-                if desc and is_valid_imp:
-                    conceptos_rows.append({
-                        "NumFactura": num, "empresa_emisora": empresa_nombre,
-                        "descripcion": desc, "cuenta_contable": "7050000",
-                        "unidad_medida": unidad_def, "unidades": 1.0,
-                        "base_unidad": float(imp_float),
-                        "tipo_impuesto": "IVA", "porcentaje": 0.0,
-                        "__col_index": i,  # Guardar índice original de columna
-                    })
-                    pos += 1
-                elif desc:
-                    textos_rows.append({
-                        "NumFactura": num, "empresa_emisora": empresa_nombre,
-                        "descripcion": desc, "posicion": pos,
-                        "__col_index": i,  # Guardar índice original de columna
-                    })
-                    pos += 1
+        # Conceptos (descripción con importe) y textos (sin importe) de las 8 parejas desc_i/imp_i
+        largo = _melt_conceptos(m_group)
+        conc, txt = largo[largo["con_importe"]], largo[~largo["con_importe"]]
+        df_conceptos_group = pd.DataFrame({
+            "NumFactura": conc["NumFactura"].to_numpy(), "empresa_emisora": empresa_nombre,
+            "descripcion": conc["descripcion"].to_numpy(), "cuenta_contable": "7050000",
+            "unidad_medida": unidad_def, "unidades": 1.0,
+            "base_unidad": conc["base_unidad"].to_numpy(),
+            "tipo_impuesto": "IVA", "porcentaje": 0.0,
+            "__col_index": conc["__col_index"].to_numpy(),  # Guardar índice original de columna
+        }) if len(conc) else pd.DataFrame()
+        df_txt_group = pd.DataFrame({
+            "NumFactura": txt["NumFactura"].to_numpy(), "empresa_emisora": empresa_nombre,
+            "descripcion": txt["descripcion"].to_numpy(), "posicion": txt["posicion"].to_numpy(),
+            "__col_index": txt["__col_index"].to_numpy(),  # Guardar índice original de columna
+        }) if len(txt) else pd.DataFrame()
 
         # Identificar la primera columna con descripción (con o sin importe) para cada factura
-        df_conceptos_group = pd.DataFrame(conceptos_rows) if conceptos_rows else pd.DataFrame()
-        df_txt_group = pd.DataFrame(textos_rows) if textos_rows else pd.DataFrame()
         
         # Combinar todos los índices de columna para encontrar el mínimo por factura
         all_col_indices = []
@@ -855,19 +1006,35 @@ def adapt_from_macro(macro_path: str):
     df_forma_pago = _ensure_columns(df_forma_pago, expected_fp_cols)
     df_txt = _ensure_columns(df_txt, expected_txt_cols)
 
+    return df_factura, df_conceptos, df_forma_pago, df_txt
+
+
+def _leer_historial(macro_path: str, session=None):
+    """
+    Lee y procesa las hojas de historial del libro (todas salvo Macro y
+    CLIENTES cuya cabecera A1 contiene "factura" o "abono").
+
+    Devuelve (df_factura_historico, df_conceptos_historico, índice); el
+    índice (macro_history.INDEX_COLUMNS) dice en qué hoja y filas está cada
+    factura y permite contestar "no está en el historial" sin procesarlo.
+    """
     # --- [NUEVO] LEER Y PROCESAR HOJAS DE HISTORIAL ---
     # El objetivo es crear df_factura_historico y df_conceptos_historico para que
     # prueba.py pueda buscar facturas originales aunque hayan sido borradas de la hoja "Macro".
 
     df_factura_historico = pd.DataFrame()
     df_conceptos_historico = pd.DataFrame()
+    df_indice_historial = macro_history.empty_index()
 
+    session = workbook_session.session_for(macro_path, session)
     try:
-        wb = load_workbook(macro_path, data_only=True, read_only=True)
-        all_sheet_names = wb.sheetnames
+        # Una sola apertura (openpyxl) para CLIENTES y las hojas de historial
+        session.load(exclude=PREFERRED_SHEETS)
+        df_emisores = _read_clientes_df_from_same_book(macro_path, session=session)
+        all_sheet_names = session.sheetnames
 
         # Excluir las hojas ya procesadas o de configuración
-        sheets_to_exclude = PREFERRED_SHEETS + ["CLIENTES", "Clientes", "clientes", "EMISORES", "EMISOR", "CONFIG", "Config"]
+        sheets_to_exclude = PREFERRED_SHEETS + CLIENTES_SHEETS
         sheets_to_exclude_lower = [s.lower() for s in sheets_to_exclude]
 
         historical_sheet_names = [
@@ -878,8 +1045,7 @@ def adapt_from_macro(macro_path: str):
         if historical_sheet_names:
             historical_dfs_raw = []
             for sheet_name in historical_sheet_names:
-                ws = wb[sheet_name]
-                rows = list(ws.iter_rows(values_only=True))
+                rows = session.rows(sheet_name)
                 if not rows or len(rows) < 2:
                     continue
                 header_first = rows[0][0] if rows[0] else ""
@@ -891,13 +1057,14 @@ def adapt_from_macro(macro_path: str):
                 headers = _unique_headers(rows[0])
                 data = rows[1:]
                 df_sheet = pd.DataFrame(data, columns=headers)
-                historical_dfs_raw.append(df_sheet)
+                historical_dfs_raw.append((sheet_name, df_sheet))
 
             if historical_dfs_raw:
                 # Filtrar columnas completamente vacías o todas-NA antes de concatenar
                 # Esto evita el FutureWarning de pandas sobre concatenación con columnas vacías
                 historical_dfs_cleaned = []
-                for df in historical_dfs_raw:
+                origen_hist = []  # (hoja, filas) de cada DataFrame limpio, en el orden del concat
+                for sheet_name, df in historical_dfs_raw:
                     if df.empty:
                         continue
                     # Eliminar columnas que estén completamente vacías o todas-NA
@@ -913,6 +1080,7 @@ def adapt_from_macro(macro_path: str):
                         df_cleaned = df_cleaned[non_empty_cols]
                     if not df_cleaned.empty:
                         historical_dfs_cleaned.append(df_cleaned)
+                        origen_hist.append((sheet_name, len(df_cleaned)))
                 
                 if historical_dfs_cleaned:
                     df_hist_all = pd.concat(historical_dfs_cleaned, ignore_index=True)
@@ -941,6 +1109,10 @@ def adapt_from_macro(macro_path: str):
                         cols_hist[key] = pd.Series([np.nan] * len(df_hist))
 
                 m_hist = pd.DataFrame(cols_hist)
+                # Hoja y fila de Excel de cada fila (datos desde la fila 2), para el índice del historial
+                hoja_origen = np.repeat(np.array([h for h, _ in origen_hist], dtype=object), [n for _, n in origen_hist])
+                fila_origen = np.concatenate([np.arange(2, n + 2) for _, n in origen_hist] or [np.arange(0)])
+                m_hist["__fila_hist"] = np.arange(len(m_hist))
                 if "fecha_emision" in m_hist.columns:
                     # Convertir fechas con validación para evitar errores de timestamp fuera de rango
                     try:
@@ -986,6 +1158,7 @@ def adapt_from_macro(macro_path: str):
 
                     hist_all_facturas = []
                     hist_all_conceptos = []
+                    indice_partes = []
 
                     for cif_norm, m_hist_group in m_hist.groupby('cif_emisor_norm'):
                         if not cif_norm: continue
@@ -996,10 +1169,15 @@ def adapt_from_macro(macro_path: str):
                         emisor_row = emisor_row_series.to_dict()
                         empresa_nombre = str(emisor_row.get("empresa_nombre","") or cif_norm).strip()
                         unidad_def = str(emisor_row.get("unidad_medida_defecto","") or "ud")
+                        posiciones = m_hist_group["__fila_hist"].to_numpy()
+                        indice_partes.append(pd.DataFrame({
+                            "NumFactura": m_hist_group["num_factura"].map(_norm_invoice_id).to_numpy(),
+                            "empresa_emisora": empresa_nombre,
+                            "hoja": hoja_origen[posiciones],
+                            "fila": fila_origen[posiciones],
+                        }))
 
                         # Procesar conceptos del historial
-                        conceptos_rows_hist = []
-                        textos_rows_hist = []
                         iva_map_hist = {}
                         if not m_hist_group.empty:
                             for num_hist, grp_hist in m_hist_group.groupby("num_factura"):
@@ -1011,32 +1189,21 @@ def adapt_from_macro(macro_path: str):
                                 vat_hist = round((iva_hist / base_hist) * 100.0, 2) if base_hist else 0.0
                                 iva_map_hist[_norm_invoice_id(num_hist)] = vat_hist
 
-                        for _, row in m_hist_group.iterrows():
-                            num = _norm_invoice_id(row["num_factura"])
-                            for i in range(1, 9):
-                                desc = row.get(f"desc_{i}", "")
-                                imp  = row.get(f"imp_{i}", np.nan)
-                                if isinstance(desc, float) and np.isnan(desc): desc = ""
-                                desc = str(desc or "").strip()
-                                imp_float = coerce_number(imp)
-                                is_valid_imp = not pd.isna(imp_float) and imp_float != 0.0
-                                if desc and is_valid_imp:
-                                    conceptos_rows_hist.append({
-                                        "NumFactura": num, "empresa_emisora": empresa_nombre,
-                                        "base_unidad": float(imp_float),
-                                        "descripcion": str(desc), "unidad_medida": unidad_def,
-                                        "__col_index": i,  # Guardar índice original de columna
-                                    })
-                                elif desc:
-                                    textos_rows_hist.append({
-                                        "NumFactura": num, "empresa_emisora": empresa_nombre,
-                                        "descripcion": str(desc),
-                                        "__col_index": i,  # Guardar índice original de columna
-                                    })
+                        largo_hist = _melt_conceptos(m_hist_group)
+                        conc_h, txt_h = largo_hist[largo_hist["con_importe"]], largo_hist[~largo_hist["con_importe"]]
+                        df_conc_hist = pd.DataFrame({
+                            "NumFactura": conc_h["NumFactura"].to_numpy(), "empresa_emisora": empresa_nombre,
+                            "base_unidad": conc_h["base_unidad"].to_numpy(),
+                            "descripcion": conc_h["descripcion"].to_numpy(), "unidad_medida": unidad_def,
+                            "__col_index": conc_h["__col_index"].to_numpy(),  # Guardar índice original de columna
+                        }) if len(conc_h) else pd.DataFrame()
+                        df_txt_hist = pd.DataFrame({
+                            "NumFactura": txt_h["NumFactura"].to_numpy(), "empresa_emisora": empresa_nombre,
+                            "descripcion": txt_h["descripcion"].to_numpy(),
+                            "__col_index": txt_h["__col_index"].to_numpy(),  # Guardar índice original de columna
+                        }) if len(txt_h) else pd.DataFrame()
 
                         # Identificar la primera columna con descripción (con o sin importe) para cada factura histórica
-                        df_conc_hist = pd.DataFrame(conceptos_rows_hist) if conceptos_rows_hist else pd.DataFrame()
-                        df_txt_hist = pd.DataFrame(textos_rows_hist) if textos_rows_hist else pd.DataFrame()
                         
                         # Combinar todos los índices de columna para encontrar el mínimo por factura
                         all_col_indices_hist = []
@@ -1107,13 +1274,16 @@ def adapt_from_macro(macro_path: str):
                         df_factura_historico = pd.concat(hist_all_facturas, ignore_index=True)
                     if hist_all_conceptos:
                         df_conceptos_historico = pd.concat(hist_all_conceptos, ignore_index=True)
+                    if indice_partes:
+                        df_indice_historial = (
+                            pd.concat(indice_partes, ignore_index=True)
+                            .groupby(["NumFactura", "empresa_emisora", "hoja"], sort=False)["fila"]
+                            .agg(fila_desde="min", fila_hasta="max")
+                            .reset_index()[macro_history.INDEX_COLUMNS]
+                        )
 
     except Exception as e:
         # Si falla la lectura del historial, no detenemos el proceso, solo lo advertimos.
         print(f"Advertencia: No se pudo procesar el historial de facturas. Causa: {e}")
-    finally:
-        if 'wb' in locals() and wb:
-            wb.close()
 
-    # Devolver los 4 dataframes originales + los 2 del historial
-    return df_factura, df_conceptos, df_forma_pago, df_txt, df_factura_historico, df_conceptos_historico
\ No newline at end of file
+    return df_factura_historico, df_conceptos_historico, df_indice_historial
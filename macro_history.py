@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+Módulo con el historial de facturas de una Macro, cargado bajo demanda.
+
+adapt_from_macro leía y procesaba en cada llamada todas las hojas de
+historial (las que empiezan por "Factura"/"Abono") aunque sólo se usan para
+buscar la factura original de una rectificativa, algo que la mayoría de los
+envíos no necesita. HistorialMacro sustituye a los dos DataFrames de
+historial por un objeto que no lee nada hasta que alguien pregunta:
+
+    indice()   DataFrame pequeño (NumFactura, empresa_emisora, hoja,
+               fila_desde, fila_hasta) con dónde está cada factura del
+               historial. Se guarda en la caché de libros y se reutiliza
+               mientras el libro no cambie, así que responder "no está" no
+               obliga a procesar el historial.
+    frames()   (df_factura_historico, df_conceptos_historico), exactamente
+               los que devolvía adapt_from_macro; se cargan la primera vez.
+
+El objeto se puede pasar a otros procesos (pickle): viaja sin el candado y,
+si ya se cargó, con los DataFrames.
+"""
+import threading
+from typing import Callable, Optional, Tuple
+
+import pandas as pd
+
+INDEX_COLUMNS = ["NumFactura", "empresa_emisora", "hoja", "fila_desde", "fila_hasta"]
+
+Frames = Tuple[pd.DataFrame, pd.DataFrame]
+
+
+def empty_index() -> pd.DataFrame:
+    return pd.DataFrame({c: pd.Series(dtype="object" if i < 3 else "int64") for i, c in enumerate(INDEX_COLUMNS)})
+
+
+class HistorialMacro:
+    """Historial (facturas y conceptos) de una Macro que se lee al consultarlo por primera vez."""
+
+    def __init__(self, path: str, cargar: Callable[[], tuple],
+                 cargar_indice: Optional[Callable[[], Optional[pd.DataFrame]]] = None):
+        """
+        cargar() devuelve (df_factura_historico, df_conceptos_historico, indice);
+        cargar_indice() devuelve el índice ya guardado o None si no lo hay.
+        """
+        self.path = path
+        self._cargar = cargar
+        self._cargar_indice = cargar_indice
+        self._lock = threading.RLock()
+        self._frames: Optional[Frames] = None
+        self._indice: Optional[pd.DataFrame] = None
+
+    @classmethod
+    def from_frames(cls, df_factura: pd.DataFrame, df_conceptos: pd.DataFrame, path: str = "") -> "HistorialMacro":
+        """Historial ya cargado (p. ej. leído de otro Excel)."""
+        historial = cls(path, cargar=_sin_origen)
+        historial._frames = (df_factura, df_conceptos)
+        historial._indice = _index_from_frames(df_factura)
+        return historial
+
+    @property
+    def loaded(self) -> bool:
+        return self._frames is not None
+
+    def _load(self) -> Frames:
+        with self._lock:
+            if self._frames is None:
+                df_factura, df_conceptos, indice = self._cargar()
+                self._frames = (df_factura, df_conceptos)
+                if indice is None:
+                    indice = _index_from_frames(df_factura)
+                self._indice = indice
+            return self._frames
+
+    def frames(self) -> Frames:
+        """(df_factura_historico, df_conceptos_historico); los lee si aún no se cargaron."""
+        return self._load()
+
+    @property
+    def df_factura(self) -> pd.DataFrame:
+        return self._load()[0]
+
+    @property
+    def df_conceptos(self) -> pd.DataFrame:
+        return self._load()[1]
+
+    def indice(self) -> pd.DataFrame:
+        """Dónde está cada factura del historial; sólo procesa el historial si no hay índice guardado."""
+        with self._lock:
+            if self._indice is None and self._cargar_indice is not None:
+                self._indice = self._cargar_indice()
+            if self._indice is None:
+                self._load()
+            return self._indice
+
+    def __len__(self) -> int:
+        return len(self.indice())
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+
+
+def _sin_origen() -> tuple:
+    # Sólo la usan los historiales creados con from_frames, que nacen cargados
+    raise RuntimeError("Historial sin libro de origen")
+
+
+def _index_from_frames(df_factura: pd.DataFrame) -> pd.DataFrame:
+    """Índice sin hoja ni filas, para historiales que no vienen de adapt_from_macro."""
+    if df_factura is None or df_factura.empty or not {"NumFactura", "empresa_emisora"} <= set(df_factura.columns):
+        return empty_index()
+    claves = df_factura[["NumFactura", "empresa_emisora"]].drop_duplicates().reset_index(drop=True)
+    return claves.assign(hoja="", fila_desde=0, fila_hasta=0)[INDEX_COLUMNS]
+
+
+__all__ = ["HistorialMacro", "INDEX_COLUMNS", "empty_index"]
@@ -6,6 +6,7 @@ import os
 import json
 import webbrowser
 import hashlib
+import io
 import re
 import glob
 import pandas as pd
@@ -35,6 +36,8 @@ QEasingCurve, QPoint, QPointF, QPropertyAnimation, QRect, QSettings, QSize, QThr
 
 from worker import Worker, detect_available_browser
 import macro_adapter
+import artifact_store
+import runtime_config
 
 from app.core.resources import (
     resource_path,
@@ -507,6 +510,8 @@ class ConfigDialog(QDialog):
         
         # Sincronizar para asegurar que se guarde inmediatamente
         self.settings.sync()
+        # Los próximos envíos usan ya los valores nuevos
+        runtime_config.reload()
         
         # Verificar que se guardó correctamente
         try:
@@ -745,6 +750,8 @@ class MainWindow(QMainWindow):
         # --- [NUEVO] Atributos para almacenar los dataframes históricos ---
         self.df_factura_historico = None
         self.df_conceptos_historico = None
+        # Historial del Excel cargado (macro_history.HistorialMacro): se lee al buscar una original
+        self.historial_macro = None
         # --- [FIN NUEVO] ---
         self.validation_errors = []
         self.nif_validation_errors = {}  # {row_index: {"nif": str, "error": str, "tipo": str}}
@@ -2099,16 +2106,24 @@ class MainWindow(QMainWindow):
             self.show_error(f"No se pudo crear la copia de seguridad: {exc}")
 
     def open_last_api_response(self):
-        responses_dir = Path(resource_path("responses"))
-        if not responses_dir.exists():
-            self.show_toast("⚠️ No se encontraron respuestas de la API.")
-            return
-        json_files = sorted(responses_dir.glob("api_*.json"), key=lambda p: p.stat().st_mtime, reverse=True)
-        if not json_files:
-            self.show_toast("⚠️ No se encontraron respuestas de la API.")
-            return
-        latest = json_files[0]
-        dlg = JsonViewerDialog(latest, self)
+        dlg = None
+        try:
+            ultima = artifact_store.get_store().latest(artifact_store.KIND_API)
+        except Exception:
+            logger.exception("No se pudo leer el almacén de artefactos")
+            ultima = None
+        if ultima is not None:
+            dlg = JsonViewerDialog(Path(ultima.name), self, content=ultima.data.decode("utf-8", errors="replace"))
+        else:
+            # Respuestas guardadas como ficheros sueltos (antes del almacén o con FACTUNABO_ARTIFACTS=files)
+            responses_dir = Path(resource_path("responses"))
+            json_files = []
+            if responses_dir.exists():
+                json_files = sorted(responses_dir.glob("api_*.json"), key=lambda p: p.stat().st_mtime, reverse=True)
+            if not json_files:
+                self.show_toast("⚠️ No se encontraron respuestas de la API.")
+                return
+            dlg = JsonViewerDialog(json_files[0], self)
         style_sheet_content = self._get_themed_stylesheet()
         if style_sheet_content:
             dlg.setStyleSheet(style_sheet_content)
@@ -2553,7 +2568,19 @@ class MainWindow(QMainWindow):
         painter.end()
         return QIcon(pix)
 
+    def _load_historical_if_indexed(self, invoice_id: str, empresa: str):
+        """Lee el historial del Excel cargado sólo si su índice dice que la factura está en él."""
+        if self.df_factura_historico is not None or self.historial_macro is None:
+            return
+        indice = self.historial_macro.indice()
+        cond_id = indice["NumFactura"].map(_normalize_invoice_id) == str(invoice_id)
+        cond_emp = indice["empresa_emisora"].astype(str).str.strip() == str(empresa or "").strip()
+        if (cond_id & cond_emp).any():
+            self.df_factura_historico, self.df_conceptos_historico = self.historial_macro.frames()
+
     def _extract_invoice_data(self, invoice_id: str, empresa: str, *, historical: bool = False):
+        if historical:
+            self._load_historical_if_indexed(invoice_id, empresa)
         df_fact = self.df_factura_historico if historical else self.df_factura_actual
         df_conc = self.df_conceptos_historico if historical else self.df_conceptos_actual
         row = None
@@ -2734,6 +2761,13 @@ class MainWindow(QMainWindow):
         return str(empresa).replace(" ", "_").replace(".", "")
 
     def _load_invoice_from_xml_logs(self, invoice_id: str, empresa: str):
+        # Primero el almacén de artefactos (consulta indexada por factura y emisor)
+        xml_bytes = artifact_store.find_xml(invoice_id, empresa)
+        if xml_bytes:
+            parsed = self._parse_xml_invoice_file(io.BytesIO(xml_bytes), invoice_id, empresa)
+            if parsed[0] is not None or (parsed[1] is not None and not parsed[1].empty):
+                return parsed
+
         logs_dir = Path("logs")
         if not logs_dir.exists():
             return None, pd.DataFrame(), {}
@@ -3448,11 +3482,12 @@ class MainWindow(QMainWindow):
         # --- [INICIO DE LA CORRECCIÓN] ---
         # Llamar a adapt_from_macro con UN solo argumento, como en tus archivos.
         try:
-            # --- [MODIFICADO] Capturar y almacenar los 6 dataframes ---
+            # --- [MODIFICADO] Capturar los 4 dataframes y el historial (se lee bajo demanda) ---
             (
-                df_factura, df_conceptos, df_forma_pago, df_txt,
-                self.df_factura_historico, self.df_conceptos_historico
-            ) = macro_adapter.adapt_from_macro(path)
+                df_factura, df_conceptos, df_forma_pago, df_txt, self.historial_macro
+            ) = macro_adapter.adapt_from_macro(path, lazy_history=True)
+            self.df_factura_historico = None
+            self.df_conceptos_historico = None
         # --- [FIN MODIFICADO] ---
         except Exception as e:
             self.append_log(f"❌ Error leyendo Excel (Macro): {e}")
@@ -3796,11 +3831,11 @@ class MainWindow(QMainWindow):
         # --- [INICIO DE LA CORRECCIÓN] ---
         # Llamar a adapt_from_macro con UN solo argumento
         try:
-            # --- [MODIFICADO] Capturar los 6 dataframes, aunque no se usen todos aquí ---
+            # --- [MODIFICADO] La validación no usa el historial: no se llega a leer ---
             (
                 df_factura, df_conceptos, df_forma_pago, df_txt,
-                _, _ # Ignoramos los históricos en la validación simple
-            ) = macro_adapter.adapt_from_macro(path)
+                _ # Ignoramos el historial en la validación simple
+            ) = macro_adapter.adapt_from_macro(path, lazy_history=True)
         # --- [FIN MODIFICADO] ---
         except Exception as e:
             self.validation_errors.append(f"Error leyendo archivo (Macro): {str(e)}")
@@ -5216,6 +5251,7 @@ class MainWindow(QMainWindow):
         """Habilita/deshabilita el modo offline."""
         self.settings.setValue("offline_mode", "1" if checked else "0")
         os.environ["USE_OFFLINE_QUEUE"] = "1" if checked else "0"
+        runtime_config.reload()
         status = "habilitado" if checked else "deshabilitado"
         self.show_toast(f"✅ Modo offline {status}")
     
@@ -5224,47 +5260,26 @@ class MainWindow(QMainWindow):
         try:
             import offline_queue
             import prueba
-            import requests
+            import connectivity
             
-            # Verificar conexión
-            try:
-                requests.get("https://www.facturantia.com", timeout=5)
-            except:
+            # Verificar conexión (estado aprendido de los envíos; sondea sólo si es desconocido)
+            monitor = connectivity.get_monitor()
+            if (monitor.check(timeout=5) == connectivity.OFFLINE
+                    and monitor.probe(timeout=5) == connectivity.OFFLINE):
                 self.show_error("❌ No hay conexión a internet. No se puede procesar la cola.")
                 return
             
-            items = offline_queue.get_pending_items(limit=50)
-            if not items:
+            pendientes = offline_queue.get_queue_stats().get("PENDIENTE", 0)
+            if not pendientes:
                 self.show_toast("ℹ️ No hay facturas pendientes en la cola")
                 return
             
-            self.show_toast(f"📤 Procesando {len(items)} facturas de la cola...")
+            self.show_toast(f"📤 Procesando {min(pendientes, 50)} facturas de la cola...")
             
-            # Procesar cada item
-            success_count = 0
-            fail_count = 0
-            
-            for item in items:
-                try:
-                    result = prueba.send_proforma(
-                        item["xml_content"],
-                        item["api_key"],
-                        item["num_factura"],
-                        item["empresa"],
-                        item["ejercicio"],
-                        item["cliente_doc"],
-                        use_offline_queue=False  # No volver a añadir a la cola
-                    )
-                    
-                    if result.get("status") in ["ÉXITO", "DUPLICADO"]:
-                        offline_queue.mark_as_sent(item["id"])
-                        success_count += 1
-                    else:
-                        offline_queue.mark_as_failed(item["id"], result.get("details", "Error desconocido"))
-                        fail_count += 1
-                except Exception as e:
-                    offline_queue.mark_as_failed(item["id"], str(e))
-                    fail_count += 1
+            # Misma configuración de envío para toda la cola
+            resultado = prueba.process_offline_queue(limit=50, config=runtime_config.get())
+            success_count = resultado["enviadas"]
+            fail_count = resultado["fallidas"]
             
             self.show_toast(f"✅ Cola procesada: {success_count} exitosos, {fail_count} fallidos")
             self.stats_service.invalidate()
@@ -5679,6 +5694,13 @@ def main():
     # Usar QTimer.singleShot para asegurar que _refresh_styles se ejecute después de que la ventana sea visible
     QTimer.singleShot(100, window._refresh_styles) # Aumentado ligero delay
 
+    # Precargar el esquema XSD en segundo plano para que el primer lote no espere
+    try:
+        import xsd_validator
+        xsd_validator.warm_async()
+    except Exception as e:
+        logger.warning(f"No se pudo iniciar la precarga del XSD: {e}")
+
     # El login se ejecuta después de mostrar la ventana principal
     if window.require_login():
         sys.exit(app.exec())
@@ -5687,4 +5709,7 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    # Necesario para el pool de procesos de prueba.py en el ejecutable de PyInstaller
+    import multiprocessing
+    multiprocessing.freeze_support()
+    main()
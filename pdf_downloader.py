@@ -14,6 +14,8 @@ from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 
+import batch_profiler
+
 DEFAULT_SELECTORS: Sequence[Tuple[str, str]] = (
     (By.ID, "div_factura_cliente_descargar_pdf"),
     (By.CSS_SELECTOR, "#div_factura_cliente_descargar_pdf, a[href*='descargar_pdf'], button[id*='descargar'][id*='pdf']"),
@@ -176,15 +178,16 @@ def download_many(
             last_err = None
             for _ in range(attempts):
                 try:
-                    path = download_one(
-                        driver=driver,
-                        url=url,
-                        download_dir=dest_dir,
-                        name_base=base,
-                        selectors=selectors,
-                        timeout_click=timeout_click,
-                        wait_download_s=wait_download_s,
-                    )
+                    with batch_profiler.span("pdf", base):
+                        path = download_one(
+                            driver=driver,
+                            url=url,
+                            download_dir=dest_dir,
+                            name_base=base,
+                            selectors=selectors,
+                            timeout_click=timeout_click,
+                            wait_download_s=wait_download_s,
+                        )
                     results.append(DownloadResult(url=url, status="ok", path=path))
                     break
                 except (WebDriverException, RuntimeError) as e:
@@ -1,6 +1,5 @@
 # -*- coding: utf-8 -*-
 import pandas as pd, xml.etree.ElementTree as ET
-from xml.dom import minidom
 import requests, os, json, logging, numpy as np, urllib.parse, re
 import unicodedata
 from datetime import datetime
@@ -8,7 +7,19 @@ from openpyxl import load_workbook
 from openpyxl.utils import get_column_letter
 import macro_adapter
 import re
-import xmlschema
+import threading
+import multiprocessing
+import send_engine
+import http_client
+import connectivity
+import invoice_index
+import invoice_totals
+import xsd_validator
+import xml_writer
+import batch_profiler
+import runtime_config
+import send_journal
+import artifact_store
 
 def quitar_tildes_empresa(nombre):
     """Quita acentos SOLO para nombres de empresa emisora"""
@@ -47,13 +58,15 @@ LOG_DIR = "logs"
 RESPONSE_DIR = "responses"
 os.makedirs(LOG_DIR, exist_ok=True)
 os.makedirs(RESPONSE_DIR, exist_ok=True)
-log_filename = os.path.join(LOG_DIR, f"proforma_import_{datetime.now().strftime('%Y%m%d_%H%M%S')}.log")
-for h in logging.root.handlers[:]:
-    logging.root.removeHandler(h)
-logging.basicConfig(level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s",
-    handlers=[logging.FileHandler(log_filename, encoding="utf-8"), logging.StreamHandler()],
-)
+# Los procesos del pipeline de generación importan este módulo: sólo el principal abre log propio
+if multiprocessing.current_process().name == "MainProcess":
+    log_filename = os.path.join(LOG_DIR, f"proforma_import_{datetime.now().strftime('%Y%m%d_%H%M%S')}.log")
+    for h in logging.root.handlers[:]:
+        logging.root.removeHandler(h)
+    logging.basicConfig(level=logging.INFO,
+        format="%(asctime)s - %(levelname)s - %(message)s",
+        handlers=[logging.FileHandler(log_filename, encoding="utf-8"), logging.StreamHandler()],
+    )
 
 GUI_LOGGER_CALLBACK = None
 def set_gui_logger(cb):
@@ -467,17 +480,21 @@ def create_sub_element(parent, tag, text, default=None):
     return el
 
 def prettify(elem):
-    return minidom.parseString(ET.tostring(elem, "utf-8")).toprettyxml(indent="    ", encoding="utf-8")
+    """XML con sangría, en una sola pasada (misma salida que minidom.toprettyxml)."""
+    return xml_writer.to_bytes(elem, xml_writer.PRETTY)
 
 # --- Validación XSD (cache de esquema y resultados) ---
 _XSD_SCHEMA = None
 _VALIDATION_CACHE = {}  # Cache de validaciones: hash(xml_bytes) -> (is_valid, error_msg)
+_XSD_SCHEMA_LOCK = threading.Lock()  # los envíos concurrentes comparten el esquema
 
 def _get_schema():
     global _XSD_SCHEMA
     if _XSD_SCHEMA is None:
-        xsd_path = os.path.join(os.path.dirname(__file__), "EsquemaProformas.xsd")
-        _XSD_SCHEMA = xmlschema.XMLSchema(xsd_path)
+        with _XSD_SCHEMA_LOCK:
+            if _XSD_SCHEMA is None:
+                # Esquema precompilado junto al XSD (se recompila si cambia el XSD)
+                _XSD_SCHEMA = xsd_validator.get_xmlschema()
     return _XSD_SCHEMA
 
 def _get_xml_hash(xml_bytes: bytes) -> str:
@@ -486,7 +503,12 @@ def _get_xml_hash(xml_bytes: bytes) -> str:
     return hashlib.md5(xml_bytes).hexdigest()
 
 def validate_xml_against_xsd(xml_bytes: bytes, use_cache: bool = True) -> None:
-    """Lanza excepción si el XML no cumple el XSD. Usa caché si está habilitado."""
+    """
+    Lanza excepción si el XML no cumple el XSD. Usa caché si está habilitado.
+
+    Orden: caché en memoria -> veredicto en disco (hash XML + checksum XSD) ->
+    lxml (rápido) -> xmlschema (mensajes de error detallados).
+    """
     if use_cache:
         xml_hash = _get_xml_hash(xml_bytes)
         if xml_hash in _VALIDATION_CACHE:
@@ -494,7 +516,45 @@ def validate_xml_against_xsd(xml_bytes: bytes, use_cache: bool = True) -> None:
             if not is_valid:
                 raise ValueError(error_msg)
             return  # Validación exitosa desde caché
-    
+
+        try:
+            xml_digest = xsd_validator.xml_hash(xml_bytes)
+            checksum = xsd_validator.xsd_checksum()
+        except OSError:
+            xml_digest = checksum = None
+        if checksum:
+            verdict = xsd_validator.get_verdict(xml_digest, checksum)
+            if verdict is not None:
+                _VALIDATION_CACHE[xml_hash] = verdict
+                if not verdict[0]:
+                    raise ValueError(verdict[1])
+                return  # Ya validado en una ejecución anterior
+
+        try:
+            _validate_xml_uncached(xml_bytes)
+        except ValueError as e:
+            # Los errores de validación se recuerdan; otros fallos (timestamp...) no
+            _VALIDATION_CACHE[xml_hash] = (False, str(e))
+            if checksum:
+                xsd_validator.store_verdict(xml_digest, checksum, False, str(e))
+            raise
+        _VALIDATION_CACHE[xml_hash] = (True, None)
+        if checksum:
+            xsd_validator.store_verdict(xml_digest, checksum, True)
+        return
+
+    _validate_xml_uncached(xml_bytes)
+
+
+def _validate_xml_uncached(xml_bytes: bytes) -> None:
+    """Valida sin cachés: lxml si lo da por bueno; si no, xmlschema para el mensaje de error."""
+    if xsd_validator.lxml_is_valid(xml_bytes):
+        return
+    _validate_with_xmlschema(xml_bytes, use_cache=False)
+
+
+def _validate_with_xmlschema(xml_bytes: bytes, use_cache: bool = False) -> None:
+    """Validación con xmlschema (referencia histórica y fuente de los mensajes de error)."""
     # Validación real con manejo robusto de errores de timestamp
     try:
         schema = _get_schema()
@@ -597,6 +657,8 @@ def create_xml_from_data(
     df_factura_all=None,
     df_conceptos_all=None,
     rectificativas_overrides=None,
+    invoice_index=None,
+    xml_format=None,
 ):
     root = ET.Element("proformas")
     overrides_map = rectificativas_overrides or {}
@@ -613,8 +675,11 @@ def create_xml_from_data(
         elif overrides_map:
             log(f"⚠️ Override NO encontrado para {num_factura_actual} ({empresa_actual}). Clave buscada: '{key_override}'. Claves disponibles: {list(overrides_map.keys())[:5]}")
 
-        df_conc = df_conceptos_single[(df_conceptos_single["NumFactura"] == num_factura_actual) &
-                               (df_conceptos_single["empresa_emisora"] == empresa_actual)].copy()
+        if invoice_index is not None:
+            df_conc = invoice_index.conceptos(num_factura_actual, empresa_actual).copy()
+        else:
+            df_conc = df_conceptos_single[(df_conceptos_single["NumFactura"] == num_factura_actual) &
+                                   (df_conceptos_single["empresa_emisora"] == empresa_actual)].copy()
         if df_conc.empty:
             raise ValueError(f"No se encontraron conceptos para la factura {num_factura_actual} ({empresa_actual}).")
         required_cols = ["NumFactura","empresa_emisora","descripcion","cuenta_contable",
@@ -626,23 +691,9 @@ def create_xml_from_data(
         if not invalid.empty:
             raise ValueError(f"Conceptos con base_unidad <= 0: {invalid['descripcion'].tolist()}")
 
-        # Cálculos por línea
-        df_conc["base_imponible_cal"] = df_conc["unidades"].fillna(0) * df_conc["base_unidad"].fillna(0)
-        df_conc["importe_iva_cal"]    = df_conc["base_imponible_cal"] * (df_conc["porcentaje"].fillna(0) / 100.0)
-
-        def calc_ret(r):
-            try:
-                if str(r.get("tipo_impuesto_retenido","")).strip() == "":
-                    return 0.0
-                p = float(r.get("porcentaje_retenido", 0.0))
-                if p <= 0:
-                    return 0.0
-                b = float(r["base_imponible_cal"])
-                return round(b * (p/100.0), 2)
-            except Exception:
-                return 0.0
-        df_conc["importe_retencion_cal"] = df_conc.apply(calc_ret, axis=1)
-        df_conc["importe_total_cal"] = df_conc["base_imponible_cal"] + df_conc["importe_iva_cal"] - df_conc["importe_retencion_cal"]
+        # Cálculos por línea (ya vienen calculados si main() preparó el lote)
+        if not all(col in df_conc.columns for col in invoice_totals.LINE_COLS):
+            df_conc = invoice_totals.add_line_amounts(df_conc)
 
         # Totales
         total_base = _safe_num(df_conc["base_imponible_cal"].sum())
@@ -958,11 +1009,16 @@ def create_xml_from_data(
             create_sub_element(concepto, "importe_total", _safe_num(c["importe_total_cal"], 0.0))
 
         # Conceptos texto (respetando la posición del Excel si viene; si no, por índice estable)
-        if df_conceptos_texto_single is not None and not df_conceptos_texto_single.empty:
+        if invoice_index is not None:
+            df_txt = invoice_index.textos(num_factura_actual, empresa_actual).copy()
+        elif df_conceptos_texto_single is not None and not df_conceptos_texto_single.empty:
             df_txt = df_conceptos_texto_single[
                 (df_conceptos_texto_single["NumFactura"] == num_factura_actual) &
                 (df_conceptos_texto_single["empresa_emisora"] == empresa_actual)
             ].copy()
+        else:
+            df_txt = None
+        if df_txt is not None:
             if not df_txt.empty:
                 if "posicion" not in df_txt.columns:
                     df_txt = df_txt.reset_index(drop=True)
@@ -1076,7 +1132,8 @@ def create_xml_from_data(
         create_sub_element(proforma, "plantilla_facturas_emitidas", factura_row.get("plantilla_facturas_emitidas"), default="")
         create_sub_element(proforma, "plantilla_facturas_proforma", factura_row.get("plantilla_facturas_proforma"), default="")
 
-    return prettify(root)
+    # pretty (legible) o wire (compacto) según FACTUNABO_XML_FORMAT
+    return xml_writer.to_bytes(root, xml_format)
 
 def _sanitize_token(tok: str) -> str:
     s = str(tok or "")
@@ -1097,74 +1154,25 @@ def _sanitize_token(tok: str) -> str:
             return s
     return s
 
-def send_proforma(xml_content, api_key, external_id, empresa, ejercicio, cliente_numero_documento,
-                  api_email=None, api_url=None, api_timeout=None, use_offline_queue=False):
-    """Envía la proforma a la API de Facturantia con manejo robusto de duplicados y errores de fecha."""
-    import urllib.parse
-    
-    # Obtener timeout: primero del parámetro, luego de QSettings, luego por defecto 100
-    # Validar que el timeout esté en un rango seguro (1-300 segundos) para evitar errores de PyTime_t
+def _resolve_api_timeout(api_timeout=None, config=None):
+    """Timeout de la API en segundos (parámetro o el de la configuración de envío), acotado a 1-300."""
     if api_timeout is None:
-        try:
-            import sys
-            from PySide6.QtCore import QSettings
-            # Usar la misma lógica que AppSettings para encontrar el archivo config.ini
-            if getattr(sys, "frozen", False):
-                app_dir = os.path.dirname(sys.executable)
-            else:
-                # En desarrollo, buscar el archivo config.ini en la raíz del proyecto
-                current_file = os.path.abspath(__file__)
-                app_dir = os.path.dirname(current_file)
-            config_path = os.path.join(app_dir, "config.ini")
-            settings = QSettings(config_path, QSettings.IniFormat)
-            timeout_str = settings.value("api/timeout", "100")
-            try:
-                # Convertir a float primero para validar
-                api_timeout = float(timeout_str)
-                # Validar que el valor sea razonable (no más de 1000 segundos o milisegundos)
-                # Si es muy grande, probablemente es un error de lectura, usar valor por defecto
-                if api_timeout > 1000 or api_timeout < 0:
-                    log(f"⚠️ Timeout inválido leído de configuración: {timeout_str}. Usando 100 segundos por defecto.")
-                    api_timeout = 100
-                else:
-                    # Si el valor está entre 1 y 1000, podría estar en milisegundos si es > 100
-                    # Pero si es <= 100, asumimos que ya está en segundos
-                    if api_timeout > 100:
-                        api_timeout = api_timeout / 1000.0
-                api_timeout = int(api_timeout)
-            except (ValueError, TypeError):
-                api_timeout = 100
-        except Exception:
-            api_timeout = 100
-    else:
-        try:
-            api_timeout = float(api_timeout)
-            # Validar que el valor sea razonable
-            if api_timeout > 1000 or api_timeout < 0:
-                log(f"⚠️ Timeout inválido: {api_timeout}. Usando 100 segundos por defecto.")
-                api_timeout = 100
-            elif api_timeout > 100:
-                # Si está entre 100 y 1000, podría estar en milisegundos
-                api_timeout = api_timeout / 1000.0
-            api_timeout = int(api_timeout)
-        except (ValueError, TypeError):
-            api_timeout = 100
-    
-    # Validar que el timeout esté en un rango seguro (1-300 segundos)
-    # Esto previene errores de "timestamp too large to convert to C PyTime_t"
-    if api_timeout < 1:
-        api_timeout = 1
-    elif api_timeout > 300:
-        api_timeout = 300
-    
-    url = api_url or "https://www.facturantia.com/API/proformas_receptor.php"
-    user_email = api_email or "facturacion@abalados.es"
+        return (config or runtime_config.get()).api_timeout
+    return runtime_config.normalize_timeout(api_timeout)
+
+
+def _preparar_envio(api_key, external_id, empresa, ejercicio, cliente_numero_documento, api_email=None, api_url=None,
+                    config=None):
+    """Devuelve (url, headers, summary, predictive_pdf_url); headers es None si falta la API Key."""
+    config = config or runtime_config.get()
+    url = api_url or config.api_url
+    user_email = api_email or config.user_email
     token_str = _sanitize_token(api_key)
     empresa_header = quitar_tildes_empresa(empresa)
 
     if not token_str:
-        return {"external_id": external_id, "empresa": empresa, "status": "ERROR_SIN_API_KEY",
-                "details": "Falta API Key", "pdf_url": None}
+        return url, None, {"external_id": external_id, "empresa": empresa, "status": "ERROR_SIN_API_KEY",
+                           "details": "Falta API Key", "pdf_url": None}, None
 
     headers = {
         "X-Usuario-Email": user_email,
@@ -1182,22 +1190,21 @@ def send_proforma(xml_content, api_key, external_id, empresa, ejercicio, cliente
     predictive_pdf_url = f"https://www.facturantia.com/ver_afc_api.php?auid={auid}&aen={aen_encoded}&aej={ejercicio}&aeid={aeid}&acn={acn}"
 
     summary = {"external_id": external_id, "empresa": empresa, "status": "", "details": "", "pdf_url": None}
+    return url, headers, summary, predictive_pdf_url
 
+
+def _guardar_respuesta_cruda(content, external_id, empresa):
+    """Guarda la respuesta tal cual (almacén de artefactos y/o responses/) y devuelve su texto."""
     try:
-        # Asegurar que el timeout sea un número válido antes de pasarlo a requests
-        # Usar una tupla (connect_timeout, read_timeout) para mayor control
-        # Esto previene errores de "timestamp too large to convert to C PyTime_t"
-        connect_timeout = min(api_timeout, 30)  # Máximo 30 segundos para conectar
-        read_timeout = api_timeout  # El resto para leer la respuesta
-        timeout_tuple = (connect_timeout, read_timeout)
-        
-        resp = requests.post(url, data=xml_content, headers=headers, timeout=timeout_tuple)
-        try:
-            resp_text = resp.content.decode("utf-8")
-        except UnicodeDecodeError:
-            resp_text = resp.content.decode("iso-8859-1", errors="replace")
+        resp_text = content.decode("utf-8")
+    except UnicodeDecodeError:
+        resp_text = content.decode("iso-8859-1", errors="replace")
 
-        try:
+    try:
+        if artifact_store.writes_store():
+            artifact_id = artifact_store.get_store().put(artifact_store.KIND_API, external_id, empresa, content)
+            log(f"↳ API raw guardada en el almacén de artefactos (id {artifact_id})")
+        if artifact_store.writes_files():
             stamp = datetime.now().strftime("%Y%m%d_%H%M%S")
             safe_id = re.sub(r'[^a-zA-Z0-9_-]', '_', str(external_id))
             os.makedirs(RESPONSE_DIR, exist_ok=True)
@@ -1205,128 +1212,487 @@ def send_proforma(xml_content, api_key, external_id, empresa, ejercicio, cliente
             with open(raw_json_path, "w", encoding="utf-8") as f:
                 f.write(resp_text)
             log(f"↳ API raw guardada en: {raw_json_path}")
-        except Exception as io_err:
-            log(f"⚠️ No se pudo guardar respuesta cruda: {io_err}")
+    except Exception as io_err:
+        log(f"⚠️ No se pudo guardar respuesta cruda: {io_err}")
+    return resp_text
 
-        if resp.status_code != 200:
-            summary["status"] = "API_ERROR"
-            summary["details"] = f"HTTP {resp.status_code}: {resp_text}"
-            return summary
 
-        try:
-            resp_json = resp.json()
-
-            # ÉXITO
-            if resp_json.get("estado_envio_facturantia") == "CORRECTO":
-                summary["status"] = "ÉXITO"
-                summary["details"] = resp_json
-                procs = resp_json.get("proformas_procesadas", [])
-                if procs and isinstance(procs, list) and procs[0].get("pdf"):
-                    summary["pdf_url"] = procs[0].get("pdf")
-                else:
-                    summary["pdf_url"] = predictive_pdf_url
-                
-                # [NUEVO] Procesar enlaces QR tributarios si vienen en la respuesta
-                # La API ahora devuelve un objeto JSON que relaciona external_id con enlace_qr
-                enlaces_qr = resp_json.get("enlaces_qr", {})
-                if isinstance(enlaces_qr, dict) and enlaces_qr:
-                    # Guardar los enlaces QR en el summary para uso posterior
-                    summary["enlaces_qr"] = enlaces_qr
-                    # Si hay un enlace QR para este external_id específico, guardarlo también
-                    if external_id in enlaces_qr:
-                        summary["enlace_qr"] = enlaces_qr[external_id]
-                        log(f"📱 Enlace QR tributario recibido para {external_id}")
-                
-                log(f"✅ Envío correcto para {external_id} ({empresa})")
-                return summary
-
-            # ATENCIÓN / DUPLICADOS / FECHA POSTERIOR
-            if "mensaje_atencion" in resp_json:
-                att = str(resp_json.get("mensaje_atencion", "") or "")
-                att_clean = re.sub('<[^>]*>', '', att).lower()
-                if ("fecha de emisión" in att_clean) and ("posterior" in att_clean):
-                    summary["status"] = "ERROR_FECHA"
-                    summary["details"] = "Error: Ya existen facturas con fecha posterior para esta serie."
-                    summary["pdf_url"] = None
-                    log(f"⛔ {external_id}: Error de Fecha de Emisión posterior detectado.")
-                else:
-                    summary["status"] = "DUPLICADO"
-                    summary["details"] = att or "La factura ya existe (duplicada)."
-                    summary["pdf_url"] = predictive_pdf_url
-                    log(f"🔁 {external_id}: Factura duplicada detectada.")
-                return summary
-
-            # DUPLICADOS REALES
-            if ("mensaje_error" in resp_json and
-                ("duplicate entry" in str(resp_json.get("mensaje_error","")).lower() or
-                 "ya existe" in str(resp_json.get("mensaje_error","")).lower())):
-                summary["status"] = "DUPLICADO"
-                summary["details"] = resp_json.get("mensaje_error", "La factura ya existe (duplicada).")
-                summary["pdf_url"] = predictive_pdf_url
-                log(f"🔁 {external_id}: Duplicado real detectado.")
-                return summary
-
-            # OTROS ERRORES
-            error_msg = resp_json.get("mensaje_error", "Error API desconocido")
-            error_msg_cleaned = re.sub('<[^>]*>', '', str(error_msg))
-            if ("existen" in error_msg_cleaned.lower() and
-                "facturas emitidas" in error_msg_cleaned.lower() and
-                "fecha de emisión" in error_msg_cleaned.lower() and
-                "posterior" in error_msg_cleaned.lower()):
-                summary["status"] = "ERROR_FECHA"
-                summary["details"] = "Error: Ya existen facturas con fecha posterior para esta serie."
-                summary["pdf_url"] = None
-                log(f"⛔ {external_id}: Error de Fecha posterior detectado.")
+def _interpretar_respuesta(status_code, content, summary, external_id, empresa, predictive_pdf_url):
+    """Traduce la respuesta HTTP de Facturantia al summary de envío (éxito, duplicado, fecha, error...)."""
+    connectivity.get_monitor().record_response(status_code)
+    resp_text = _guardar_respuesta_cruda(content, external_id, empresa)
+
+    if status_code != 200:
+        summary["status"] = "API_ERROR"
+        summary["details"] = f"HTTP {status_code}: {resp_text}"
+        return summary
+
+    try:
+        resp_json = json.loads(resp_text)
+
+        # ÉXITO
+        if resp_json.get("estado_envio_facturantia") == "CORRECTO":
+            summary["status"] = "ÉXITO"
+            summary["details"] = resp_json
+            procs = resp_json.get("proformas_procesadas", [])
+            if procs and isinstance(procs, list) and procs[0].get("pdf"):
+                summary["pdf_url"] = procs[0].get("pdf")
             else:
-                summary["status"] = "ERROR_API_LÓGICO"
-                summary["details"] = error_msg
-                log(f"⚠️ {external_id}: Error API lógico -> {error_msg}")
+                summary["pdf_url"] = predictive_pdf_url
+
+            # [NUEVO] Procesar enlaces QR tributarios si vienen en la respuesta
+            # La API ahora devuelve un objeto JSON que relaciona external_id con enlace_qr
+            enlaces_qr = resp_json.get("enlaces_qr", {})
+            if isinstance(enlaces_qr, dict) and enlaces_qr:
+                # Guardar los enlaces QR en el summary para uso posterior
+                summary["enlaces_qr"] = enlaces_qr
+                # Si hay un enlace QR para este external_id específico, guardarlo también
+                if external_id in enlaces_qr:
+                    summary["enlace_qr"] = enlaces_qr[external_id]
+                    log(f"📱 Enlace QR tributario recibido para {external_id}")
+
+            log(f"✅ Envío correcto para {external_id} ({empresa})")
             return summary
 
-        except json.JSONDecodeError:
-            if "CORRECTO" in resp_text.upper():
-                summary["status"] = "ÉXITO"
-                summary["details"] = resp_text
-                summary["pdf_url"] = predictive_pdf_url
-                return summary
-            if "fecha de emisión" in resp_text.lower() and "posterior" in resp_text.lower():
+        # ATENCIÓN / DUPLICADOS / FECHA POSTERIOR
+        if "mensaje_atencion" in resp_json:
+            att = str(resp_json.get("mensaje_atencion", "") or "")
+            att_clean = re.sub('<[^>]*>', '', att).lower()
+            if ("fecha de emisión" in att_clean) and ("posterior" in att_clean):
                 summary["status"] = "ERROR_FECHA"
-                summary["details"] = "Error: Ya existen facturas con fecha posterior."
+                summary["details"] = "Error: Ya existen facturas con fecha posterior para esta serie."
                 summary["pdf_url"] = None
-                return summary
-            if "ya existe" in resp_text.lower():
+                log(f"⛔ {external_id}: Error de Fecha de Emisión posterior detectado.")
+            else:
                 summary["status"] = "DUPLICADO"
-                summary["details"] = "La factura ya existe (duplicada)."
+                summary["details"] = att or "La factura ya existe (duplicada)."
                 summary["pdf_url"] = predictive_pdf_url
-                return summary
+                log(f"🔁 {external_id}: Factura duplicada detectada.")
+            return summary
+
+        # DUPLICADOS REALES
+        if ("mensaje_error" in resp_json and
+            ("duplicate entry" in str(resp_json.get("mensaje_error","")).lower() or
+             "ya existe" in str(resp_json.get("mensaje_error","")).lower())):
+            summary["status"] = "DUPLICADO"
+            summary["details"] = resp_json.get("mensaje_error", "La factura ya existe (duplicada).")
+            summary["pdf_url"] = predictive_pdf_url
+            log(f"🔁 {external_id}: Duplicado real detectado.")
+            return summary
 
-            summary["status"] = "API_ERROR_NO_JSON"
+        # OTROS ERRORES
+        error_msg = resp_json.get("mensaje_error", "Error API desconocido")
+        error_msg_cleaned = re.sub('<[^>]*>', '', str(error_msg))
+        if ("existen" in error_msg_cleaned.lower() and
+            "facturas emitidas" in error_msg_cleaned.lower() and
+            "fecha de emisión" in error_msg_cleaned.lower() and
+            "posterior" in error_msg_cleaned.lower()):
+            summary["status"] = "ERROR_FECHA"
+            summary["details"] = "Error: Ya existen facturas con fecha posterior para esta serie."
+            summary["pdf_url"] = None
+            log(f"⛔ {external_id}: Error de Fecha posterior detectado.")
+        else:
+            summary["status"] = "ERROR_API_LÓGICO"
+            summary["details"] = error_msg
+            log(f"⚠️ {external_id}: Error API lógico -> {error_msg}")
+        return summary
+
+    except json.JSONDecodeError:
+        if "CORRECTO" in resp_text.upper():
+            summary["status"] = "ÉXITO"
             summary["details"] = resp_text
+            summary["pdf_url"] = predictive_pdf_url
+            return summary
+        if "fecha de emisión" in resp_text.lower() and "posterior" in resp_text.lower():
+            summary["status"] = "ERROR_FECHA"
+            summary["details"] = "Error: Ya existen facturas con fecha posterior."
+            summary["pdf_url"] = None
+            return summary
+        if "ya existe" in resp_text.lower():
+            summary["status"] = "DUPLICADO"
+            summary["details"] = "La factura ya existe (duplicada)."
+            summary["pdf_url"] = predictive_pdf_url
             return summary
 
+        summary["status"] = "API_ERROR_NO_JSON"
+        summary["details"] = resp_text
+        return summary
+
+
+
+def _encolar_offline(summary, xml_content, api_key, external_id, empresa, ejercicio, cliente_numero_documento, motivo):
+    """Añade la factura a la cola offline y lo refleja en el summary."""
+    try:
+        import offline_queue
+        queue_id = offline_queue.add_to_queue(
+            xml_content, external_id, empresa, ejercicio, cliente_numero_documento, api_key
+        )
+        log(f"📦 Factura {external_id} añadida a cola offline (ID: {queue_id})")
+        summary["status"] = "EN_COLA_OFFLINE"
+        summary["details"] = f"{motivo}. Añadida a cola offline (ID: {queue_id})"
+    except Exception as queue_err:
+        log(f"⚠️ Error añadiendo a cola offline: {queue_err}")
+    return summary
+
+
+def _resultado_error_conexion(summary, error, xml_content, api_key, external_id, empresa, ejercicio,
+                              cliente_numero_documento, use_offline_queue=False):
+    """Completa el summary ante un fallo de conexión y, si procede, encola la factura offline."""
+    connectivity.get_monitor().record_failure()
+    summary["status"] = "ERROR_CONEXIÓN"
+    summary["details"] = str(error)
+    log(f"❌ Error de conexión para {external_id}: {error}")
+
+    # [NUEVO] Si hay error de conexión y está habilitado, añadir a cola offline
+    if use_offline_queue:
+        _encolar_offline(summary, xml_content, api_key, external_id, empresa, ejercicio,
+                         cliente_numero_documento, "Error de conexión")
+    return summary
+
+
+def _resultado_timeout(summary, external_id):
+    connectivity.get_monitor().record_degraded()
+    summary["status"] = "ERROR_TIMEOUT"
+    summary["details"] = "Timeout API (>60s)"
+    log(f"⚠️ Timeout API (>60s) para {external_id}.")
+    return summary
+
+
+def _sin_conexion(summary, xml_content, api_key, external_id, empresa, ejercicio, cliente_numero_documento,
+                  use_offline_queue):
+    """Si la cola offline está activa y el monitor nos da por desconectados, encola sin tocar la red."""
+    if not use_offline_queue or not connectivity.get_monitor().is_offline():
+        return None
+    log(f"📴 Sin conexión con Facturantia: {external_id} se envía a la cola offline.")
+    return _encolar_offline(summary, xml_content, api_key, external_id, empresa, ejercicio,
+                            cliente_numero_documento, "Sin conexión")
+
+
+def _post(url, data, headers, timeout, limiter=None, factura=None):
+    """
+    POST al receptor; con limiter (send_engine.AdaptiveLimiter) espera hueco y
+    le informa de la latencia y de si la API dio señales de saturación.
+    """
+    if limiter is None:
+        with batch_profiler.span("envio", factura):
+            return http_client.post(url, data=data, headers=headers, timeout=timeout)
+    started = limiter.acquire()
+    sobrecarga = True
+    try:
+        with batch_profiler.span("envio", factura):
+            resp = http_client.post(url, data=data, headers=headers, timeout=timeout)
+        sobrecarga = send_engine.is_overload_status(resp.status_code)
+        return resp
+    finally:
+        limiter.release(started, sobrecarga)
+
+
+def send_proforma(xml_content, api_key, external_id, empresa, ejercicio, cliente_numero_documento,
+                  api_email=None, api_url=None, api_timeout=None, use_offline_queue=False, config=None,
+                  limiter=None):
+    """
+    Envía la proforma a la API de Facturantia con manejo robusto de duplicados y errores de fecha.
+
+    config es la instantánea de runtime_config del lote (por defecto la vigente) y
+    limiter el límite adaptativo de envíos en vuelo del lote (None = sin límite).
+    """
+    config = config or runtime_config.get()
+    api_timeout = _resolve_api_timeout(api_timeout, config)
+    url, headers, summary, predictive_pdf_url = _preparar_envio(
+        api_key, external_id, empresa, ejercicio, cliente_numero_documento, api_email, api_url, config
+    )
+    if headers is None:
+        return summary
+    encolada = _sin_conexion(summary, xml_content, api_key, external_id, empresa, ejercicio,
+                             cliente_numero_documento, use_offline_queue)
+    if encolada is not None:
+        return encolada
+
+    try:
+        # Asegurar que el timeout sea un número válido antes de pasarlo a requests
+        # Usar una tupla (connect_timeout, read_timeout) para mayor control
+        # Esto previene errores de "timestamp too large to convert to C PyTime_t"
+        timeout_tuple = http_client.get_timeouts(api_timeout)
+
+        # Pool keep-alive compartido con reintentos para fallos transitorios
+        resp = _post(url, xml_content, headers, timeout_tuple, limiter, factura=external_id)
+        return _interpretar_respuesta(resp.status_code, resp.content, summary, external_id, empresa, predictive_pdf_url)
     except requests.exceptions.Timeout:
-        summary["status"] = "ERROR_TIMEOUT"
-        summary["details"] = "Timeout API (>60s)"
-        log(f"⚠️ Timeout API (>60s) para {external_id}.")
+        return _resultado_timeout(summary, external_id)
     except requests.exceptions.RequestException as e:
-        summary["status"] = "ERROR_CONEXIÓN"
-        summary["details"] = str(e)
-        log(f"❌ Error de conexión para {external_id}: {e}")
-        
-        # [NUEVO] Si hay error de conexión y está habilitado, añadir a cola offline
-        if use_offline_queue:
-            try:
-                import offline_queue
-                queue_id = offline_queue.add_to_queue(
-                    xml_content, external_id, empresa, ejercicio, cliente_numero_documento, api_key
-                )
-                log(f"📦 Factura {external_id} añadida a cola offline (ID: {queue_id})")
-                summary["status"] = "EN_COLA_OFFLINE"
-                summary["details"] = f"Error de conexión. Añadida a cola offline (ID: {queue_id})"
-            except Exception as queue_err:
-                log(f"⚠️ Error añadiendo a cola offline: {queue_err}")
+        return _resultado_error_conexion(summary, e, xml_content, api_key, external_id, empresa, ejercicio,
+                                         cliente_numero_documento, use_offline_queue)
 
-    return summary
+
+# Claves de la respuesta de Facturantia que van por proforma
+_CLAVES_POR_PROFORMA = ("proformas_procesadas", "numeros_facturas", "enlaces_qr")
+
+
+def _respuesta_por_proforma(resp_json, envios):
+    """
+    Reparte una respuesta CORRECTO de un lote entre sus proformas.
+
+    Devuelve una lista (alineada con envios) con el JSON que habría recibido
+    cada proforma enviada sola, o None para las que la respuesta no menciona.
+    """
+    procs = resp_json.get("proformas_procesadas") or []
+    if not isinstance(procs, list):
+        procs = []
+    numeros = resp_json.get("numeros_facturas")
+    numeros = numeros if isinstance(numeros, dict) else {}
+    enlaces = resp_json.get("enlaces_qr")
+    enlaces = enlaces if isinstance(enlaces, dict) else {}
+    comunes = {k: v for k, v in resp_json.items() if k not in _CLAVES_POR_PROFORMA}
+
+    ids = [str(envio["external_id"]) for envio in envios]
+    if procs and all(isinstance(pr, dict) and pr.get("external_id") is not None for pr in procs):
+        por_id = {}
+        for pr in procs:
+            por_id.setdefault(str(pr["external_id"]), []).append(pr)
+        procs_por_envio = [por_id.get(ext, []) for ext in ids]
+    elif len(procs) == len(envios):
+        # Sin external_id en cada proforma: la API las devuelve en el orden enviado
+        procs_por_envio = [[pr] for pr in procs]
+    else:
+        procs_por_envio = [[] for _ in envios]
+
+    respuestas = []
+    for ext, envio, procs_envio in zip(ids, envios, procs_por_envio):
+        if not procs_envio and ext not in numeros:
+            respuestas.append(None)
+            continue
+        item = dict(comunes)
+        item["proformas_procesadas"] = procs_envio
+        clave = envio["external_id"] if envio["external_id"] in numeros else ext
+        if clave in numeros:
+            item["numeros_facturas"] = {clave: numeros[clave]}
+        clave = envio["external_id"] if envio["external_id"] in enlaces else ext
+        if clave in enlaces:
+            item["enlaces_qr"] = {clave: enlaces[clave]}
+        respuestas.append(item)
+    return respuestas
+
+
+def send_proforma_batch(envios):
+    """
+    Envía varias proformas de un mismo emisor/ejercicio en una sola petición.
+
+    envios es una lista de dicts con los argumentos de send_proforma (misma
+    empresa, ejercicio, API Key y URL). Los XML se unen en un único
+    <proformas> y la respuesta se reparte por external_id. Si Facturantia
+    rechaza el lote por alguna proforma (duplicado, fecha posterior, error...),
+    se divide en dos mitades y se reintenta cada una, hasta llegar a envíos
+    individuales con send_proforma; las proformas que la respuesta no menciona
+    se reenvían. Los HTTP 429/5xx y los fallos de transporte no dependen de las
+    proformas: pasan por los reintentos de http_client y el limiter, y el lote
+    entero queda con el mismo error que tendría cada envío suelto, sin dividirlo.
+    Devuelve los summaries en el mismo orden que envios.
+    """
+    if len(envios) == 1:
+        return [send_proforma(**envios[0])]
+
+    primero = envios[0]
+    config = primero.get("config") or runtime_config.get()
+    api_timeout = _resolve_api_timeout(primero.get("api_timeout"), config)
+    resultados = [None] * len(envios)
+    pendientes = []  # posiciones que viajan en la petición
+    contexto = {}
+    for pos, envio in enumerate(envios):
+        url, headers, summary, predictive_pdf_url = _preparar_envio(
+            envio["api_key"], envio["external_id"], envio["empresa"], envio["ejercicio"],
+            envio["cliente_numero_documento"], envio.get("api_email"), envio.get("api_url"), config,
+        )
+        if headers is None:
+            resultados[pos] = summary
+            continue
+        encolada = _sin_conexion(summary, envio["xml_content"], envio["api_key"], envio["external_id"],
+                                 envio["empresa"], envio["ejercicio"], envio["cliente_numero_documento"],
+                                 envio.get("use_offline_queue", False))
+        if encolada is not None:
+            resultados[pos] = encolada
+            continue
+        contexto[pos] = (url, headers, summary, predictive_pdf_url)
+        pendientes.append(pos)
+    if len(pendientes) <= 1:
+        for pos in pendientes:
+            resultados[pos] = send_proforma(**envios[pos])
+        return resultados
+
+    url, headers = contexto[pendientes[0]][0], contexto[pendientes[0]][1]
+    lote = [envios[pos] for pos in pendientes]
+    xml_lote = xml_writer.combine([envio["xml_content"] for envio in lote])
+    etiqueta = f"{lote[0]['external_id']}..{lote[-1]['external_id']}"
+    log(f"📦 Enviando lote de {len(lote)} proformas de {primero['empresa']} ({etiqueta})")
+
+    try:
+        resp = _post(url, xml_lote, headers, http_client.get_timeouts(api_timeout), primero.get("limiter"))
+    except requests.exceptions.Timeout:
+        for pos in pendientes:
+            resultados[pos] = _resultado_timeout(contexto[pos][2], envios[pos]["external_id"])
+        return resultados
+    except requests.exceptions.RequestException as e:
+        for pos in pendientes:
+            envio = envios[pos]
+            resultados[pos] = _resultado_error_conexion(
+                contexto[pos][2], e, envio["xml_content"], envio["api_key"], envio["external_id"],
+                envio["empresa"], envio["ejercicio"], envio["cliente_numero_documento"],
+                envio.get("use_offline_queue", False),
+            )
+        return resultados
+
+    if send_engine.is_overload_status(resp.status_code):
+        # API saturada: _post ya reintentó y avisó al limiter; dividir el lote sólo multiplicaría los POST
+        connectivity.get_monitor().record_response(resp.status_code)
+        resp_text = _guardar_respuesta_cruda(resp.content, etiqueta, primero["empresa"])
+        log(f"⚠️ Lote {etiqueta}: HTTP {resp.status_code}; no se divide.")
+        for pos in pendientes:
+            summary = contexto[pos][2]
+            summary["status"] = "API_ERROR"
+            summary["details"] = f"HTTP {resp.status_code}: {resp_text}"
+            resultados[pos] = summary
+        return resultados
+
+    resp_json = None
+    if resp.status_code == 200:
+        try:
+            resp_json = json.loads(resp.content.decode("utf-8"))
+        except (UnicodeDecodeError, ValueError):
+            resp_json = None
+    correcto = isinstance(resp_json, dict) and resp_json.get("estado_envio_facturantia") == "CORRECTO"
+    respuestas = _respuesta_por_proforma(resp_json, lote) if correcto else [None] * len(lote)
+
+    if not any(r is not None for r in respuestas):
+        # Rechazo del lote completo (o respuesta sin detalle): se parte en dos y se reintenta
+        connectivity.get_monitor().record_response(resp.status_code)
+        _guardar_respuesta_cruda(resp.content, etiqueta, primero["empresa"])
+        log(f"✂️ Lote {etiqueta} rechazado (HTTP {resp.status_code}); se divide y se reintenta.")
+        mitad = len(lote) // 2
+        for pos, summary in zip(pendientes, send_proforma_batch(lote[:mitad]) + send_proforma_batch(lote[mitad:])):
+            resultados[pos] = summary
+        return resultados
+
+    sin_respuesta = []
+    for pos, respuesta in zip(pendientes, respuestas):
+        if respuesta is None:
+            sin_respuesta.append(pos)
+            continue
+        _, _, summary, predictive_pdf_url = contexto[pos]
+        resultados[pos] = _interpretar_respuesta(
+            200, json.dumps(respuesta, ensure_ascii=False).encode("utf-8"), summary,
+            envios[pos]["external_id"], envios[pos]["empresa"], predictive_pdf_url,
+        )
+    if sin_respuesta:
+        log(f"🔁 {len(sin_respuesta)} proformas del lote {etiqueta} sin respuesta propia; se reenvían.")
+        for pos, summary in zip(sin_respuesta, send_proforma_batch([envios[pos] for pos in sin_respuesta])):
+            resultados[pos] = summary
+    return resultados
+
+
+async def async_send_proforma(xml_content, api_key, external_id, empresa, ejercicio, cliente_numero_documento,
+                              api_email=None, api_url=None, api_timeout=None, use_offline_queue=False,
+                              config=None, limiter=None, client=None, deadline=None):
+    """
+    Versión asíncrona de send_proforma (httpx). Devuelve el mismo summary.
+
+    client es un httpx.AsyncClient compartido por el lote; deadline limita el
+    tiempo total de la petición incluidos los reintentos (por defecto connect + read).
+    limiter se acepta por compatibilidad con los envíos del lote y no se usa: el
+    transporte asíncrono se limita con max_in_flight.
+    """
+    import asyncio
+    import httpx
+
+    config = config or runtime_config.get()
+    api_timeout = _resolve_api_timeout(api_timeout, config)
+    url, headers, summary, predictive_pdf_url = _preparar_envio(
+        api_key, external_id, empresa, ejercicio, cliente_numero_documento, api_email, api_url, config
+    )
+    if headers is None:
+        return summary
+    encolada = _sin_conexion(summary, xml_content, api_key, external_id, empresa, ejercicio,
+                             cliente_numero_documento, use_offline_queue)
+    if encolada is not None:
+        return encolada
+
+    connect_timeout, read_timeout = http_client.get_timeouts(api_timeout)
+    if deadline is None:
+        deadline = connect_timeout + read_timeout
+    own_client = client is None
+    if own_client:
+        client = http_client.get_async_client()
+    try:
+        with batch_profiler.span("envio", external_id):
+            resp = await asyncio.wait_for(
+                http_client.async_post(client, url, content=xml_content, headers=headers,
+                                       timeout=httpx.Timeout(read_timeout, connect=connect_timeout)),
+                timeout=deadline,
+            )
+        return _interpretar_respuesta(resp.status_code, resp.content, summary, external_id, empresa, predictive_pdf_url)
+    except (asyncio.TimeoutError, httpx.TimeoutException):
+        return _resultado_timeout(summary, external_id)
+    except httpx.HTTPError as e:
+        return _resultado_error_conexion(summary, e, xml_content, api_key, external_id, empresa, ejercicio,
+                                         cliente_numero_documento, use_offline_queue)
+    finally:
+        if own_client:
+            await client.aclose()
+
+
+def process_offline_queue(limit=50, config=None):
+    """
+    Reenvía las facturas pendientes de la cola offline (sin volver a encolarlas).
+
+    Devuelve {"procesadas", "enviadas", "fallidas"}; las enviadas (ÉXITO o
+    DUPLICADO) se marcan como enviadas y el resto suma un intento fallido.
+    """
+    import offline_queue
+
+    config = config or runtime_config.get()
+    items = offline_queue.get_pending_items(limit=limit)
+    enviadas = fallidas = 0
+    for item in items:
+        try:
+            result = send_proforma(
+                item["xml_content"], item["api_key"], item["num_factura"], item["empresa"],
+                item["ejercicio"], item["cliente_doc"],
+                use_offline_queue=False,  # No volver a añadir a la cola
+                config=config,
+            )
+            if result.get("status") in ["ÉXITO", "DUPLICADO"]:
+                offline_queue.mark_as_sent(item["id"])
+                enviadas += 1
+            else:
+                offline_queue.mark_as_failed(item["id"], result.get("details", "Error desconocido"))
+                fallidas += 1
+        except Exception as e:
+            offline_queue.mark_as_failed(item["id"], str(e))
+            fallidas += 1
+    return {"procesadas": len(items), "enviadas": enviadas, "fallidas": fallidas}
+
+
+def run_async_batch(envios, max_in_flight=None, deadline=None):
+    """
+    Envía un lote de proformas desde un único hilo con httpx.
+
+    envios es una lista de dicts con los argumentos de send_proforma. Las
+    facturas de una misma empresa se envían en orden (una en vuelo por
+    empresa) y en total hay como mucho max_in_flight peticiones abiertas.
+    Devuelve los summaries en el mismo orden que envios.
+    """
+    import asyncio
+
+    async def _run():
+        async with http_client.get_async_client() as client:
+            async def _enviar(envio):
+                return await async_send_proforma(client=client, deadline=deadline, **envio)
+            return await send_engine.run_lanes_async(
+                envios,
+                key_func=lambda envio: envio["empresa"],
+                coro_func=_enviar,
+                max_in_flight=max_in_flight,
+            )
+
+    return asyncio.run(_run())
 
 def read_excel_any(path, **kwargs):
     lower = path.lower()
@@ -1334,7 +1700,560 @@ def read_excel_any(path, **kwargs):
         return pd.read_excel(path, engine="openpyxl", **kwargs)
     return pd.read_excel(path, **kwargs)
 
-def main(df_factura_historico=None, df_conceptos_historico=None, rectificativas_overrides=None):
+def _datos_factura(frow, ctx):
+    """
+    Primera parte (barata) de la preparación: ids, importe y filas de la factura.
+
+    Devuelve {"filas": [...]} si la factura no debe generarse (sin API Key) o
+    los datos con los que _construir_xml genera el XML.
+    """
+    index = ctx["index"]
+    totals = ctx["totals"]
+    rectificativas_overrides = ctx["rectificativas_overrides"]
+
+    filas = []
+    num, empresa = frow["NumFactura"], frow["empresa_emisora"]
+    ejercicio, cliente_doc, api_key = frow["ejercicio"], frow["cliente_numero_documento"], frow["api_key"]
+    key_override = _rectificativa_key(num, empresa)
+    override_entry = rectificativas_overrides.get(key_override) if rectificativas_overrides else None
+    tipo_override = ""
+    if override_entry and override_entry.get("tipo_factura"):
+        tipo_override = str(override_entry.get("tipo_factura") or "").upper()
+    tipo_row = str(frow.get("tipo_factura", "") or "").upper()
+    effective_tipo = tipo_override or tipo_row
+
+    base_external_id = _norm_invoice_id(num)
+    external_id_to_send = base_external_id
+    is_rectificativa = effective_tipo.startswith("R")
+    if is_rectificativa:
+        if override_entry is None:
+            override_entry = rectificativas_overrides.setdefault(key_override, {})
+        desired_external = f"R{base_external_id}"
+        stored_external = str(override_entry.get("__external_id", "")).strip()
+        if stored_external:
+            external_id_to_send = stored_external
+        else:
+            # Intentar usar R{numero}; si excede 60 caracteres recortamos por la izquierda
+            if len(desired_external) > 60:
+                desired_external = desired_external[-60:]
+            override_entry["__external_id"] = desired_external
+            log(f"ℹ️ External ID rectificativa asignado para {base_external_id}: {desired_external}")
+            external_id_to_send = desired_external
+    elif override_entry and override_entry.get("__external_id"):
+        external_id_to_send = str(override_entry["__external_id"])
+
+    if not api_key:
+        # --- CALCULAR IMPORTE PARA ERROR_SIN_API_KEY ---
+        try:
+            importe_total = totals.importe(num, empresa, frow.get("total_suplidos", 0.0))
+        except Exception:
+            importe_total = 0.0
+        
+        filas.append({
+            "id": num,
+            "empresa": empresa,
+            "status": "ERROR_SIN_API_KEY",
+            "details": "Falta API Key",
+            "pdf_url": None,
+            "cliente": frow.get("cliente_nombre",""),
+            "importe": importe_total,
+            "external_id": external_id_to_send,
+            "num_original": base_external_id,
+        })
+        return {"filas": filas, "frow": frow, "empresa": empresa}
+
+    # Reanudación: lo ya confirmado en el diario de envíos no se vuelve a generar ni enviar
+    journal = ctx.get("journal")
+    if journal is not None and ctx.get("resume"):
+        filas_previas = journal.resolved_rows(external_id_to_send, empresa)
+        if filas_previas is not None:
+            log(f"⏭️ {external_id_to_send} ({empresa}) ya enviada según el diario; no se reenvía.")
+            return {"filas": filas_previas, "frow": frow, "empresa": empresa}
+
+    df_f_single = pd.DataFrame([frow])
+    df_c_single = index.conceptos(num, empresa)
+    df_fp_single = index.forma_pago(num, empresa)
+    df_txt_single = index.textos(num, empresa)
+
+    # --- Importe total para summary.json (mismo cálculo que el XML) ---
+    try:
+        importe_total = totals.importe(num, empresa, frow.get("total_suplidos", 0.0))
+    except Exception:
+        importe_total = 0.0
+
+    return {
+        "frow": frow,
+        "num": num,
+        "empresa": empresa,
+        "ejercicio": ejercicio,
+        "cliente_doc": cliente_doc,
+        "api_key": api_key,
+        "key_override": key_override,
+        "base_external_id": base_external_id,
+        "external_id": external_id_to_send,
+        "importe_total": importe_total,
+        "xml_args": (df_f_single, df_c_single, df_fp_single, df_txt_single),
+    }
+
+
+def _construir_xml(df_f_single, df_c_single, df_fp_single, df_txt_single, rectificativas_overrides=None,
+                   invoice_index=None, factura=None):
+    """
+    Genera el XML de una factura y lo valida contra el XSD.
+
+    Devuelve (xml_bytes, error_xsd, traceback_xsd); los errores de generación se propagan.
+    factura sólo identifica la factura en el informe de tiempos.
+    """
+    try:
+        with batch_profiler.span("xml", factura):
+            xml_bytes = create_xml_from_data(
+                df_f_single, df_c_single, df_fp_single, df_txt_single,
+                rectificativas_overrides=rectificativas_overrides,
+                invoice_index=invoice_index,
+            )
+    except (OverflowError, OSError) as timestamp_err:
+        log(f"❌ ERROR DE TIMESTAMP en create_xml_from_data: {timestamp_err}")
+        log(f"❌ Tipo de error: {type(timestamp_err).__name__}")
+        import traceback
+        log(f"❌ Traceback completo:\n{traceback.format_exc()}")
+        raise
+
+    # Validación XSD previa al envío
+    try:
+        with batch_profiler.span("xsd", factura):
+            validate_xml_against_xsd(xml_bytes)
+    except Exception as xsd_err:
+        import traceback
+        return xml_bytes, xsd_err, traceback.format_exc()
+    return xml_bytes, None, ""
+
+
+# --- Generación en procesos (pipeline de main) ---
+def _construir_xml_en_proceso(xml_args, overrides):
+    """
+    _construir_xml en un proceso del pool: devuelve también los mensajes de log,
+    los overrides tocados y los tiempos medidos (para el informe del lote).
+    """
+    mensajes = []
+    set_gui_logger(mensajes.append)
+    try:
+        with batch_profiler.collect() as tiempos:
+            xml_bytes, xsd_err, xsd_tb = _construir_xml(
+                *xml_args, rectificativas_overrides=overrides,
+            )
+    except Exception as e:
+        # El error se relanza en el proceso principal, después de volcar sus mensajes
+        return {"error": e, "logs": mensajes}
+    finally:
+        set_gui_logger(None)
+    # Los veredictos XSD nuevos los escribe el proceso principal, en un solo lote
+    return {"xml": xml_bytes, "xsd_err": xsd_err, "xsd_tb": xsd_tb, "logs": mensajes, "overrides": overrides,
+            "tiempos": tiempos, "veredictos": xsd_validator.take_pending_verdicts()}
+
+
+def _preparar_factura(frow, ctx, datos=None, obtener_xml=None):
+    """
+    Genera, guarda y valida el XML de una factura de la Macro.
+
+    Devuelve {"filas": [...]} si la factura ya no debe enviarse (sin API Key,
+    error de XSD o de generación) o el trabajo de envío, con los argumentos
+    de send_proforma en "envio". En el pipeline, datos ya viene calculado y
+    obtener_xml() entrega el resultado de _construir_xml_en_proceso.
+    """
+    if datos is None:
+        datos = _datos_factura(frow, ctx)
+    if "filas" in datos:
+        return datos
+    frow = datos["frow"]
+    rectificativas_overrides = ctx["rectificativas_overrides"]
+    num, empresa = datos["num"], datos["empresa"]
+    ejercicio, cliente_doc, api_key = datos["ejercicio"], datos["cliente_doc"], datos["api_key"]
+    base_external_id = datos["base_external_id"]
+    external_id_to_send = datos["external_id"]
+    importe_total = datos["importe_total"]
+    filas = []
+
+    try:
+        if obtener_xml is None:
+            xml_bytes, xsd_err, xsd_tb = _construir_xml(
+                *datos["xml_args"],
+                rectificativas_overrides=rectificativas_overrides,
+                invoice_index=ctx["index"],
+                factura=external_id_to_send,
+            )
+        else:
+            construido = obtener_xml()
+            batch_profiler.merge(construido.get("tiempos"), external_id_to_send)
+            xsd_validator.add_pending_verdicts(construido.get("veredictos"))
+            for mensaje in construido["logs"]:
+                log(mensaje)
+            if "error" in construido:
+                raise construido["error"]
+            for key, entry in (construido["overrides"] or {}).items():
+                if key in rectificativas_overrides:
+                    rectificativas_overrides[key].update(entry)
+            xml_bytes, xsd_err, xsd_tb = construido["xml"], construido["xsd_err"], construido["xsd_tb"]
+        xml_hash = artifact_store.content_hash(xml_bytes)
+
+        # Guardar XML
+        try:
+            empresa_safe = str(empresa).replace(" ", "_").replace(".", "")
+            # IDs sin ".0"
+            num_str = str(external_id_to_send)
+            try:
+                fnum = float(num_str)
+                if fnum.is_integer():
+                    num_str = str(int(fnum))
+            except Exception:
+                pass
+            num_safe = num_str.replace("/", "_")
+            with batch_profiler.span("escritura", external_id_to_send):
+                if artifact_store.writes_store():
+                    artifact_id = artifact_store.get_store().put(
+                        artifact_store.KIND_XML, num_str, empresa, xml_bytes, num_original=base_external_id,
+                        digest=xml_hash,
+                    )
+                    log(f"💾 XML guardado en el almacén de artefactos (id {artifact_id})")
+                if artifact_store.writes_files():
+                    stamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+                    xml_filename_logs = os.path.join(LOG_DIR, f"{empresa_safe}_proforma_{num_safe}_{stamp}.xml")
+                    xml_filename_resp = os.path.join(RESPONSE_DIR, f"xml_{num_safe}_{stamp}.xml")
+                    # Una sola escritura: la copia de responses/ es un enlace duro
+                    artifact_store.write_copies(xml_bytes, (xml_filename_logs, xml_filename_resp))
+                    log(f"💾 XML guardado en: {xml_filename_logs}")
+                    log(f"💾 XML copiado en: {xml_filename_resp}")
+        except Exception as io_err:
+            log(f"⚠️ No se pudo guardar el XML: {io_err}")
+
+        # Resultado de la validación XSD previa al envío
+        if isinstance(xsd_err, (OverflowError, OSError)):
+            log(f"❌ ERROR DE TIMESTAMP en validacion XSD: {xsd_err}")
+            log(f"❌ Tipo de error: {type(xsd_err).__name__}")
+            log(f"❌ Traceback completo:\n{xsd_tb}")
+            filas.append({
+                "id": num,
+                "empresa": empresa,
+                "status": "ERROR_VALIDACION_XSD",
+                "details": f"Error de timestamp en validación XSD: {xsd_err}",
+                "pdf_url": None,
+                "cliente": frow.get("cliente_nombre",""),
+                "importe": importe_total
+            })
+            return {"filas": filas}
+        if xsd_err is not None:
+            log(f"❌ ERROR en validacion XSD: {xsd_err}")
+            log(f"❌ Tipo de error: {type(xsd_err).__name__}")
+            log(f"❌ Traceback completo:\n{xsd_tb}")
+            filas.append({
+                "id": num,
+                "empresa": empresa,
+                "status": "ERROR_VALIDACION_XSD",
+                "details": str(xsd_err),
+                "pdf_url": None,
+                "cliente": frow.get("cliente_nombre",""),
+                "importe": importe_total
+            })
+            return {"filas": filas}
+
+        # Cola offline: send_proforma consulta el monitor de conectividad (sin sondeo por factura)
+        use_offline = ctx["config"].offline_mode
+        # Obtener api_email y api_url del DataFrame si están disponibles
+        api_email_from_df = frow.get("api_email", None)
+        api_url_from_df = frow.get("api_url", None)
+        journal = ctx.get("journal")
+        if journal is not None:
+            journal.start(external_id_to_send, empresa)
+        return {
+            "envio": {
+                "xml_content": xml_bytes,
+                "api_key": api_key,
+                "external_id": external_id_to_send,
+                "empresa": empresa,
+                "ejercicio": ejercicio,
+                "cliente_numero_documento": cliente_doc,
+                "api_email": api_email_from_df,
+                "api_url": api_url_from_df,
+                "api_timeout": None,
+                "use_offline_queue": use_offline,
+                "config": ctx["config"],
+                "limiter": ctx.get("limiter"),
+            },
+            "frow": frow,
+            "num": num,
+            "empresa": empresa,
+            "base_external_id": base_external_id,
+            "external_id": external_id_to_send,
+            "importe_total": importe_total,
+            "xml_hash": xml_hash,
+            "journal": journal,
+        }
+    except (OverflowError, OSError) as timestamp_err:
+        log(f"❌ ERROR DE TIMESTAMP capturado en bloque principal: {timestamp_err}")
+        log(f"❌ Tipo de error: {type(timestamp_err).__name__}")
+        import traceback
+        log(f"❌ Traceback completo:\n{traceback.format_exc()}")
+        return {"filas": [_fila_error_generacion(frow, num, empresa, importe_total, external_id_to_send,
+                                                 base_external_id, f"Error de timestamp: {timestamp_err}")]}
+    except Exception as e:
+        log(f"❌ ERROR GENERAL capturado: {e}")
+        log(f"❌ Tipo de error: {type(e).__name__}")
+        import traceback
+        log(f"❌ Traceback completo:\n{traceback.format_exc()}")
+        return {"filas": [_fila_error_generacion(frow, num, empresa, importe_total, external_id_to_send,
+                                                 base_external_id, str(e))]}
+
+
+def _fila_error_generacion(frow, num, empresa, importe_total, external_id, base_external_id, details):
+    return {
+        "id": num,
+        "empresa": empresa,
+        "status": "ERROR_GENERACION_XML",
+        "details": details,
+        "pdf_url": None,
+        "cliente": frow.get("cliente_nombre",""),
+        "importe": importe_total,
+        "external_id": external_id,
+        "num_original": base_external_id,
+    }
+
+
+def _filas_envio(trabajo, result):
+    """Filas de resumen a partir del trabajo de envío y el summary devuelto por send_proforma."""
+    frow = trabajo["frow"]
+    num = trabajo["num"]
+    empresa = trabajo["empresa"]
+    base_external_id = trabajo["base_external_id"]
+    external_id_to_send = trabajo["external_id"]
+    importe_total = trabajo["importe_total"]
+
+    filas = []
+    details_json = result.get("details", {})
+    procs = []
+    numeros_facturas = {}
+    if isinstance(details_json, dict):
+        procs = details_json.get("proformas_procesadas", [])
+        numeros_facturas = details_json.get("numeros_facturas", {})
+        if not isinstance(numeros_facturas, dict):
+            numeros_facturas = {}
+    assigned_number = numeros_facturas.get(external_id_to_send)
+    if procs:
+        for pr in procs:
+            pdf_url = pr.get("pdf", result.get("pdf_url"))
+            # [NUEVO] Obtener enlace QR si está disponible
+            enlace_qr = None
+            if result.get("enlaces_qr") and pr.get("external_id"):
+                enlace_qr = result.get("enlaces_qr", {}).get(pr.get("external_id"))
+            elif result.get("enlace_qr"):
+                enlace_qr = result.get("enlace_qr")
+
+            numero_factura_api = pr.get("numero_factura") or numeros_facturas.get(pr.get("external_id"))
+            if not numero_factura_api:
+                numero_factura_api = assigned_number
+
+            filas.append({
+                "id": base_external_id,
+                "empresa": empresa,
+                "status": pr.get("status","ERROR").upper(),
+                "details": pr.get("message",""),
+                "pdf_url": pdf_url,
+                "enlace_qr": enlace_qr,  # [NUEVO] Enlace QR tributario
+                "cliente": frow.get("cliente_nombre",""), 
+                "importe": importe_total,  # <-- INCLUIR IMPORTE EN TODOS LOS CASOS
+                "external_id": pr.get("external_id", external_id_to_send),
+                "num_original": base_external_id,
+                "numero_asignado": numero_factura_api,
+            })
+    else:
+        # [NUEVO] Obtener enlace QR si está disponible
+        enlace_qr = None
+        if result.get("enlaces_qr") and num:
+            enlace_qr = result.get("enlaces_qr", {}).get(num)
+        elif result.get("enlace_qr"):
+            enlace_qr = result.get("enlace_qr")
+
+        filas.append({
+            "id": num,
+            "empresa": empresa,
+            "status": result.get("status","ERROR").upper(),
+            "details": result.get("details",""),
+            "pdf_url": result.get("pdf_url"),
+            "enlace_qr": enlace_qr,  # [NUEVO] Enlace QR tributario
+            "cliente": frow.get("cliente_nombre",""),
+            "importe": importe_total,  # <-- INCLUIR IMPORTE EN TODOS LOS CASOS
+            "external_id": external_id_to_send,
+            "num_original": base_external_id,
+            "numero_asignado": assigned_number,
+        })
+    return filas
+
+
+def _completar_factura(trabajo, result=None, error=None):
+    """Convierte el resultado del envío (o el error que lo interrumpió) en filas de resumen."""
+    filas = None
+    if error is None:
+        try:
+            filas = _filas_envio(trabajo, result)
+        except Exception as e:
+            error = e
+    if filas is None:
+        import traceback
+        prefix = "Error de timestamp: " if isinstance(error, (OverflowError, OSError)) else ""
+        log(f"❌ ERROR GENERAL capturado: {error}")
+        log(f"❌ Tipo de error: {type(error).__name__}")
+        log(f"❌ Traceback completo:\n{''.join(traceback.format_exception(error))}")
+        filas = [_fila_error_generacion(trabajo["frow"], trabajo["num"], trabajo["empresa"], trabajo["importe_total"],
+                                        trabajo["external_id"], trabajo["base_external_id"], f"{prefix}{error}")]
+    journal = trabajo.get("journal")
+    if journal is not None:
+        journal.finish(trabajo["external_id"], trabajo["empresa"], filas, result if error is None else str(error))
+    return filas
+
+
+def _procesar_factura(frow, ctx):
+    """Genera, valida y envía una factura de la Macro. Devuelve las filas de resumen que produce."""
+    trabajo = _preparar_factura(frow, ctx)
+    if "filas" in trabajo:
+        return trabajo["filas"]
+    try:
+        result = send_proforma(**trabajo["envio"])
+    except Exception as e:
+        return _completar_factura(trabajo, error=e)
+    return _completar_factura(trabajo, result)
+
+
+def _procesar_facturas_por_lotes(filas_factura, ctx, tamano):
+    """
+    Envío por lotes: cada carril (empresa) toma tandas de hasta tamano facturas
+    consecutivas, genera sus XML y envía juntas las que comparten ejercicio,
+    API Key y URL con send_proforma_batch.
+    """
+    tandas = send_engine.chunk_lanes(filas_factura, lambda frow: frow["empresa_emisora"], tamano)
+    filas_por_factura = [None] * len(filas_factura)
+
+    def _clave_envio(envio):
+        return (envio["ejercicio"], envio["api_key"], envio.get("api_url"), envio.get("api_email"))
+
+    def _procesar_tanda(indices):
+        trabajos = []
+        for idx in indices:
+            trabajo = _preparar_factura(filas_factura[idx], ctx)
+            if "filas" in trabajo:
+                filas_por_factura[idx] = trabajo["filas"]
+            else:
+                trabajos.append((idx, trabajo))
+        # Grupos consecutivos que pueden compartir petición
+        grupos = []
+        for idx, trabajo in trabajos:
+            if grupos and _clave_envio(grupos[-1][-1][1]["envio"]) == _clave_envio(trabajo["envio"]):
+                grupos[-1].append((idx, trabajo))
+            else:
+                grupos.append([(idx, trabajo)])
+        for grupo in grupos:
+            try:
+                resultados = send_proforma_batch([trabajo["envio"] for _, trabajo in grupo])
+            except Exception as e:
+                for idx, trabajo in grupo:
+                    filas_por_factura[idx] = _completar_factura(trabajo, error=e)
+                continue
+            for (idx, trabajo), result in zip(grupo, resultados):
+                filas_por_factura[idx] = _completar_factura(trabajo, result)
+
+    log(f"📦 Envío por lotes de hasta {tamano} proformas por petición.")
+    send_engine.run_lanes(
+        tandas,
+        key_func=lambda indices: filas_factura[indices[0]]["empresa_emisora"],
+        process_func=_procesar_tanda,
+        max_workers=ctx["config"].send_workers,
+    )
+    return filas_por_factura
+
+
+def _procesar_facturas_pipeline(filas_factura, ctx, procesos):
+    """
+    Pipeline por etapas: un pool de procesos genera y valida los XML mientras
+    los carriles por empresa guardan, envían y resumen los que ya están listos.
+    """
+    overrides = ctx["rectificativas_overrides"]
+    datos_facturas = [_datos_factura(frow, ctx) for frow in filas_factura]
+    total = len(datos_facturas)
+    hechas = [0]
+
+    def _args(datos):
+        if "filas" in datos:
+            return None
+        key = datos["key_override"]
+        solo_esta = {key: dict(overrides[key])} if key in overrides else None
+        return datos["xml_args"], solo_esta
+
+    def _finalizar(datos, obtener_xml):
+        trabajo = _preparar_factura(datos["frow"], ctx, datos=datos, obtener_xml=obtener_xml)
+        if "filas" in trabajo:
+            return trabajo["filas"]
+        try:
+            result = send_proforma(**trabajo["envio"])
+        except Exception as e:
+            return _completar_factura(trabajo, error=e)
+        return _completar_factura(trabajo, result)
+
+    def _progreso(_idx, _filas):
+        hechas[0] += 1
+        if hechas[0] % 25 == 0 or hechas[0] == total:
+            log(f"📊 Facturas procesadas: {hechas[0]}/{total}")
+
+    log(f"⚙️ Generando XML en {procesos} procesos en paralelo con los envíos.")
+    return send_engine.run_staged(
+        datos_facturas,
+        key_func=lambda datos: datos["empresa"],
+        build_args=_args,
+        build_func=_construir_xml_en_proceso,
+        finish_func=_finalizar,
+        processes=procesos,
+        max_workers=ctx["config"].send_workers,
+        on_result=_progreso,
+    )
+
+
+def _procesar_facturas_async(filas_factura, ctx):
+    """Transporte asíncrono: prepara todas las facturas y las envía en un lote httpx desde este hilo."""
+    trabajos = [_preparar_factura(frow, ctx) for frow in filas_factura]
+    pendientes = [t for t in trabajos if "filas" not in t]
+    resultados = iter(run_async_batch([t["envio"] for t in pendientes], max_in_flight=ctx["config"].async_in_flight))
+    return [t["filas"] if "filas" in t else _completar_factura(t, next(resultados)) for t in trabajos]
+
+
+def main(df_factura_historico=None, df_conceptos_historico=None, rectificativas_overrides=None, resume=None):
+    """
+    Lee la Macro, genera y envía todas las proformas y guarda responses/summary.json.
+
+    Con resume=True (por defecto FACTUNABO_RESUME=1) no se reenvían las
+    facturas que el diario de envíos ya tiene confirmadas de una ejecución
+    anterior interrumpida.
+
+    Si nadie ha abierto antes un perfilador (batch_profiler), al terminar se
+    escribe responses/perf_report.json con los tiempos por etapa del lote.
+    """
+    propio = batch_profiler.active() is None and batch_profiler.start() is not None
+    try:
+        _main(df_factura_historico, df_conceptos_historico, rectificativas_overrides, resume)
+    finally:
+        xsd_validator.flush_verdicts()
+        if propio:
+            informe_tiempos(RESPONSE_DIR)
+
+
+def informe_tiempos(directory=RESPONSE_DIR):
+    """Cierra el perfilador del lote, guarda el informe JSON y lo resume en el log."""
+    try:
+        informe = batch_profiler.finish(directory)
+    except Exception as e:
+        log(f"⚠️ No se pudo guardar el informe de tiempos: {e}")
+        return None
+    for linea in batch_profiler.summary_lines(informe):
+        log(linea)
+    return informe
+
+
+def _main(df_factura_historico, df_conceptos_historico, rectificativas_overrides, resume):
     excel_path = os.environ.get("EXCEL_PATH", "Resumen FRAs 2025 aBalados Services_macro.xlsm")
     if not os.path.exists(excel_path):
         log(f"🔥 ERROR: No se encuentra el Excel: {excel_path}")
@@ -1342,14 +2261,13 @@ def main(df_factura_historico=None, df_conceptos_historico=None, rectificativas_
     try:
         base_dir = os.path.dirname(excel_path)
 
-        (
-            df_factura, df_conceptos, df_forma_pago, df_conceptos_texto,
-            df_factura_historico_leido, df_conceptos_historico_leido
-        ) = macro_adapter.adapt_from_macro(excel_path)
+        with batch_profiler.span("lectura"):
+            (
+                df_factura, df_conceptos, df_forma_pago, df_conceptos_texto, _historial
+            ) = macro_adapter.adapt_from_macro(excel_path, lazy_history=True)
 
-        # Priorizar los dataframes pasados como argumentos (desde el worker)
-        df_factura_historico = df_factura_historico if df_factura_historico is not None else df_factura_historico_leido
-        df_conceptos_historico = df_conceptos_historico if df_conceptos_historico is not None else df_conceptos_historico_leido
+        # El historial (el del libro o el que pasa el worker) no se consulta al generar
+        # los XML, así que no se lee ni se agrupa.
         # --- [FIN MODIFICADO] ---
 
         # Normalizar SOLO la clave 'empresa_emisora' en todos los DFs para que casen los filtros
@@ -1364,315 +2282,58 @@ def main(df_factura_historico=None, df_conceptos_historico=None, rectificativas_
         if df_conceptos_texto is not None and not df_conceptos_texto.empty:
             df_conceptos_texto.columns = df_conceptos_texto.columns.str.strip()
         df_factura["api_key"] = df_factura["api_key"].fillna("")
+        # Importes por línea calculados una sola vez para todo el lote (resumen y XML)
+        df_conceptos = invoice_totals.add_line_amounts(df_conceptos)
 
         if rectificativas_overrides is None:
             rectificativas_overrides = {}
 
-        summary_data = []
-        for _, frow in df_factura.iterrows():
-            num, empresa = frow["NumFactura"], frow["empresa_emisora"]
-            ejercicio, cliente_doc, api_key = frow["ejercicio"], frow["cliente_numero_documento"], frow["api_key"]
-            key_override = _rectificativa_key(num, empresa)
-            override_entry = rectificativas_overrides.get(key_override) if rectificativas_overrides else None
-            tipo_override = ""
-            if override_entry and override_entry.get("tipo_factura"):
-                tipo_override = str(override_entry.get("tipo_factura") or "").upper()
-            tipo_row = str(frow.get("tipo_factura", "") or "").upper()
-            effective_tipo = tipo_override or tipo_row
-
-            base_external_id = _norm_invoice_id(num)
-            external_id_to_send = base_external_id
-            is_rectificativa = effective_tipo.startswith("R")
-            if is_rectificativa:
-                if override_entry is None:
-                    override_entry = rectificativas_overrides.setdefault(key_override, {})
-                desired_external = f"R{base_external_id}"
-                stored_external = str(override_entry.get("__external_id", "")).strip()
-                if stored_external:
-                    external_id_to_send = stored_external
-                else:
-                    # Intentar usar R{numero}; si excede 60 caracteres recortamos por la izquierda
-                    if len(desired_external) > 60:
-                        desired_external = desired_external[-60:]
-                    override_entry["__external_id"] = desired_external
-                    log(f"ℹ️ External ID rectificativa asignado para {base_external_id}: {desired_external}")
-                    external_id_to_send = desired_external
-            elif override_entry and override_entry.get("__external_id"):
-                external_id_to_send = str(override_entry["__external_id"])
-
-            if not api_key:
-                # --- CALCULAR IMPORTE PARA ERROR_SIN_API_KEY ---
-                try:
-                    df_tmp = df_conceptos[(df_conceptos["NumFactura"] == num) & (df_conceptos["empresa_emisora"] == empresa)].copy()
-                    df_tmp["__base"] = df_tmp["unidades"].fillna(0) * df_tmp["base_unidad"].fillna(0)
-                    df_tmp["__iva"] = df_tmp["__base"] * (df_tmp["porcentaje"].fillna(0) / 100.0)
-                    def _ret_row(r):
-                        try:
-                            p = float(r.get("porcentaje_retenido", 0.0) or 0.0)
-                            if p <= 0:
-                                return 0.0
-                            return float(r["__base"]) * (p/100.0)
-                        except Exception:
-                            return 0.0
-                    df_tmp["__ret"] = df_tmp.apply(_ret_row, axis=1)
-                    total_lineas = float((df_tmp["__base"] + df_tmp["__iva"] - df_tmp["__ret"]).sum())
-                    suplidos = float(frow.get("total_suplidos", 0.0) or 0.0)
-                    importe_total = round(total_lineas + suplidos, 2)
-                except Exception:
-                    importe_total = 0.0
-                # --- FIN cálculo importe ---
-                
-                summary_data.append({
-                    "id": num,
-                    "empresa": empresa,
-                    "status": "ERROR_SIN_API_KEY",
-                    "details": "Falta API Key",
-                    "pdf_url": None,
-                    "cliente": frow.get("cliente_nombre",""),
-                    "importe": importe_total,
-                    "external_id": external_id_to_send,
-                    "num_original": base_external_id,
-                })
-                continue
-
-            df_f_single = pd.DataFrame([frow])
-            df_c_single = df_conceptos[(df_conceptos["NumFactura"] == num) & (df_conceptos["empresa_emisora"] == empresa)]
-            df_fp_single = df_forma_pago[(df_forma_pago["NumFactura"] == num) & (df_forma_pago["empresa_emisora"] == empresa)]
-            df_txt_single = pd.DataFrame(columns=["NumFactura","empresa_emisora","descripcion","posicion"])
-            if df_conceptos_texto is not None and not df_conceptos_texto.empty:
-                df_txt_single = df_conceptos_texto[(df_conceptos_texto["NumFactura"] == num) & (df_conceptos_texto["empresa_emisora"] == empresa)].copy()
-
-            # --- Calcular importe total para guardar en summary.json ---
-            try:
-                df_tmp = df_c_single.copy()
-                df_tmp["__base"] = df_tmp["unidades"].fillna(0) * df_tmp["base_unidad"].fillna(0)
-                df_tmp["__iva"] = df_tmp["__base"] * (df_tmp["porcentaje"].fillna(0) / 100.0)
-                def _ret_row(r):
-                    try:
-                        p = float(r.get("porcentaje_retenido", 0.0) or 0.0)
-                        if p <= 0:
-                            return 0.0
-                        return float(r["__base"]) * (p/100.0)
-                    except Exception:
-                        return 0.0
-                df_tmp["__ret"] = df_tmp.apply(_ret_row, axis=1)
-                total_lineas = float((df_tmp["__base"] + df_tmp["__iva"] - df_tmp["__ret"]).sum())
-                suplidos = float(frow.get("total_suplidos", 0.0) or 0.0)
-                importe_total = round(total_lineas + suplidos, 2)
-            except Exception:
-                importe_total = 0.0
-            # --- FIN cálculo importe ---
-
-
-            try:
-                # --- [MODIFICADO] Combinar datos actuales e históricos para la búsqueda ---
-                df_factura_busqueda = pd.concat([df_factura, df_factura_historico], ignore_index=True) if df_factura_historico is not None else df_factura
-                df_conceptos_busqueda = pd.concat([df_conceptos, df_conceptos_historico], ignore_index=True) if df_conceptos_historico is not None else df_conceptos
-
-                try:
-                    xml_bytes = create_xml_from_data(
-                        df_f_single, df_c_single, df_fp_single, df_txt_single,
-                        df_factura_all=df_factura_busqueda, df_conceptos_all=df_conceptos_busqueda,
-                        rectificativas_overrides=rectificativas_overrides,
-                    )
-                except (OverflowError, OSError) as timestamp_err:
-                    log(f"❌ ERROR DE TIMESTAMP en create_xml_from_data: {timestamp_err}")
-                    log(f"❌ Tipo de error: {type(timestamp_err).__name__}")
-                    import traceback
-                    log(f"❌ Traceback completo:\n{traceback.format_exc()}")
-                    raise
-                # --- [FIN MODIFICADO] ---
-
-                # Guardar XML
-                try:
-                    empresa_safe = str(empresa).replace(" ", "_").replace(".", "")
-                    # IDs sin ".0"
-                    num_str = str(external_id_to_send)
-                    try:
-                        fnum = float(num_str)
-                        if fnum.is_integer():
-                            num_str = str(int(fnum))
-                    except Exception:
-                        pass
-                    num_safe = num_str.replace("/", "_")
-                    stamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                    xml_filename_logs = os.path.join(LOG_DIR, f"{empresa_safe}_proforma_{num_safe}_{stamp}.xml")
-                    xml_filename_resp = os.path.join(RESPONSE_DIR, f"xml_{num_safe}_{stamp}.xml")
-                    with open(xml_filename_logs, "wb") as f:
-                        f.write(xml_bytes)
-                    with open(xml_filename_resp, "wb") as f:
-                        f.write(xml_bytes)
-                    log(f"💾 XML guardado en: {xml_filename_logs}")
-                    log(f"💾 XML copiado en: {xml_filename_resp}")
-                except Exception as io_err:
-                    log(f"⚠️ No se pudo guardar el XML: {io_err}")
-
-                # Validación XSD previa al envío
-                try:
-                    validate_xml_against_xsd(xml_bytes)
-                except (OverflowError, OSError) as timestamp_err:
-                    log(f"❌ ERROR DE TIMESTAMP en validacion XSD: {timestamp_err}")
-                    log(f"❌ Tipo de error: {type(timestamp_err).__name__}")
-                    import traceback
-                    log(f"❌ Traceback completo:\n{traceback.format_exc()}")
-                    summary_data.append({
-                        "id": num,
-                        "empresa": empresa,
-                        "status": "ERROR_VALIDACION_XSD",
-                        "details": f"Error de timestamp en validación XSD: {timestamp_err}",
-                        "pdf_url": None,
-                        "cliente": frow.get("cliente_nombre",""),
-                        "importe": importe_total
-                    })
-                    continue
-                except Exception as xsd_err:
-                    log(f"❌ ERROR en validacion XSD: {xsd_err}")
-                    log(f"❌ Tipo de error: {type(xsd_err).__name__}")
-                    import traceback
-                    log(f"❌ Traceback completo:\n{traceback.format_exc()}")
-                    summary_data.append({
-                        "id": num,
-                        "empresa": empresa,
-                        "status": "ERROR_VALIDACION_XSD",
-                        "details": str(xsd_err),
-                        "pdf_url": None,
-                        "cliente": frow.get("cliente_nombre",""),
-                        "importe": importe_total
-                    })
-                    continue
-
-                # [NUEVO] Procesamiento paralelo: preparar datos para envío
-                invoice_data = {
-                    "xml_bytes": xml_bytes,
-                    "api_key": api_key,
-                    "num": num,
-                    "external_id": external_id_to_send,
-                    "empresa": empresa,
-                    "ejercicio": ejercicio,
-                    "cliente_doc": cliente_doc,
-                    "importe_total": importe_total,
-                    "cliente": frow.get("cliente_nombre", ""),
-                    "frow": frow
-                }
-                # [NUEVO] Verificar si hay conexión antes de enviar
-                import requests
-                has_connection = False
-                try:
-                    # Usar un timeout seguro y validado
-                    safe_timeout = 5
-                    if safe_timeout < 1:
-                        safe_timeout = 1
-                    elif safe_timeout > 300:
-                        safe_timeout = 300
-                    requests.get("https://www.facturantia.com", timeout=safe_timeout)
-                    has_connection = True
-                except:
-                    has_connection = False
-                
-                # Enviar con cola offline si no hay conexión
-                use_offline = os.environ.get("USE_OFFLINE_QUEUE", "0") == "1"
-                # Obtener api_email y api_url del DataFrame si están disponibles
-                api_email_from_df = frow.get("api_email", None)
-                api_url_from_df = frow.get("api_url", None)
-                try:
-                    result = send_proforma(xml_bytes, api_key, external_id_to_send, empresa, ejercicio, cliente_doc,
-                                         api_email=api_email_from_df, api_url=api_url_from_df, api_timeout=None,
-                                         use_offline_queue=(use_offline and not has_connection))
-                except (OverflowError, OSError) as timestamp_err:
-                    log(f"❌ ERROR DE TIMESTAMP en send_proforma: {timestamp_err}")
-                    log(f"❌ Tipo de error: {type(timestamp_err).__name__}")
-                    import traceback
-                    log(f"❌ Traceback completo:\n{traceback.format_exc()}")
-                    raise
-                details_json = result.get("details", {})
-                procs = []
-                numeros_facturas = {}
-                if isinstance(details_json, dict):
-                    procs = details_json.get("proformas_procesadas", [])
-                    numeros_facturas = details_json.get("numeros_facturas", {})
-                    if not isinstance(numeros_facturas, dict):
-                        numeros_facturas = {}
-                assigned_number = numeros_facturas.get(external_id_to_send)
-                if procs:
-                    for pr in procs:
-                        pdf_url = pr.get("pdf", result.get("pdf_url"))
-                        # [NUEVO] Obtener enlace QR si está disponible
-                        enlace_qr = None
-                        if result.get("enlaces_qr") and pr.get("external_id"):
-                            enlace_qr = result.get("enlaces_qr", {}).get(pr.get("external_id"))
-                        elif result.get("enlace_qr"):
-                            enlace_qr = result.get("enlace_qr")
-                        
-                        numero_factura_api = pr.get("numero_factura") or numeros_facturas.get(pr.get("external_id"))
-                        if not numero_factura_api:
-                            numero_factura_api = assigned_number
-
-                        summary_data.append({
-                            "id": base_external_id,
-                            "empresa": empresa,
-                            "status": pr.get("status","ERROR").upper(),
-                            "details": pr.get("message",""),
-                            "pdf_url": pdf_url,
-                            "enlace_qr": enlace_qr,  # [NUEVO] Enlace QR tributario
-                            "cliente": frow.get("cliente_nombre",""), 
-                            "importe": importe_total,  # <-- INCLUIR IMPORTE EN TODOS LOS CASOS
-                            "external_id": pr.get("external_id", external_id_to_send),
-                            "num_original": base_external_id,
-                            "numero_asignado": numero_factura_api,
-                        })
-                else:
-                    # [NUEVO] Obtener enlace QR si está disponible
-                    enlace_qr = None
-                    if result.get("enlaces_qr") and num:
-                        enlace_qr = result.get("enlaces_qr", {}).get(num)
-                    elif result.get("enlace_qr"):
-                        enlace_qr = result.get("enlace_qr")
-                    
-                    summary_data.append({
-                        "id": num,
-                        "empresa": empresa,
-                        "status": result.get("status","ERROR").upper(),
-                        "details": result.get("details",""),
-                        "pdf_url": result.get("pdf_url"),
-                        "enlace_qr": enlace_qr,  # [NUEVO] Enlace QR tributario
-                        "cliente": frow.get("cliente_nombre",""),
-                        "importe": importe_total,  # <-- INCLUIR IMPORTE EN TODOS LOS CASOS
-                        "external_id": external_id_to_send,
-                        "num_original": base_external_id,
-                        "numero_asignado": assigned_number,
-                    })
-            except (OverflowError, OSError) as timestamp_err:
-                log(f"❌ ERROR DE TIMESTAMP capturado en bloque principal: {timestamp_err}")
-                log(f"❌ Tipo de error: {type(timestamp_err).__name__}")
-                import traceback
-                log(f"❌ Traceback completo:\n{traceback.format_exc()}")
-                summary_data.append({
-                    "id": num,
-                    "empresa": empresa,
-                    "status": "ERROR_GENERACION_XML",
-                    "details": f"Error de timestamp: {timestamp_err}",
-                    "pdf_url": None,
-                    "cliente": frow.get("cliente_nombre",""),
-                    "importe": importe_total,
-                    "external_id": external_id_to_send,
-                    "num_original": base_external_id,
-                })
-            except Exception as e:
-                log(f"❌ ERROR GENERAL capturado: {e}")
-                log(f"❌ Tipo de error: {type(e).__name__}")
-                import traceback
-                log(f"❌ Traceback completo:\n{traceback.format_exc()}")
-                summary_data.append({
-                    "id": num,
-                    "empresa": empresa,
-                    "status": "ERROR_GENERACION_XML",
-                    "details": str(e),
-                    "pdf_url": None,
-                    "cliente": frow.get("cliente_nombre",""),
-                    "importe": importe_total,
-                    "external_id": external_id_to_send,
-                    "num_original": base_external_id,
-                })
+        # Configuración de envío leída una sola vez para todo el lote
+        config = runtime_config.reload()
+
+        if resume is None:
+            resume = send_journal.resume_default()
+        journal = send_journal.open_journal()
+        if resume and journal is not None:
+            log(f"↩️ Reanudando lote: diario de envíos {journal.stats()}")
+
+        # El transporte asíncrono tiene su propio tope de peticiones en vuelo
+        limiter = None if config.async_transport else config.new_limiter(log_func=log)
+
+        ctx = {
+            "config": config,
+            "limiter": limiter,
+            "journal": journal,
+            "resume": bool(resume),
+            "df_factura": df_factura,
+            "df_conceptos": df_conceptos,
+            "rectificativas_overrides": rectificativas_overrides,
+            "index": invoice_index.InvoiceIndex(df_conceptos, df_forma_pago, df_conceptos_texto),
+            "totals": invoice_totals.InvoiceTotals(df_conceptos),
+        }
+        filas_factura = [frow for _, frow in df_factura.iterrows()]
+        procesos = send_engine.get_build_processes(len(filas_factura))
+        try:
+            tamano_lote = config.batch_size
+            if config.async_transport:
+                filas_por_factura = _procesar_facturas_async(filas_factura, ctx)
+            elif tamano_lote > 1:
+                filas_por_factura = _procesar_facturas_por_lotes(filas_factura, ctx, tamano_lote)
+            elif procesos:
+                filas_por_factura = _procesar_facturas_pipeline(filas_factura, ctx, procesos)
+            else:
+                filas_por_factura = send_engine.run_lanes(
+                    filas_factura,
+                    key_func=lambda frow: frow["empresa_emisora"],
+                    process_func=lambda frow: _procesar_factura(frow, ctx),
+                    max_workers=config.send_workers,
+                )
+        finally:
+            if journal is not None:
+                journal.close()
+            if limiter is not None:
+                log(f"🎚️ Concurrencia adaptativa al terminar: {limiter.stats()}")
+        summary_data = [fila for filas in filas_por_factura for fila in filas]
 
     except Exception as e:
         log(f"❌ Error general: {e}")
@@ -1687,9 +2348,10 @@ def main(df_factura_historico=None, df_conceptos_historico=None, rectificativas_
     # --- Post-proceso en Macro: marcar o borrar filas ---
     try:
         post_action = os.environ.get("POST_MACRO_ACTION", "MARK").upper()
-        mark_rows_in_macro(excel_path, summary_data, estado_col=COL_ESTADO, keep_vba=True)
-        if post_action == "DELETE_OK":
-            delete_ok_rows_in_macro(excel_path, summary_data, keep_vba=True)
+        with batch_profiler.span("macro"):
+            mark_rows_in_macro(excel_path, summary_data, estado_col=COL_ESTADO, keep_vba=True)
+            if post_action == "DELETE_OK":
+                delete_ok_rows_in_macro(excel_path, summary_data, keep_vba=True)
         log(f"🧾 Post-proceso Excel Macro completado ({post_action}).")
     except Exception as e:
         log(f"⚠️ No se pudo actualizar Macro: {e}")
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""
+Módulo con la configuración de envío en una instantánea inmutable (sin Qt).
+
+Antes cada send_proforma importaba PySide6, abría config.ini con QSettings y
+volvía a interpretar api/timeout. Ahora config.ini (mismo fichero y formato
+INI que AppSettings) y las variables FACTUNABO_* se leen una vez por lote en
+un RuntimeConfig que prueba.main pasa a los envíos; la interfaz llama a
+reload() cuando se guarda la configuración o cambia el modo offline.
+
+Uso:
+    config = runtime_config.get()      # instantánea vigente (se carga la primera vez)
+    config = runtime_config.reload()   # vuelve a leer config.ini y el entorno
+"""
+import configparser
+import logging
+import os
+import sys
+import threading
+from dataclasses import dataclass
+from typing import Optional
+
+import send_engine
+
+logger = logging.getLogger("runtime_config")
+
+CONFIG_FILENAME = "config.ini"
+DEFAULT_API_URL = "https://www.facturantia.com/API/proformas_receptor.php"
+DEFAULT_USER_EMAIL = "facturacion@abalados.es"
+DEFAULT_TIMEOUT = 100
+MIN_TIMEOUT = 1
+MAX_TIMEOUT = 300
+
+
+@dataclass(frozen=True)
+class RuntimeConfig:
+    """Valores de envío ya validados; no cambia durante un lote."""
+
+    api_timeout: int = DEFAULT_TIMEOUT
+    api_url: str = DEFAULT_API_URL
+    user_email: str = DEFAULT_USER_EMAIL
+    offline_mode: bool = False
+    concurrency: int = send_engine.DEFAULT_CONCURRENCY
+    adaptive_concurrency: bool = False
+    concurrency_min: int = 1
+    concurrency_max: int = send_engine.DEFAULT_ADAPTIVE_MAX
+    latency_target: Optional[float] = None
+    async_in_flight: int = send_engine.DEFAULT_ASYNC_IN_FLIGHT
+    batch_size: int = 1
+    async_transport: bool = False
+    source: str = ""
+
+    @property
+    def send_workers(self) -> int:
+        """Hilos de envío: concurrency, o hasta concurrency_max con límite adaptativo."""
+        if self.adaptive_concurrency:
+            return max(self.concurrency, self.concurrency_max)
+        return self.concurrency
+
+    def new_limiter(self, log_func=None) -> Optional[send_engine.AdaptiveLimiter]:
+        """Limitador AIMD para un lote (empieza en concurrency), o None si está desactivado."""
+        if not self.adaptive_concurrency:
+            return None
+        return send_engine.AdaptiveLimiter(
+            self.concurrency, self.concurrency_min, self.concurrency_max,
+            latency_target=self.latency_target, log_func=log_func,
+        )
+
+
+def config_path() -> str:
+    """Ruta de config.ini: junto al ejecutable o en la raíz del proyecto (como AppSettings)."""
+    if getattr(sys, "frozen", False):
+        app_dir = os.path.dirname(sys.executable)
+    else:
+        app_dir = os.path.dirname(os.path.abspath(__file__))
+    return os.path.join(app_dir, CONFIG_FILENAME)
+
+
+def normalize_timeout(value) -> int:
+    """
+    Timeout en segundos acotado a 1-300 (evita errores de PyTime_t).
+
+    Misma regla que se aplicaba en cada envío: fuera de 0-1000 se usa 100 y
+    entre 100 y 1000 se interpreta como milisegundos.
+    """
+    if value is None or value == "":
+        return DEFAULT_TIMEOUT
+    try:
+        timeout = float(value)
+    except (ValueError, TypeError):
+        return DEFAULT_TIMEOUT
+    if timeout > 1000 or timeout < 0:
+        logger.warning(f"⚠️ Timeout inválido: {value}. Usando {DEFAULT_TIMEOUT} segundos por defecto.")
+        timeout = DEFAULT_TIMEOUT
+    elif timeout > 100:
+        timeout = timeout / 1000.0
+    return max(MIN_TIMEOUT, min(MAX_TIMEOUT, int(timeout)))
+
+
+def _ini_value(parser: configparser.ConfigParser, key: str, default: str = "") -> str:
+    # QSettings guarda "api/timeout" como [api] timeout y las claves sin grupo en [General]
+    section, _, option = key.rpartition("/")
+    value = parser.get(section or "General", option, fallback=default)
+    value = str(value).strip()
+    if len(value) >= 2 and value[0] == value[-1] == '"':
+        value = value[1:-1]
+    return value
+
+
+def load(path: Optional[str] = None) -> RuntimeConfig:
+    """Lee config.ini y el entorno y devuelve una instantánea nueva (sin publicarla)."""
+    path = path or config_path()
+    parser = configparser.ConfigParser(interpolation=None)
+    parser.optionxform = str
+    try:
+        parser.read(path, encoding="utf-8")
+    except (configparser.Error, OSError, UnicodeDecodeError) as e:
+        logger.warning(f"No se pudo leer {path}: {e}")
+
+    offline_env = os.environ.get("USE_OFFLINE_QUEUE")
+    if offline_env is not None:
+        offline_mode = offline_env.strip() == "1"
+    else:
+        offline_mode = _ini_value(parser, "offline_mode", "0") == "1"
+
+    concurrency_min, concurrency_max = send_engine.get_concurrency_bounds()
+    return RuntimeConfig(
+        api_timeout=normalize_timeout(_ini_value(parser, "api/timeout", str(DEFAULT_TIMEOUT))),
+        api_url=_ini_value(parser, "api/url") or DEFAULT_API_URL,
+        user_email=_ini_value(parser, "api/user") or DEFAULT_USER_EMAIL,
+        offline_mode=offline_mode,
+        concurrency=send_engine.get_concurrency(),
+        adaptive_concurrency=send_engine.use_adaptive_concurrency(),
+        concurrency_min=concurrency_min,
+        concurrency_max=concurrency_max,
+        latency_target=send_engine.get_latency_target(),
+        async_in_flight=send_engine.get_async_in_flight(),
+        batch_size=send_engine.get_batch_size(),
+        async_transport=send_engine.use_async_transport(),
+        source=path,
+    )
+
+
+_current: Optional[RuntimeConfig] = None
+_lock = threading.Lock()
+
+
+def get() -> RuntimeConfig:
+    """Instantánea vigente; la carga la primera vez."""
+    config = _current
+    if config is None:
+        with _lock:
+            config = _current
+            if config is None:
+                config = _publish(load())
+    return config
+
+
+def reload(path: Optional[str] = None) -> RuntimeConfig:
+    """Vuelve a leer la configuración y la publica (p. ej. tras ConfigDialog.save_settings)."""
+    with _lock:
+        return _publish(load(path))
+
+
+def _publish(config: RuntimeConfig) -> RuntimeConfig:
+    global _current
+    _current = config
+    return config
+
+
+__all__ = ["RuntimeConfig", "DEFAULT_API_URL", "DEFAULT_USER_EMAIL", "DEFAULT_TIMEOUT",
+           "config_path", "normalize_timeout", "load", "get", "reload"]
@@ -0,0 +1,415 @@
+# -*- coding: utf-8 -*-
+"""
+Módulo para procesar los envíos de facturas de forma concurrente.
+
+Las facturas se reparten en "carriles" por empresa emisora: dentro de cada
+carril se procesan en el orden original de la Macro (la numeración de cada
+emisor debe llegar ordenada a Facturantia) y los distintos carriles se
+ejecutan en paralelo.
+"""
+import math
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Deque, Dict, Iterable, List, Optional, Tuple
+
+DEFAULT_CONCURRENCY = 4
+MAX_CONCURRENCY = 32
+DEFAULT_ASYNC_IN_FLIGHT = 32
+DEFAULT_BUILD_PROCESSES = 4
+DEFAULT_PIPELINE_MIN_ITEMS = 50
+MAX_ASYNC_IN_FLIGHT = 256
+MAX_BATCH_SIZE = 50
+DEFAULT_ADAPTIVE_MAX = 16
+
+
+def get_concurrency() -> int:
+    """Número de carriles simultáneos (variable FACTUNABO_SEND_CONCURRENCY)."""
+    raw = os.getenv("FACTUNABO_SEND_CONCURRENCY", "").strip()
+    try:
+        value = int(raw) if raw else DEFAULT_CONCURRENCY
+    except ValueError:
+        value = DEFAULT_CONCURRENCY
+    return max(1, min(MAX_CONCURRENCY, value))
+
+
+def run_lanes(items: Iterable[Any], key_func: Callable[[Any], Any], process_func: Callable[[Any], Any],
+              max_workers: Optional[int] = None,
+              on_result: Optional[Callable[[int, Any], None]] = None) -> List[Any]:
+    """
+    Ejecuta process_func sobre cada elemento, agrupando por key_func.
+
+    Los elementos con la misma clave se procesan secuencialmente y en orden;
+    los grupos distintos se procesan en paralelo con hasta max_workers hilos.
+    Devuelve los resultados en el mismo orden que items. Si process_func lanza
+    una excepción, se propaga al terminar (como en el bucle secuencial).
+    """
+    items = list(items)
+    results: List[Any] = [None] * len(items)
+    if not items:
+        return results
+
+    lanes: Dict[Any, List[int]] = {}
+    for idx, item in enumerate(items):
+        lanes.setdefault(key_func(item), []).append(idx)
+
+    workers = max_workers if max_workers is not None else get_concurrency()
+    workers = max(1, min(workers, len(lanes)))
+
+    def _run_lane(indices: List[int]) -> None:
+        for idx in indices:
+            results[idx] = process_func(items[idx])
+            if on_result:
+                on_result(idx, results[idx])
+
+    if workers == 1:
+        # Sin paralelismo: mismo orden que el bucle clásico
+        _run_lane(list(range(len(items))))
+        return results
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="envio") as pool:
+        futures = [pool.submit(_run_lane, indices) for indices in lanes.values()]
+        for fut in futures:
+            fut.result()
+    return results
+
+
+def get_build_processes(n_items: int) -> int:
+    """
+    Procesos para generar y validar XML en paralelo (0 = sin pipeline).
+
+    FACTUNABO_BUILD_PROCESSES fija el número (0 desactiva; por defecto, núcleos
+    - 1 hasta 4). Sólo compensa arrancar procesos en lotes de al menos
+    FACTUNABO_PIPELINE_MIN_FACTURAS facturas (por defecto 50).
+    """
+    raw = os.getenv("FACTUNABO_BUILD_PROCESSES", "").strip()
+    try:
+        processes = int(raw) if raw else min(DEFAULT_BUILD_PROCESSES, max(1, (os.cpu_count() or 1) - 1))
+    except ValueError:
+        processes = 0
+    raw_min = os.getenv("FACTUNABO_PIPELINE_MIN_FACTURAS", "").strip()
+    try:
+        min_items = int(raw_min) if raw_min else DEFAULT_PIPELINE_MIN_ITEMS
+    except ValueError:
+        min_items = DEFAULT_PIPELINE_MIN_ITEMS
+    if processes < 2 or n_items < max(1, min_items):
+        return 0
+    return min(processes, MAX_CONCURRENCY)
+
+
+def run_staged(items: Iterable[Any], key_func: Callable[[Any], Any],
+               build_args: Callable[[Any], Optional[tuple]], build_func: Callable[..., Any],
+               finish_func: Callable[[Any, Callable[[], Any]], Any],
+               processes: int, max_workers: Optional[int] = None, max_pending: Optional[int] = None,
+               initializer: Optional[Callable[..., None]] = None, initargs: tuple = (),
+               on_result: Optional[Callable[[int, Any], None]] = None) -> List[Any]:
+    """
+    Pipeline en dos etapas conectadas por una cola acotada.
+
+    Etapa 1: un pool de procesos ejecuta build_func(*build_args(item)) para
+    cada elemento, en el orden de items y con como mucho max_pending trabajos
+    en cola o en curso (por defecto 2 por proceso). Si build_args devuelve
+    None el elemento no necesita esa etapa.
+
+    Etapa 2: los carriles de run_lanes llaman a finish_func(item, obtener),
+    donde obtener() espera y devuelve el resultado de la etapa 1 (o relanza su
+    excepción; None si el elemento no pasó por ella). Así la generación de
+    las siguientes facturas se solapa con los envíos en curso.
+    Devuelve los resultados de finish_func en el orden de items.
+    """
+    import multiprocessing
+    import threading
+    from concurrent.futures import Future, ProcessPoolExecutor
+
+    items = list(items)
+    pendientes: List[Future] = [Future() for _ in items]
+    if max_pending is None:
+        max_pending = processes * 2
+    slots = threading.BoundedSemaphore(max(1, max_pending))
+    ctx = multiprocessing.get_context("spawn")
+    pool = ProcessPoolExecutor(max_workers=processes, mp_context=ctx,
+                               initializer=initializer, initargs=initargs)
+    parar = threading.Event()
+
+    def _enlazar(origen: Future, destino: Future) -> None:
+        slots.release()
+        if origen.cancelled():
+            destino.cancel()
+        elif origen.exception() is not None:
+            destino.set_exception(origen.exception())
+        else:
+            destino.set_result(origen.result())
+
+    def _alimentar() -> None:
+        for idx, item in enumerate(items):
+            if parar.is_set():
+                pendientes[idx].cancel()
+                continue
+            try:
+                args = build_args(item)
+            except Exception as e:
+                pendientes[idx].set_exception(e)
+                continue
+            if args is None:
+                pendientes[idx].set_result(None)
+                continue
+            slots.acquire()
+            try:
+                fut = pool.submit(build_func, *args)
+            except Exception as e:
+                slots.release()
+                pendientes[idx].set_exception(e)
+                continue
+            fut.add_done_callback(lambda f, destino=pendientes[idx]: _enlazar(f, destino))
+
+    alimentador = threading.Thread(target=_alimentar, name="pipeline-xml", daemon=True)
+    alimentador.start()
+
+    def _finalizar(idx: int) -> Any:
+        return finish_func(items[idx], pendientes[idx].result)
+
+    try:
+        return run_lanes(
+            list(range(len(items))),
+            key_func=lambda idx: key_func(items[idx]),
+            process_func=_finalizar,
+            max_workers=max_workers,
+            on_result=on_result,
+        )
+    finally:
+        parar.set()
+        alimentador.join()
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+async def run_lanes_async(items: Iterable[Any], key_func: Callable[[Any], Any],
+                          coro_func: Callable[[Any], Awaitable[Any]],
+                          max_in_flight: Optional[int] = None) -> List[Any]:
+    """
+    Equivalente asíncrono de run_lanes para un único hilo.
+
+    Cada carril es una corrutina que procesa sus elementos en orden; un
+    semáforo limita a max_in_flight las llamadas a coro_func simultáneas.
+    """
+    import asyncio
+
+    items = list(items)
+    results: List[Any] = [None] * len(items)
+    if not items:
+        return results
+
+    lanes: Dict[Any, List[int]] = {}
+    for idx, item in enumerate(items):
+        lanes.setdefault(key_func(item), []).append(idx)
+
+    limit = max_in_flight if max_in_flight is not None else get_async_in_flight()
+    semaphore = asyncio.Semaphore(max(1, limit))
+
+    async def _run_lane(indices: List[int]) -> None:
+        for idx in indices:
+            async with semaphore:
+                results[idx] = await coro_func(items[idx])
+
+    await asyncio.gather(*(_run_lane(indices) for indices in lanes.values()))
+    return results
+
+
+def get_async_in_flight() -> int:
+    """Peticiones simultáneas del transporte asíncrono (FACTUNABO_ASYNC_IN_FLIGHT, por defecto 32)."""
+    raw = os.getenv("FACTUNABO_ASYNC_IN_FLIGHT", "").strip()
+    try:
+        value = int(raw) if raw else DEFAULT_ASYNC_IN_FLIGHT
+    except ValueError:
+        value = DEFAULT_ASYNC_IN_FLIGHT
+    return max(1, min(MAX_ASYNC_IN_FLIGHT, value))
+
+
+def use_async_transport() -> bool:
+    """True si FACTUNABO_TRANSPORT=async (envío con httpx desde un único hilo)."""
+    return os.getenv("FACTUNABO_TRANSPORT", "").strip().lower() == "async"
+
+
+def get_batch_size() -> int:
+    """Proformas por petición (FACTUNABO_BATCH_SIZE, por defecto 1 = una por petición, máximo 50)."""
+    raw = os.getenv("FACTUNABO_BATCH_SIZE", "").strip()
+    try:
+        value = int(raw) if raw else 1
+    except ValueError:
+        value = 1
+    return max(1, min(MAX_BATCH_SIZE, value))
+
+
+def chunk_lanes(items: Iterable[Any], key_func: Callable[[Any], Any], size: int) -> List[List[int]]:
+    """
+    Agrupa los índices de items en tandas de hasta size elementos consecutivos
+    de un mismo carril (misma clave), respetando el orden original.
+    """
+    lanes: Dict[Any, List[int]] = {}
+    for idx, item in enumerate(items):
+        lanes.setdefault(key_func(item), []).append(idx)
+    chunks: List[List[int]] = []
+    for indices in lanes.values():
+        for start in range(0, len(indices), max(1, size)):
+            chunks.append(indices[start:start + max(1, size)])
+    return chunks
+
+
+def _env_int(name: str, default: int) -> int:
+    raw = os.getenv(name, "").strip()
+    try:
+        return int(raw) if raw else default
+    except ValueError:
+        return default
+
+
+def use_adaptive_concurrency() -> bool:
+    """Límite de envíos en vuelo adaptativo (FACTUNABO_ADAPTIVE_CONCURRENCY=1; desactivado por defecto)."""
+    return os.getenv("FACTUNABO_ADAPTIVE_CONCURRENCY", "0").strip() == "1"
+
+
+def get_concurrency_bounds() -> Tuple[int, int]:
+    """Mínimo y máximo del límite adaptativo (FACTUNABO_CONCURRENCY_MIN/MAX, por defecto 1 y 16)."""
+    maximum = max(1, min(MAX_CONCURRENCY, _env_int("FACTUNABO_CONCURRENCY_MAX", DEFAULT_ADAPTIVE_MAX)))
+    minimum = max(1, min(maximum, _env_int("FACTUNABO_CONCURRENCY_MIN", 1)))
+    return minimum, maximum
+
+
+def get_latency_target() -> Optional[float]:
+    """p95 objetivo en segundos (FACTUNABO_LATENCY_TARGET_MS); None = el doble del mejor p95 observado."""
+    value = _env_int("FACTUNABO_LATENCY_TARGET_MS", 0)
+    return value / 1000.0 if value > 0 else None
+
+
+def is_overload_status(status_code: int) -> bool:
+    """Respuestas HTTP que indican que la API está saturada (429 y 5xx)."""
+    return status_code == 429 or status_code >= 500
+
+
+class AdaptiveLimiter:
+    """
+    Límite de peticiones en vuelo con AIMD (aumento aditivo, recorte multiplicativo).
+
+    Cada envío pide hueco con acquire() y lo devuelve con release() indicando
+    si hubo sobrecarga (timeout, error de conexión, 429 o 5xx). Tras una
+    "ronda" de respuestas sanas (tantas como el límite actual) con el p95 de
+    latencia por debajo del objetivo y pocos errores, el límite sube en 1 si
+    en esa ronda llegó a estar lleno (si no, subirlo no cambia nada); con
+    una sobrecarga se multiplica por decrease. Sólo se recorta una vez por
+    ronda: las peticiones que ya estaban en vuelo al recortar no vuelven a
+    recortar. El límite se mantiene entre minimum y maximum.
+    """
+
+    def __init__(self, initial: int, minimum: int = 1, maximum: int = MAX_CONCURRENCY,
+                 latency_target: Optional[float] = None, window: int = 50, max_error_rate: float = 0.05,
+                 decrease: float = 0.5, log_func: Optional[Callable[[str], None]] = None):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.latency_target = latency_target
+        self.max_error_rate = max_error_rate
+        self.decrease = decrease
+        self._log = log_func
+        self._cond = threading.Condition()
+        self._limit = max(self.minimum, min(self.maximum, initial))
+        self._in_flight = 0
+        self._latencies: Deque[float] = deque(maxlen=window)
+        self._overloads: Deque[int] = deque(maxlen=window)
+        self._healthy_since_change = 0
+        self._saturated = False
+        self._last_cut = 0.0
+        self._baseline: Optional[float] = None
+        self._peak = self._limit
+        self._floor = self._limit
+        self.changes = 0
+
+    @property
+    def limit(self) -> int:
+        return self._limit
+
+    def acquire(self) -> float:
+        """Espera a que haya hueco; devuelve el instante de salida para release()."""
+        with self._cond:
+            while self._in_flight >= self._limit:
+                self._cond.wait()
+            self._in_flight += 1
+            if self._in_flight >= self._limit:
+                self._saturated = True
+        return time.monotonic()
+
+    def release(self, started: float, overload: bool = False) -> None:
+        """Devuelve el hueco y anota la latencia y el resultado de la petición."""
+        latency = time.monotonic() - started
+        with self._cond:
+            self._in_flight -= 1
+            self._latencies.append(latency)
+            self._overloads.append(1 if overload else 0)
+            if overload:
+                if started >= self._last_cut:
+                    self._last_cut = time.monotonic()
+                    self._set_limit(int(self._limit * self.decrease), "sobrecarga")
+            else:
+                self._healthy_since_change += 1
+                if (self._saturated and self._healthy_since_change >= self._limit
+                        and self._limit < self.maximum and self._is_healthy()):
+                    self._set_limit(self._limit + 1, "latencia estable")
+            self._cond.notify_all()
+
+    def p95(self) -> Optional[float]:
+        """p95 de las últimas latencias (segundos), o None sin datos."""
+        if not self._latencies:
+            return None
+        ordered = sorted(self._latencies)
+        return ordered[max(0, math.ceil(0.95 * len(ordered)) - 1)]
+
+    def error_rate(self) -> float:
+        return sum(self._overloads) / len(self._overloads) if self._overloads else 0.0
+
+    def _is_healthy(self) -> bool:
+        if self.error_rate() > self.max_error_rate:
+            return False
+        p95 = self.p95()
+        if p95 is None:
+            return True
+        if len(self._latencies) >= 5 and (self._baseline is None or p95 < self._baseline):
+            self._baseline = p95
+        target = self.latency_target
+        if target is None:
+            if self._baseline is None:
+                return True
+            target = 2 * self._baseline
+        return p95 <= target
+
+    def _set_limit(self, value: int, motivo: str) -> None:
+        value = max(self.minimum, min(self.maximum, value))
+        self._healthy_since_change = 0
+        self._saturated = self._in_flight >= value
+        if value == self._limit:
+            return
+        anterior, self._limit = self._limit, value
+        self._peak = max(self._peak, value)
+        self._floor = min(self._floor, value)
+        self.changes += 1
+        if self._log:
+            p95 = self.p95()
+            self._log(f"🎚️ Concurrencia de envío {anterior} → {value} ({motivo}; "
+                      f"p95 {p95 * 1000 if p95 is not None else 0:.0f} ms, errores {self.error_rate():.0%})")
+
+    def stats(self) -> Dict[str, Any]:
+        """Estado actual para el log: límite, p95, tasa de errores y extremos alcanzados."""
+        with self._cond:
+            p95 = self.p95()
+            return {
+                "limite": self._limit,
+                "min_alcanzado": self._floor,
+                "max_alcanzado": self._peak,
+                "cambios": self.changes,
+                "p95_ms": round(p95 * 1000, 1) if p95 is not None else None,
+                "errores": round(self.error_rate(), 3),
+            }
+
+
+__all__ = ["DEFAULT_CONCURRENCY", "get_concurrency", "run_lanes", "get_build_processes", "run_staged",
+           "get_async_in_flight", "run_lanes_async", "use_async_transport", "get_batch_size", "chunk_lanes",
+           "use_adaptive_concurrency", "get_concurrency_bounds", "get_latency_target", "is_overload_status",
+           "AdaptiveLimiter"]
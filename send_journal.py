@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""
+Módulo con el diario de envíos (tabla envios_journal de factunabo_history.db).
+
+Cada envío a Facturantia se anota en dos momentos: al salir (EN_CURSO) y al
+terminar (estado final, respuesta y filas de resumen). Como se escribe factura
+a factura, un cierre inesperado a mitad de lote no pierde lo ya enviado.
+
+En modo reanudación (prueba.main(resume=True) o FACTUNABO_RESUME=1) las
+facturas ya confirmadas o encoladas offline no se vuelven a enviar: se
+reutilizan sus filas de resumen y sólo se reintentan las que quedaron en curso
+o fallaron. La factura se identifica por emisor y external_id: si se cambió en
+la Macro después de confirmarla, tampoco se reenvía (Facturantia ya tiene ese
+external_id).
+
+Estados:
+    EN_CURSO    enviada sin respuesta registrada (p. ej. cierre de la app)
+    CONFIRMADO  Facturantia la tiene (ÉXITO/OK o DUPLICADO)
+    EN_COLA     añadida a la cola offline
+    FALLIDO     cualquier otro resultado
+
+Variables de entorno:
+    FACTUNABO_SEND_JOURNAL  0 para no llevar el diario
+    FACTUNABO_RESUME        1 para reanudar por defecto
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from app.core.resources import DB_PATH
+
+logger = logging.getLogger("send_journal")
+
+EN_CURSO = "EN_CURSO"
+CONFIRMADO = "CONFIRMADO"
+EN_COLA = "EN_COLA"
+FALLIDO = "FALLIDO"
+
+# Mismos estados que se marcan como correctos en la Macro
+STATUS_CONFIRMADOS = ("ÉXITO", "OK", "SUCCESS", "DUPLICATE", "DUPLICADO")
+STATUS_EN_COLA = ("EN_COLA_OFFLINE",)
+ESTADOS_RESUELTOS = (CONFIRMADO, EN_COLA)
+
+CREATE_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS envios_journal (
+        empresa TEXT NOT NULL,
+        external_id TEXT NOT NULL,
+        estado TEXT NOT NULL,
+        status TEXT,
+        respuesta TEXT,
+        filas TEXT,
+        intentos INTEGER NOT NULL DEFAULT 0,
+        fecha_inicio TEXT,
+        fecha_fin TEXT,
+        PRIMARY KEY (empresa, external_id)
+    )
+"""
+
+
+def is_enabled() -> bool:
+    return os.getenv("FACTUNABO_SEND_JOURNAL", "1").strip() != "0"
+
+
+def resume_default() -> bool:
+    return os.getenv("FACTUNABO_RESUME", "0").strip() == "1"
+
+
+def estado_de_filas(filas: List[dict]) -> str:
+    """Estado del diario según los status de las filas de resumen de un envío."""
+    status = [str(f.get("status", "")).upper() for f in filas] or [""]
+    if all(s in STATUS_CONFIRMADOS for s in status):
+        return CONFIRMADO
+    if all(s in STATUS_EN_COLA for s in status):
+        return EN_COLA
+    return FALLIDO
+
+
+def _now() -> str:
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+
+class SendJournal:
+    """Diario de envíos compartido por los carriles de un lote (una conexión, con lock)."""
+
+    def __init__(self, db_path: Optional[str] = None):
+        self.db_path = db_path or DB_PATH
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.db_path, timeout=10, check_same_thread=False)
+        # Cada anotación se confirma al momento; NORMAL evita un fsync completo por factura
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(CREATE_TABLE_SQL)
+        self._conn.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    def _execute(self, sql: str, params: tuple) -> None:
+        with self._lock:
+            try:
+                self._conn.execute(sql, params)
+                self._conn.commit()
+            except sqlite3.Error as e:
+                # El diario nunca debe interrumpir un envío
+                logger.warning(f"No se pudo escribir en el diario de envíos: {e}")
+
+    def start(self, external_id, empresa) -> None:
+        """Anota la factura como EN_CURSO justo antes de enviarla."""
+        self._execute(
+            """
+            INSERT INTO envios_journal (empresa, external_id, estado, intentos, fecha_inicio)
+            VALUES (?, ?, ?, 1, ?)
+            ON CONFLICT(empresa, external_id) DO UPDATE SET
+                estado = excluded.estado, intentos = envios_journal.intentos + 1,
+                fecha_inicio = excluded.fecha_inicio, fecha_fin = NULL
+            """,
+            (str(empresa), str(external_id), EN_CURSO, _now()),
+        )
+
+    def finish(self, external_id, empresa, filas: List[dict], respuesta=None) -> str:
+        """Guarda el resultado del envío y devuelve el estado anotado."""
+        estado = estado_de_filas(filas)
+        status = ",".join(sorted({str(f.get("status", "")) for f in filas}))
+        self._execute(
+            """
+            UPDATE envios_journal SET estado = ?, status = ?, respuesta = ?, filas = ?, fecha_fin = ?
+            WHERE empresa = ? AND external_id = ?
+            """,
+            (estado, status, json.dumps(respuesta, ensure_ascii=False, default=str),
+             json.dumps(filas, ensure_ascii=False, default=str), _now(), str(empresa), str(external_id)),
+        )
+        return estado
+
+    def resolved_rows(self, external_id, empresa) -> Optional[List[dict]]:
+        """Filas de resumen de un envío ya confirmado o encolado; None si hay que (re)enviarlo."""
+        with self._lock:
+            try:
+                row = self._conn.execute(
+                    "SELECT estado, filas FROM envios_journal WHERE empresa = ? AND external_id = ?",
+                    (str(empresa), str(external_id)),
+                ).fetchone()
+            except sqlite3.Error as e:
+                logger.warning(f"No se pudo leer el diario de envíos: {e}")
+                return None
+        if row is None or row[0] not in ESTADOS_RESUELTOS or not row[1]:
+            return None
+        try:
+            return json.loads(row[1])
+        except ValueError:
+            return None
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            rows = self._conn.execute("SELECT estado, COUNT(*) FROM envios_journal GROUP BY estado").fetchall()
+        return {estado: n for estado, n in rows}
+
+    def clear(self) -> None:
+        """Vacía el diario (las próximas reanudaciones volverán a enviar todo)."""
+        self._execute("DELETE FROM envios_journal", ())
+
+
+def open_journal(db_path: Optional[str] = None) -> Optional[SendJournal]:
+    """Diario listo para usar, o None si está desactivado o no se puede abrir."""
+    if not is_enabled():
+        return None
+    try:
+        return SendJournal(db_path)
+    except sqlite3.Error as e:
+        logger.warning(f"No se pudo abrir el diario de envíos: {e}")
+        return None
+
+
+__all__ = ["EN_CURSO", "CONFIRMADO", "EN_COLA", "FALLIDO", "SendJournal", "open_journal",
+           "estado_de_filas", "is_enabled", "resume_default"]
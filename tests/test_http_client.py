@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""Pruebas de la política de reintentos de http_client (los POST de proformas no se duplican)."""
+import os
+import socket
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import http_client  # noqa: E402
+
+
+class _Servidor:
+    """Servidor local que responde con los estados indicados, uno por petición."""
+
+    def __init__(self, estados):
+        self.estados = list(estados)
+        self.peticiones = 0
+        servidor = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _responder(self):
+                longitud = int(self.headers.get("Content-Length") or 0)
+                self.rfile.read(longitud)
+                servidor.peticiones += 1
+                estado = servidor.estados.pop(0) if servidor.estados else 200
+                if estado is None:
+                    # Cierra la conexión sin responder, con el cuerpo ya recibido
+                    self.close_connection = True
+                    self.connection.shutdown(socket.SHUT_RDWR)
+                    return
+                self.send_response(estado)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            do_GET = do_POST = _responder
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = HTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_port}/"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def cerrar(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture(autouse=True)
+def _sin_espera(monkeypatch):
+    monkeypatch.setenv("FACTUNABO_HTTP_BACKOFF", "0.001")
+
+
+@pytest.mark.parametrize("estado", [502, 504])
+def test_post_no_reintenta_502_504(estado):
+    servidor = _Servidor([estado])
+    try:
+        resp = http_client.post(servidor.url, data=b"<proformas/>", timeout=5)
+        assert resp.status_code == estado
+        assert servidor.peticiones == 1
+    finally:
+        servidor.cerrar()
+
+
+def test_post_reintenta_503():
+    servidor = _Servidor([503, 200])
+    try:
+        assert http_client.post(servidor.url, data=b"<proformas/>", timeout=5).status_code == 200
+        assert servidor.peticiones == 2
+    finally:
+        servidor.cerrar()
+
+
+def test_get_reintenta_502_504():
+    servidor = _Servidor([502, 504, 200])
+    try:
+        assert http_client.get(servidor.url, timeout=5).status_code == 200
+        assert servidor.peticiones == 3
+    finally:
+        servidor.cerrar()
+
+
+def test_post_no_reintenta_conexion_cortada():
+    servidor = _Servidor([None])
+    try:
+        with pytest.raises(requests.exceptions.ConnectionError):
+            http_client.post(servidor.url, data=b"<proformas/>", timeout=5)
+        assert servidor.peticiones == 1
+    finally:
+        servidor.cerrar()
+
+
+def test_post_reintenta_conexion_rechazada():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        puerto = s.getsockname()[1]
+    with pytest.raises(requests.exceptions.ConnectionError) as info:
+        http_client.post(f"http://127.0.0.1:{puerto}/", data=b"<proformas/>", timeout=5, retries=0)
+    assert http_client._is_retryable_exception(info.value, "POST")
+
+
+def _async_post(url, **kwargs):
+    import asyncio
+
+    async def _enviar():
+        async with http_client.get_async_client() as client:
+            return await http_client.async_post(client, url, content=b"<proformas/>", timeout=5, **kwargs)
+
+    return asyncio.run(_enviar())
+
+
+def test_async_post_misma_politica_que_post():
+    pytest.importorskip("httpx")
+    servidor = _Servidor([502, 503, 200])
+    try:
+        assert _async_post(servidor.url).status_code == 502
+        assert _async_post(servidor.url).status_code == 200
+        assert servidor.peticiones == 3
+    finally:
+        servidor.cerrar()
+
+
+def test_async_post_no_reintenta_conexion_cortada():
+    httpx = pytest.importorskip("httpx")
+    servidor = _Servidor([None])
+    try:
+        with pytest.raises(httpx.RemoteProtocolError):
+            _async_post(servidor.url)
+        assert servidor.peticiones == 1
+    finally:
+        servidor.cerrar()
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""Pruebas de la búsqueda de URLs de PDF y del XML de cada factura de responses/summary.json."""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from send_job import SendJob  # noqa: E402
+
+URL = "https://facturantia.example/ver_afc_api.php?id=25042"
+
+
+def test_clave_directa():
+    assert SendJob._extract_pdf_url({"pdf_url": URL, "status": "OK"}) == URL
+
+
+def test_url_dentro_de_texto():
+    assert SendJob._extract_pdf_url({"descarga": f"Descargar: {URL} (PDF)"}) == URL
+
+
+def test_dict_anidado():
+    item = {"status": "OK", "pdf": {"meta": {"enlaces": [None, URL]}}}
+    assert SendJob._extract_pdf_url(item) == URL
+
+
+def test_busqueda_global_en_listas():
+    item = {"respuesta": {"documentos": [{"tipo": "xml"}, {"href": URL}]}}
+    assert SendJob._extract_pdf_url(item) == URL
+
+
+def test_filas_vacias_o_sin_url():
+    assert SendJob._extract_pdf_url({}) is None
+    assert SendJob._extract_pdf_url({"pdf_url": None, "status": "ERROR"}) is None
+    assert SendJob._extract_pdf_url({"pdf_url": "", "pdf": {}, "detalle": []}) is None
+
+
+XML = (b"<proformas><proforma><external_id>F-7</external_id><empresa_emisora>Emisor SL</empresa_emisora>"
+       b"<cliente><nombre>Cliente Uno</nombre></cliente><total_a_pagar>121.00</total_a_pagar></proforma></proformas>")
+
+
+def test_contexto_xml_desde_el_almacen(tmp_path, monkeypatch):
+    import artifact_store
+
+    db = str(tmp_path / "artifacts.db")
+    monkeypatch.setenv("FACTUNABO_ARTIFACTS", "store")
+    monkeypatch.setenv("FACTUNABO_ARTIFACT_DB", db)
+    monkeypatch.chdir(tmp_path)
+    artifact_store.get_store(db).put(artifact_store.KIND_XML, "F-7", "Emisor SL", XML)
+    job = SendJob()
+
+    ctx = job._xml_context_for_item({"id": "F-7", "empresa": "Emisor SL"})
+    assert ctx["importe_total"] == 121.0
+    # Emisor con otro nombre en el summary: se encuentra por nº de factura y cliente
+    ctx = job._xml_context_for_item({"id": "F-7", "empresa": "Otro", "cliente": "Cliente Uno"})
+    assert ctx["importe_total"] == 121.0
+    ctx = job._xml_context_for_item({"id": "F-8", "empresa": "Emisor SL"})
+    assert ctx["importe_total"] is None
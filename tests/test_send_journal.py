@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+"""Pruebas del diario de envíos usado para reanudar lotes interrumpidos."""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import send_journal  # noqa: E402
+
+
+def test_reanudacion_por_estado(tmp_path):
+    journal = send_journal.SendJournal(str(tmp_path / "journal.db"))
+    try:
+        journal.start("F-1", "Emisor SL")
+        assert journal.resolved_rows("F-1", "Emisor SL") is None  # en curso: se reenvía
+
+        filas = [{"id": "F-1", "status": "ÉXITO", "pdf_url": None}]
+        assert journal.finish("F-1", "Emisor SL", filas, {"ok": True}) == send_journal.CONFIRMADO
+        assert journal.resolved_rows("F-1", "Emisor SL") == filas
+
+        journal.start("F-2", "Emisor SL")
+        journal.finish("F-2", "Emisor SL", [{"id": "F-2", "status": "ERROR"}])
+        assert journal.resolved_rows("F-2", "Emisor SL") is None
+        assert journal.stats() == {send_journal.CONFIRMADO: 1, send_journal.FALLIDO: 1}
+    finally:
+        journal.close()
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+"""
+Módulo con la caché de libros ya adaptados (resultado de adapt_from_macro).
+
+En un ciclo de envío la misma Macro se adapta varias veces (validate_excel,
+select_excel, prueba.main y la lectura del historial para rectificativas) y
+cada vez se abre el .xlsm con openpyxl y se repite toda la normalización. La
+caché guarda los DataFrames devueltos, indexados por:
+
+    (ruta absoluta, tamaño, mtime, versión del adaptador, entradas extra)
+
+en memoria (los últimos libros usados) y en disco (un pickle por libro en
+responses/macro_cache/). Si el fichero cambia (p. ej. tras marcar las filas
+enviadas) la clave deja de coincidir y se vuelve a adaptar. Siempre se
+devuelven copias, así que quien modifique los DataFrames no altera la caché.
+
+Cada libro puede tener varias entradas independientes (namespace): los
+DataFrames de envío, el historial procesado y su índice se guardan y se
+leen por separado, de modo que usar unos no obliga a cargar los otros.
+
+Variables de entorno:
+    FACTUNABO_MACRO_CACHE      0 para desactivar la caché
+    FACTUNABO_MACRO_CACHE_DIR  carpeta de la caché en disco (por defecto responses/macro_cache)
+"""
+import hashlib
+import logging
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Optional, Sequence
+
+import pandas as pd
+
+logger = logging.getLogger("workbook_cache")
+
+DEFAULT_CACHE_DIR = os.path.join("responses", "macro_cache")
+MAX_MEMORY_ENTRIES = 4
+CACHE_SUFFIX = ".pkl"
+
+_memory: "OrderedDict[tuple[str, str], tuple[tuple, tuple]]" = OrderedDict()
+_lock = threading.Lock()
+
+
+def is_enabled() -> bool:
+    return os.getenv("FACTUNABO_MACRO_CACHE", "1").strip() != "0"
+
+
+def cache_dir() -> str:
+    return os.path.abspath(os.getenv("FACTUNABO_MACRO_CACHE_DIR", "").strip() or DEFAULT_CACHE_DIR)
+
+
+def cache_key(path: str, version: str, extra: Sequence = ()) -> tuple:
+    """Clave de un libro: cambia si cambia el fichero, el adaptador o cualquier entrada extra."""
+    st = os.stat(path)
+    return (os.path.abspath(path), st.st_size, st.st_mtime_ns, version, pd.__version__, tuple(extra))
+
+
+def _copy_frames(frames: tuple) -> tuple:
+    return tuple(f.copy(deep=True) if isinstance(f, pd.DataFrame) else f for f in frames)
+
+
+def _disk_prefix(abs_path: str) -> str:
+    return hashlib.sha1(os.path.normcase(abs_path).encode("utf-8")).hexdigest()
+
+
+def _disk_path(abs_path: str, namespace: str = "") -> str:
+    # Un fichero por libro y namespace: al cambiar la clave se sobrescribe en vez de acumularse
+    name = _disk_prefix(abs_path) + (f".{namespace}" if namespace else "")
+    return os.path.join(cache_dir(), name + CACHE_SUFFIX)
+
+
+def _remember(key: tuple, frames: tuple, namespace: str = "") -> None:
+    slot = (namespace, key[0])
+    with _lock:
+        _memory[slot] = (key, frames)
+        _memory.move_to_end(slot)
+        while len(_memory) > MAX_MEMORY_ENTRIES:
+            _memory.popitem(last=False)
+
+
+def _load_from_disk(key: tuple, namespace: str = "") -> Optional[tuple]:
+    path = _disk_path(key[0], namespace)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "rb") as f:
+            stored_key, frames = pickle.load(f)
+    except Exception as e:
+        # Fichero corrupto o de otra versión de pandas: se regenera
+        logger.warning(f"Caché de libro ilegible ({path}): {e}")
+        return None
+    return frames if stored_key == key else None
+
+
+def _save_to_disk(key: tuple, frames: tuple, namespace: str = "") -> None:
+    path = _disk_path(key[0], namespace)
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmp, "wb") as f:
+            pickle.dump((key, frames), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+    except Exception as e:
+        logger.warning(f"No se pudo guardar la caché del libro en {path}: {e}")
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+
+
+def _cached(key: tuple, namespace: str) -> Optional[tuple]:
+    """Entrada válida para key, de memoria o de disco (None si no la hay)."""
+    slot = (namespace, key[0])
+    with _lock:
+        entry = _memory.get(slot)
+        if entry is not None and entry[0] == key:
+            _memory.move_to_end(slot)
+            return entry[1]
+
+    t0 = time.perf_counter()
+    frames = _load_from_disk(key, namespace)
+    if frames is not None:
+        label = f"{os.path.basename(key[0])}{f' [{namespace}]' if namespace else ''}"
+        logger.info(f"Libro en caché: {label} ({(time.perf_counter() - t0) * 1000:.0f} ms)")
+        _remember(key, frames, namespace)
+    return frames
+
+
+def get_or_build(path: str, version: str, builder: Callable[[], tuple], extra: Sequence = (),
+                 namespace: str = "") -> tuple:
+    """
+    Devuelve una copia de los DataFrames de path: de memoria, de disco o
+    llamando a builder() (y guardando el resultado) si no hay entrada válida.
+    """
+    if not is_enabled():
+        return builder()
+    try:
+        key = cache_key(path, version, extra)
+    except OSError:
+        # El fichero no existe: que el adaptador dé su error habitual
+        return builder()
+
+    frames = _cached(key, namespace)
+    if frames is None:
+        frames = tuple(builder())
+        _remember(key, frames, namespace)
+        _save_to_disk(key, frames, namespace)
+    return _copy_frames(frames)
+
+
+def peek(path: str, version: str, extra: Sequence = (), namespace: str = "") -> Optional[tuple]:
+    """Copia de la entrada de path si ya está en caché; None si no (nunca construye)."""
+    if not is_enabled():
+        return None
+    try:
+        frames = _cached(cache_key(path, version, extra), namespace)
+    except OSError:
+        return None
+    return _copy_frames(frames) if frames is not None else None
+
+
+def store(path: str, version: str, frames: tuple, extra: Sequence = (), namespace: str = "") -> None:
+    """Guarda frames como entrada de path (p. ej. un subproducto de otra construcción)."""
+    if not is_enabled():
+        return
+    try:
+        key = cache_key(path, version, extra)
+    except OSError:
+        return
+    frames = _copy_frames(tuple(frames))
+    _remember(key, frames, namespace)
+    _save_to_disk(key, frames, namespace)
+
+
+def invalidate(path: Optional[str] = None) -> None:
+    """Olvida las entradas de path (o toda la caché en memoria y disco si es None)."""
+    abs_path = os.path.abspath(path) if path is not None else None
+    with _lock:
+        if abs_path is None:
+            _memory.clear()
+        else:
+            for slot in [s for s in _memory if s[1] == abs_path]:
+                del _memory[slot]
+    targets = []
+    if os.path.isdir(cache_dir()):
+        prefix = _disk_prefix(abs_path) if abs_path is not None else ""
+        targets = [
+            os.path.join(cache_dir(), n) for n in os.listdir(cache_dir())
+            if n.endswith(CACHE_SUFFIX) and n.startswith(prefix)
+        ]
+    for target in targets:
+        try:
+            os.remove(target)
+        except OSError:
+            pass
+
+
+__all__ = ["DEFAULT_CACHE_DIR", "is_enabled", "cache_dir", "cache_key", "get_or_build", "peek", "store", "invalidate"]
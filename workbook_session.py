@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+Módulo con la sesión de lectura de un libro Excel (una sola apertura).
+
+adapt_from_macro abría el mismo .xlsm con load_workbook tres veces (Macro,
+CLIENTES y el repaso de hojas de historial) y el generador MMB otra vez por
+cada cliente. Cada apertura vuelve a descomprimir el zip y a parsear los
+shared strings. Una WorkbookSession abre el libro una vez, lee de una pasada
+todas las hojas que se le piden, cierra el fichero y sirve después las filas
+desde memoria a quien las necesite (adaptador, CLIENTES, historial, MMB).
+
+Uso:
+    with WorkbookSession(path) as session:
+        session.load()                       # todas las hojas, una sola apertura
+        rows = session.rows("CLIENTES")      # lista de tuplas (values_only)
+"""
+import os
+import threading
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from openpyxl import load_workbook
+
+Row = Tuple[object, ...]
+
+
+class WorkbookSession:
+    """Filas de las hojas de un libro, leídas con una sola apertura de openpyxl."""
+
+    def __init__(self, path: str):
+        self.path = os.path.abspath(path)
+        self._lock = threading.Lock()
+        self._sheetnames: Optional[List[str]] = None
+        self._states: Dict[str, str] = {}
+        self._rows: Dict[str, List[Row]] = {}
+        self._stamp: Optional[Tuple[int, int]] = None
+        self.opens = 0  # aperturas reales del fichero (diagnóstico)
+
+    # ----------------- Estado -----------------
+    def _file_stamp(self) -> Tuple[int, int]:
+        st = os.stat(self.path)
+        return (st.st_size, st.st_mtime_ns)
+
+    def is_current(self) -> bool:
+        """False si el fichero cambió desde que se leyó (las filas en memoria ya no valen)."""
+        if self._stamp is None:
+            return True
+        try:
+            return self._file_stamp() == self._stamp
+        except OSError:
+            return False
+
+    def _check_current(self) -> None:
+        if not self.is_current():
+            # El libro se guardó entretanto (p. ej. al marcar filas): se empieza de cero
+            self._sheetnames = None
+            self._states.clear()
+            self._rows.clear()
+            self._stamp = None
+
+    # ----------------- Lectura -----------------
+    def _wanted(self, names: Optional[Iterable[str]], exclude: Sequence[str]) -> List[str]:
+        excluded = {n.lower() for n in exclude}
+        candidates = self._sheetnames if names is None else [n for n in names if n in self._sheetnames]
+        return [n for n in candidates if n.lower() not in excluded and n not in self._rows]
+
+    def _read(self, names: Optional[Iterable[str]], exclude: Sequence[str] = ()) -> None:
+        """Abre el libro una vez, lee las hojas pedidas (None = todas) que falten y lo cierra."""
+        wb = load_workbook(self.path, data_only=True, read_only=True)
+        self.opens += 1
+        try:
+            self._stamp = self._file_stamp()
+            self._sheetnames = list(wb.sheetnames)
+            self._states = {ws.title: ws.sheet_state for ws in wb.worksheets}
+            for name in self._wanted(names, exclude):
+                self._rows[name] = list(wb[name].iter_rows(values_only=True))
+        finally:
+            wb.close()
+
+    def load(self, names: Optional[Iterable[str]] = None, exclude: Sequence[str] = ()) -> "WorkbookSession":
+        """
+        Lee de una pasada las hojas indicadas (todas si names es None) que no
+        estén ya en memoria, salvo las de exclude (sin distinguir mayúsculas).
+        """
+        with self._lock:
+            self._check_current()
+            names = list(names) if names is not None else None
+            if self._sheetnames is not None and not self._wanted(names, exclude):
+                return self
+            self._read(names, exclude)
+        return self
+
+    @property
+    def sheetnames(self) -> List[str]:
+        with self._lock:
+            self._check_current()
+            if self._sheetnames is None:
+                self._read([])
+            return list(self._sheetnames)
+
+    @property
+    def worksheet_names(self) -> List[str]:
+        """Hojas de cálculo (sin hojas de gráfico), como Workbook.worksheets."""
+        names = self.sheetnames
+        return [n for n in names if n in self._states]
+
+    def sheet_state(self, name: str) -> str:
+        """visible, hidden o veryHidden (como Worksheet.sheet_state)."""
+        self.sheetnames  # carga nombres y estados si aún no se abrió el libro
+        return self._states.get(name, "visible")
+
+    def find_sheet(self, candidates: Iterable[str]) -> Optional[str]:
+        """Primera hoja de cálculo cuyo nombre coincide (sin distinguir mayúsculas) con algún candidato."""
+        low = {n.lower(): n for n in self.worksheet_names}
+        for cand in candidates:
+            if cand.lower() in low:
+                return low[cand.lower()]
+        return None
+
+    def rows(self, name: str) -> List[Row]:
+        """Filas (values_only) de la hoja; la lee si aún no está en memoria."""
+        self.load([name])
+        with self._lock:
+            if name not in self._rows:
+                raise KeyError(f"La hoja '{name}' no existe en {self.path}")
+            return self._rows[name]
+
+    # ----------------- Cierre -----------------
+    def close(self) -> None:
+        """Libera las filas en memoria (el fichero ya se cierra tras cada lectura)."""
+        with self._lock:
+            self._rows.clear()
+
+    def __enter__(self) -> "WorkbookSession":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+def session_for(path: str, session: Optional[WorkbookSession] = None) -> WorkbookSession:
+    """La sesión recibida si es de path; si no, una nueva."""
+    if session is not None and session.path == os.path.abspath(path):
+        return session
+    return WorkbookSession(path)
+
+
+__all__ = ["WorkbookSession", "session_for"]
@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+"""
+Módulo con un lector directo de hojas .xlsx/.xlsm (sin openpyxl).
+
+openpyxl materializa todas las celdas de la hoja Macro aunque el adaptador
+sólo use las columnas de EXCEL_COLS. XlsxReader recorre el XML de la hoja
+dentro del zip con iterparse, decodifica únicamente las columnas pedidas y
+entrega las filas por bloques, de modo que el tiempo y la memoria dependen de
+las columnas usadas y no del ancho de la hoja. Los shared strings y los
+estilos (para reconocer fechas) se leen sólo si aparece una celda que los
+necesita.
+
+Los valores y el número de filas coinciden con los de
+load_workbook(read_only=True, data_only=True) + iter_rows(values_only=True):
+filas que faltan como filas vacías, ancho según la dimensión de la hoja,
+fechas según el formato de número y valores cacheados de las fórmulas.
+
+Uso:
+    with XlsxReader(path) as reader:
+        for chunk in reader.iter_chunks("Macro", columns=[0, 1, 4]):
+            chunk.rows    # listas con los valores de las columnas pedidas
+            chunk.width   # ancho máximo (como en openpyxl) de las filas del bloque
+"""
+import posixpath
+import zipfile
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional
+
+from lxml import etree
+from openpyxl.styles.numbers import builtin_format_code, is_date_format, is_timedelta_format
+from openpyxl.utils.cell import column_index_from_string, range_boundaries
+from openpyxl.utils.datetime import CALENDAR_MAC_1904, CALENDAR_WINDOWS_1900, from_excel, from_ISO8601
+
+DEFAULT_CHUNK_ROWS = 2000
+
+_MAIN_NS = "http://schemas.openxmlformats.org/spreadsheetml/2006/main"
+_DOC_REL_NS = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+_PKG_REL_NS = "http://schemas.openxmlformats.org/package/2006/relationships"
+
+_ROW = f"{{{_MAIN_NS}}}row"
+_CELL = f"{{{_MAIN_NS}}}c"
+_VALUE = f"{{{_MAIN_NS}}}v"
+_TEXT = f"{{{_MAIN_NS}}}t"
+_RUN = f"{{{_MAIN_NS}}}r"
+_INLINE = f"{{{_MAIN_NS}}}is"
+_SI = f"{{{_MAIN_NS}}}si"
+_DIMENSION = f"{{{_MAIN_NS}}}dimension"
+
+_DIGITS = "0123456789"
+
+
+class SheetInfo(NamedTuple):
+    name: str
+    state: str
+    part: str
+    is_worksheet: bool
+
+
+class Chunk(NamedTuple):
+    rows: List[list]
+    width: int
+
+
+def _text_content(node) -> str:
+    """Texto de un <si>/<is> como Text.content de openpyxl (<t> directo + <r><t>, sin fonética)."""
+    snippets = []
+    t = node.find(_TEXT)
+    if t is not None and t.text is not None:
+        snippets.append(t.text)
+    for run in node.iterfind(_RUN):
+        rt = run.find(_TEXT)
+        if rt is not None and rt.text is not None:
+            snippets.append(rt.text)
+    return "".join(snippets)
+
+
+def _cast_number(value: str):
+    if "." in value or "E" in value or "e" in value:
+        return float(value)
+    return int(value)
+
+
+class XlsxReader:
+    """Hojas de un .xlsx/.xlsm leídas directamente del zip, con proyección de columnas."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._zip = zipfile.ZipFile(path)
+        try:
+            self._workbook_part = self._find_workbook_part()
+            rels = self._read_rels(self._workbook_part)
+            root = etree.fromstring(self._zip.read(self._workbook_part))
+            pr = root.find(f"{{{_MAIN_NS}}}workbookPr")
+            date1904 = pr is not None and pr.get("date1904", "").lower() in ("1", "true")
+            self.epoch = CALENDAR_MAC_1904 if date1904 else CALENDAR_WINDOWS_1900
+            self.sheets: List[SheetInfo] = []
+            for sheet in root.iterfind(f"{{{_MAIN_NS}}}sheets/{{{_MAIN_NS}}}sheet"):
+                rel_type, part = rels.get(sheet.get(f"{{{_DOC_REL_NS}}}id"), ("", ""))
+                self.sheets.append(SheetInfo(
+                    sheet.get("name"), sheet.get("state", "visible"), part, rel_type.endswith("/worksheet")
+                ))
+            self._shared_part = next((p for t, p in rels.values() if t.endswith("/sharedStrings")), None)
+            self._styles_part = next((p for t, p in rels.values() if t.endswith("/styles")), None)
+        except Exception:
+            self._zip.close()
+            raise
+        self._shared_strings: Optional[List[str]] = None
+        self._date_styles: Optional[set] = None
+        self._timedelta_styles: Optional[set] = None
+        self._columns: Dict[str, int] = {}
+
+    # ----------------- Estructura del paquete -----------------
+    def _find_workbook_part(self) -> str:
+        root = etree.fromstring(self._zip.read("_rels/.rels"))
+        for rel in root.iterfind(f"{{{_PKG_REL_NS}}}Relationship"):
+            if rel.get("Type", "").endswith("/officeDocument"):
+                return rel.get("Target").lstrip("/")
+        return "xl/workbook.xml"
+
+    def _read_rels(self, part: str) -> Dict[str, tuple]:
+        folder, name = posixpath.split(part)
+        rels_part = posixpath.join(folder, "_rels", name + ".rels")
+        root = etree.fromstring(self._zip.read(rels_part))
+        rels = {}
+        for rel in root.iterfind(f"{{{_PKG_REL_NS}}}Relationship"):
+            target = rel.get("Target", "")
+            if target.startswith("/"):
+                target = target.lstrip("/")
+            else:
+                target = posixpath.normpath(posixpath.join(folder, target))
+            rels[rel.get("Id")] = (rel.get("Type", ""), target)
+        return rels
+
+    @property
+    def sheetnames(self) -> List[str]:
+        return [s.name for s in self.sheets]
+
+    @property
+    def worksheets(self) -> List[SheetInfo]:
+        """Hojas de cálculo (sin hojas de gráfico), en el orden del libro, como Workbook.worksheets."""
+        return [s for s in self.sheets if s.is_worksheet]
+
+    # ----------------- Carga diferida -----------------
+    def _strings(self) -> List[str]:
+        if self._shared_strings is None:
+            strings = []
+            if self._shared_part and self._shared_part in self._zip.namelist():
+                with self._zip.open(self._shared_part) as src:
+                    for _, node in etree.iterparse(src, events=("end",), tag=_SI):
+                        strings.append(_text_content(node).replace("x005F_", ""))
+                        node.clear()
+            self._shared_strings = strings
+        return self._shared_strings
+
+    def _load_styles(self) -> None:
+        dates, timedeltas = set(), set()
+        if self._styles_part and self._styles_part in self._zip.namelist():
+            root = etree.fromstring(self._zip.read(self._styles_part))
+            custom = {
+                int(fmt.get("numFmtId")): fmt.get("formatCode")
+                for fmt in root.iterfind(f"{{{_MAIN_NS}}}numFmts/{{{_MAIN_NS}}}numFmt")
+            }
+            for idx, xf in enumerate(root.iterfind(f"{{{_MAIN_NS}}}cellXfs/{{{_MAIN_NS}}}xf")):
+                num_fmt_id = int(xf.get("numFmtId", 0))
+                code = custom[num_fmt_id] if num_fmt_id in custom else builtin_format_code(num_fmt_id)
+                if is_date_format(code):
+                    dates.add(idx)
+                if is_timedelta_format(code):
+                    timedeltas.add(idx)
+        self._date_styles, self._timedelta_styles = dates, timedeltas
+
+    def _column(self, ref: str) -> int:
+        letters = ref.rstrip(_DIGITS)
+        col = self._columns.get(letters)
+        if col is None:
+            col = self._columns[letters] = column_index_from_string(letters)
+        return col
+
+    # ----------------- Celdas -----------------
+    def _value(self, cell):
+        """Valor de una celda como lo da openpyxl con data_only=True."""
+        data_type = cell.get("t", "n")
+        if data_type == "inlineStr":
+            inline = cell.find(_INLINE)
+            return _text_content(inline) if inline is not None else None
+        value = cell.findtext(_VALUE) or None
+        if value is None:
+            return None
+        if data_type == "n":
+            value = _cast_number(value)
+            style_id = int(cell.get("s", 0))
+            if self._date_styles is None:
+                self._load_styles()
+            if style_id in self._date_styles:
+                try:
+                    return from_excel(value, self.epoch, timedelta=style_id in self._timedelta_styles)
+                except (OverflowError, ValueError):
+                    return "#VALUE!"
+            return value
+        if data_type == "s":
+            return self._strings()[int(value)]
+        if data_type == "b":
+            return bool(int(value))
+        if data_type == "d":
+            return from_ISO8601(value)
+        return value  # "str" (fórmula de texto) y "e" (error)
+
+    # ----------------- Filas -----------------
+    def _sheet(self, name: str) -> SheetInfo:
+        for sheet in self.sheets:
+            if sheet.name == name:
+                return sheet
+        raise KeyError(f"La hoja '{name}' no existe en {self.path}")
+
+    def iter_rows(self, name: str, columns: Optional[Iterable[int]] = None) -> Iterator[tuple]:
+        """
+        (valores, ancho) por fila. columns son índices 0-based; None = todas
+        (entonces valores es la fila completa).
+        """
+        wanted = None if columns is None else {c + 1: i for i, c in enumerate(columns)}
+        n_out = 0 if wanted is None else len(wanted)
+        max_row = max_col = None
+        counter = 1
+        idx = 1
+        row_counter = 0
+
+        def _empty():
+            width = max_col or 0
+            return ([None] * width if wanted is None else [None] * n_out), width
+
+        with self._zip.open(self._sheet(name).part) as src:
+            for _, node in etree.iterparse(src, events=("end",), tag=(_DIMENSION, _ROW)):
+                if node.tag == _DIMENSION:
+                    ref = node.get("ref")
+                    if ref:
+                        _, _, max_col, max_row = range_boundaries(ref)
+                    continue
+
+                r = node.get("r")
+                row_counter = int(float(r)) if r else row_counter + 1
+                idx = row_counter
+                if max_row is not None and idx > max_row:
+                    break
+                # Filas que faltan en el XML: vacías, como en openpyxl
+                while counter < idx:
+                    counter += 1
+                    yield _empty()
+                if counter <= idx:
+                    counter += 1
+                    cells = []
+                    col_counter = 0
+                    for cell in node.iterchildren(_CELL):
+                        ref = cell.get("r")
+                        col_counter = self._column(ref) if ref else col_counter + 1
+                        cells.append((col_counter, cell))
+                    if not cells and not max_col:
+                        width = 0
+                    else:
+                        width = max_col or cells[-1][0]
+                    if wanted is None:
+                        values = [None] * width
+                        for col, cell in cells:
+                            if col <= width:
+                                values[col - 1] = self._value(cell)
+                    else:
+                        values = [None] * n_out
+                        for col, cell in cells:
+                            pos = wanted.get(col)
+                            if pos is not None and col <= width:
+                                values[pos] = self._value(cell)
+                    yield values, width
+
+                node.clear()
+                while node.getprevious() is not None:
+                    del node.getparent()[0]
+
+        if max_row is not None and max_row < idx:
+            while counter <= max_row:
+                counter += 1
+                yield _empty()
+
+    def iter_chunks(self, name: str, columns: Optional[Iterable[int]] = None,
+                    chunk_size: int = DEFAULT_CHUNK_ROWS) -> Iterator[Chunk]:
+        """Las filas de iter_rows agrupadas en bloques de chunk_size."""
+        rows, width = [], 0
+        for values, row_width in self.iter_rows(name, columns):
+            rows.append(values)
+            width = max(width, row_width)
+            if len(rows) >= chunk_size:
+                yield Chunk(rows, width)
+                rows, width = [], 0
+        if rows:
+            yield Chunk(rows, width)
+
+    # ----------------- Cierre -----------------
+    def close(self) -> None:
+        self._zip.close()
+
+    def __enter__(self) -> "XlsxReader":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+__all__ = ["XlsxReader", "SheetInfo", "Chunk", "DEFAULT_CHUNK_ROWS"]
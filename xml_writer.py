@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+Módulo para serializar en una sola pasada el XML de las proformas.
+
+Sustituye al antiguo prettify (ET.tostring -> minidom.parseString ->
+toprettyxml): recorre el árbol de ElementTree una vez y escribe directamente
+los bytes, sin copia DOM intermedia.
+
+Modos:
+    pretty  sangría de 4 espacios, byte a byte igual que la salida de
+            minidom.toprettyxml(indent="    ") que se usaba antes
+    wire    compacto, sin saltos de línea ni sangría (el mismo contenido para
+            el XSD y para la API, con menos bytes)
+
+Variable de entorno:
+    FACTUNABO_XML_FORMAT  pretty (por defecto) o wire
+"""
+import os
+import xml.etree.ElementTree as ET
+from typing import List, Optional, Sequence
+
+PRETTY = "pretty"
+WIRE = "wire"
+
+XML_DECLARATION = '<?xml version="1.0" encoding="utf-8"?>'
+INDENT = "    "
+
+
+def get_format() -> str:
+    """Formato configurado en FACTUNABO_XML_FORMAT (pretty si no es válido)."""
+    value = os.getenv("FACTUNABO_XML_FORMAT", "").strip().lower()
+    return WIRE if value == WIRE else PRETTY
+
+
+def _escape(data: str) -> str:
+    # Mismo escapado que minidom (_write_data), comillas incluidas
+    if "&" in data:
+        data = data.replace("&", "&amp;")
+    if "<" in data:
+        data = data.replace("<", "&lt;")
+    if '"' in data:
+        data = data.replace('"', "&quot;")
+    if ">" in data:
+        data = data.replace(">", "&gt;")
+    return data
+
+
+def _text(data: str) -> str:
+    # El parser XML normalizaba los saltos de línea del texto (\r\n y \r -> \n)
+    if "\r" in data:
+        data = data.replace("\r\n", "\n").replace("\r", "\n")
+    return _escape(data)
+
+
+def _open_tag(elem: ET.Element) -> str:
+    if not elem.attrib:
+        return "<" + elem.tag
+    attrs = "".join(f' {k}="{_escape(str(v))}"' for k, v in elem.attrib.items())
+    return "<" + elem.tag + attrs
+
+
+def _write_pretty(elem: ET.Element, out: List[str], indent: str) -> None:
+    # Nodos hijos tal y como los vería minidom: texto, elementos y colas (tail)
+    nodes = []
+    if elem.text:
+        nodes.append(elem.text)
+    for child in elem:
+        nodes.append(child)
+        if child.tail:
+            nodes.append(child.tail)
+
+    out.append(indent + _open_tag(elem))
+    if not nodes:
+        out.append("/>\n")
+        return
+    if len(nodes) == 1 and isinstance(nodes[0], str):
+        out.append(">" + _text(nodes[0]) + "</" + elem.tag + ">\n")
+        return
+    out.append(">\n")
+    child_indent = indent + INDENT
+    for node in nodes:
+        if isinstance(node, str):
+            out.append(child_indent + _text(node) + "\n")
+        else:
+            _write_pretty(node, out, child_indent)
+    out.append(indent + "</" + elem.tag + ">\n")
+
+
+def _write_wire(elem: ET.Element, out: List[str]) -> None:
+    out.append(_open_tag(elem))
+    if not elem.text and len(elem) == 0:
+        out.append("/>")
+        return
+    out.append(">")
+    if elem.text:
+        out.append(_text(elem.text))
+    for child in elem:
+        _write_wire(child, out)
+        if child.tail:
+            out.append(_text(child.tail))
+    out.append("</" + elem.tag + ">")
+
+
+def to_bytes(root: ET.Element, fmt: Optional[str] = None) -> bytes:
+    """Serializa root en UTF-8 con declaración XML, en formato pretty o wire."""
+    fmt = fmt or get_format()
+    out: List[str] = [XML_DECLARATION]
+    if fmt == WIRE:
+        _write_wire(root, out)
+    else:
+        out.append("\n")
+        _write_pretty(root, out, "")
+    return "".join(out).encode("utf-8", "xmlcharrefreplace")
+
+
+def combine(documents: Sequence[bytes], root_tag: str = "proformas") -> bytes:
+    """
+    Une varios documentos <proformas> en uno, con las proformas en el mismo orden.
+
+    Trabaja sobre los bytes ya serializados (pretty o wire): toma la cabecera y
+    el cierre del primero y el contenido de la raíz de cada uno.
+    """
+    if len(documents) == 1:
+        return documents[0]
+    open_tag = f"<{root_tag}>".encode("utf-8")
+    close_tag = f"</{root_tag}>".encode("utf-8")
+    first = documents[0]
+    head_end = first.index(open_tag) + len(open_tag)
+    parts = []
+    for pos, doc in enumerate(documents):
+        inner = doc[doc.index(open_tag) + len(open_tag):doc.rindex(close_tag)]
+        # En pretty cada contenido empieza con salto de línea: sólo se conserva el primero
+        parts.append(inner if pos == 0 else inner.lstrip(b"\n"))
+    return first[:head_end] + b"".join(parts) + first[first.rindex(close_tag):]
+
+
+__all__ = ["PRETTY", "WIRE", "get_format", "to_bytes", "combine"]
@@ -0,0 +1,400 @@
+# -*- coding: utf-8 -*-
+"""
+Módulo para validar rápido las proformas contra EsquemaProformas.xsd.
+
+- El XSD se compila una sola vez con el validador en C de lxml, que decide en
+  milisegundos si un XML es válido. xmlschema sigue siendo la referencia para
+  los XML que lxml rechaza, porque da mensajes de error más detallados.
+- Los veredictos se guardan en disco (tabla xsd_validaciones de
+  factunabo_history.db) por (hash del XML, checksum del XSD), de modo que los
+  reenvíos y reintentos de un mismo XML no se vuelven a validar. Si cambia el
+  XSD cambia el checksum y los veredictos antiguos dejan de aplicarse. Cada
+  proceso abre una sola conexión, lee de una vez los veredictos del XSD
+  actual y escribe los nuevos por lotes (executemany en una transacción);
+  al abrir se borran los de otros XSD y los más antiguos que
+  FACTUNABO_XSD_VERDICTS_DAYS.
+- El esquema de xmlschema ya compilado se guarda serializado junto al XSD
+  (EsquemaProformas.xsd.pickle) y se carga en milisegundos en lugar de
+  recompilarlo en cada proceso. El artefacto lleva el checksum del XSD y la
+  versión de xmlschema; si alguno no coincide se recompila y se reescribe.
+  Puede generarse al empaquetar con `python xsd_validator.py`.
+
+Variables de entorno:
+    FACTUNABO_XSD_VERDICTS  0 para no leer ni guardar veredictos en disco
+    FACTUNABO_XSD_VERDICTS_DAYS  días que se conservan los veredictos (por defecto 90)
+    FACTUNABO_XSD_LXML      0 para no usar lxml (sólo xmlschema)
+    FACTUNABO_XSD_ARTIFACT  0 para no leer ni escribir el esquema serializado
+    FACTUNABO_XSD_WARM      0 para no precargar los esquemas al arrancar la app
+"""
+import atexit
+import hashlib
+import logging
+import os
+import pickle
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from app.core.resources import DB_PATH
+
+logger = logging.getLogger("xsd_validator")
+
+XSD_PATH = os.path.join(os.path.dirname(__file__), "EsquemaProformas.xsd")
+ARTIFACT_PATH = XSD_PATH + ".pickle"
+
+_LOCK = threading.Lock()
+_CHECKSUM: Optional[Tuple[Tuple[float, int], str]] = None  # ((mtime, size), sha256)
+_LXML_SCHEMA = None
+_LXML_FAILED = False
+_XMLSCHEMA = None
+_XMLSCHEMA_LOCK = threading.Lock()
+_WARM_THREAD = None
+
+DEFAULT_VERDICT_DAYS = 90
+VERDICT_FLUSH_ROWS = 500  # veredictos pendientes que fuerzan una escritura
+
+
+def _env_enabled(name: str) -> bool:
+    return os.getenv(name, "1").strip() != "0"
+
+
+def xml_hash(xml_bytes: bytes) -> str:
+    return hashlib.sha256(xml_bytes).hexdigest()
+
+
+def xsd_checksum(xsd_path: str = XSD_PATH) -> str:
+    """SHA-256 del XSD (se recalcula sólo si cambian fecha o tamaño del fichero)."""
+    global _CHECKSUM
+    st = os.stat(xsd_path)
+    firma = (st.st_mtime, st.st_size)
+    cached = _CHECKSUM
+    if cached is not None and cached[0] == firma:
+        return cached[1]
+    h = hashlib.sha256()
+    with open(xsd_path, "rb") as f:
+        for chunk in iter(lambda: f.read(65536), b""):
+            h.update(chunk)
+    _CHECKSUM = (firma, h.hexdigest())
+    return _CHECKSUM[1]
+
+
+# --- Validador lxml ---
+def _get_lxml_schema():
+    global _LXML_SCHEMA, _LXML_FAILED
+    if _LXML_SCHEMA is None and not _LXML_FAILED:
+        with _LOCK:
+            if _LXML_SCHEMA is None and not _LXML_FAILED:
+                try:
+                    from lxml import etree
+                    _LXML_SCHEMA = etree.XMLSchema(etree.parse(XSD_PATH))
+                except Exception as e:
+                    _LXML_FAILED = True
+                    logger.warning(f"No se pudo compilar el XSD con lxml; se usará xmlschema: {e}")
+    return _LXML_SCHEMA
+
+
+def lxml_is_valid(xml_bytes: bytes) -> Optional[bool]:
+    """True/False según lxml; None si lxml no está disponible o no puede decidir."""
+    if not _env_enabled("FACTUNABO_XSD_LXML"):
+        return None
+    schema = _get_lxml_schema()
+    if schema is None:
+        return None
+    try:
+        from lxml import etree
+        doc = etree.fromstring(xml_bytes)
+    except Exception:
+        return False  # XML mal formado: xmlschema dará el mensaje
+    # Los objetos XMLSchema de lxml no son seguros entre hilos
+    with _LOCK:
+        return bool(schema.validate(doc))
+
+
+# --- Esquema xmlschema serializado ---
+def _artifact_header() -> dict:
+    import xmlschema
+    return {"xsd_checksum": xsd_checksum(), "xmlschema": xmlschema.__version__}
+
+
+def _load_artifact(header: dict, path: str = ARTIFACT_PATH):
+    """Esquema guardado en path si su cabecera coincide con header; None en otro caso."""
+    try:
+        with open(path, "rb") as f:
+            # La cabecera va primero para descartar artefactos caducados sin leer el esquema
+            if pickle.load(f) != header:
+                logger.info("El esquema XSD serializado está desactualizado; se recompilará")
+                return None
+            return pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.warning(f"No se pudo cargar el esquema XSD serializado: {e}")
+        return None
+
+
+def _save_artifact(header: dict, schema, path: str = ARTIFACT_PATH) -> bool:
+    """Escribe el artefacto de forma atómica (fichero temporal + os.replace)."""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            pickle.dump(header, f, protocol=pickle.HIGHEST_PROTOCOL)
+            pickle.dump(schema, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+        return True
+    except Exception as e:
+        # Carpeta de sólo lectura (p. ej. la app empaquetada): se sigue sin artefacto
+        logger.debug(f"No se pudo guardar el esquema XSD serializado: {e}")
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        return False
+
+
+def build_artifact(path: str = ARTIFACT_PATH):
+    """Compila el XSD con xmlschema, guarda el artefacto y devuelve el esquema."""
+    import xmlschema
+    schema = xmlschema.XMLSchema(XSD_PATH)
+    _save_artifact(_artifact_header(), schema, path)
+    return schema
+
+
+def get_xmlschema():
+    """Esquema xmlschema compartido: del artefacto si es válido, compilándolo si no."""
+    global _XMLSCHEMA
+    if _XMLSCHEMA is None:
+        with _XMLSCHEMA_LOCK:
+            if _XMLSCHEMA is None:
+                if not _env_enabled("FACTUNABO_XSD_ARTIFACT"):
+                    import xmlschema
+                    _XMLSCHEMA = xmlschema.XMLSchema(XSD_PATH)
+                else:
+                    header = _artifact_header()
+                    schema = _load_artifact(header)
+                    if schema is None:
+                        schema = build_artifact()
+                    _XMLSCHEMA = schema
+    return _XMLSCHEMA
+
+
+def warm_async() -> None:
+    """Precarga en segundo plano los esquemas lxml y xmlschema (una vez por proceso)."""
+    global _WARM_THREAD
+    if not _env_enabled("FACTUNABO_XSD_WARM"):
+        return
+    if _WARM_THREAD is not None:
+        return
+
+    def _warm() -> None:
+        try:
+            if _env_enabled("FACTUNABO_XSD_LXML"):
+                _get_lxml_schema()
+            get_xmlschema()
+        except Exception as e:
+            logger.warning(f"No se pudo precargar el esquema XSD: {e}")
+
+    _WARM_THREAD = threading.Thread(target=_warm, name="xsd-warm", daemon=True)
+    _WARM_THREAD.start()
+
+
+# --- Veredictos en disco ---
+Verdict = Tuple[bool, Optional[str]]
+VerdictRow = Tuple[str, str, int, Optional[str], str]  # (xml_hash, xsd_checksum, valido, error, fecha)
+
+
+def _verdict_days() -> int:
+    try:
+        return max(1, int(os.getenv("FACTUNABO_XSD_VERDICTS_DAYS", str(DEFAULT_VERDICT_DAYS))))
+    except ValueError:
+        return DEFAULT_VERDICT_DAYS
+
+
+class VerdictStore:
+    """
+    Veredictos de un proceso: una conexión, lectura de todos los del XSD
+    actual al abrir y escritura de los nuevos por lotes.
+    """
+
+    def __init__(self, db_path: Optional[str] = None):
+        self.db_path = db_path or DB_PATH
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._checksum: Optional[str] = None
+        self._known: Dict[str, Verdict] = {}
+        self._pending: List[VerdictRow] = []
+        self._failed = False
+
+    def _check_process(self) -> None:
+        # Tras un fork la conexión y los pendientes son del proceso padre
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._conn = None
+            self._checksum = None
+            self._known = {}
+            self._pending = []
+
+    def _open(self, checksum: str) -> bool:
+        self._check_process()
+        if self._failed:
+            return False
+        try:
+            if self._conn is None:
+                self._conn = sqlite3.connect(self.db_path, timeout=5, check_same_thread=False)
+                with self._conn:
+                    self._conn.execute(
+                        """
+                        CREATE TABLE IF NOT EXISTS xsd_validaciones (
+                            xml_hash TEXT NOT NULL,
+                            xsd_checksum TEXT NOT NULL,
+                            valido INTEGER NOT NULL,
+                            error TEXT,
+                            fecha TEXT NOT NULL,
+                            PRIMARY KEY (xml_hash, xsd_checksum)
+                        )
+                        """
+                    )
+                    limite = (datetime.now() - timedelta(days=_verdict_days())).strftime("%Y-%m-%d %H:%M:%S")
+                    self._conn.execute(
+                        "DELETE FROM xsd_validaciones WHERE xsd_checksum != ? OR fecha < ?", (checksum, limite)
+                    )
+            if checksum != self._checksum:
+                rows = self._conn.execute(
+                    "SELECT xml_hash, valido, error FROM xsd_validaciones WHERE xsd_checksum = ?", (checksum,)
+                ).fetchall()
+                self._known = {h: (bool(v), e) for h, v, e in rows}
+                self._checksum = checksum
+            return True
+        except sqlite3.Error as e:
+            # Sin base de datos se valida igual, sólo que sin veredictos guardados
+            logger.debug(f"No se pudieron leer los veredictos XSD: {e}")
+            self._failed = True
+            return False
+
+    def get(self, xml_digest: str, checksum: str) -> Optional[Verdict]:
+        with self._lock:
+            if not self._open(checksum):
+                return None
+            return self._known.get(xml_digest)
+
+    def add(self, rows: Iterable[VerdictRow]) -> None:
+        with self._lock:
+            self._check_process()
+            for row in rows:
+                if row[1] == self._checksum:
+                    self._known[row[0]] = (bool(row[2]), row[3])
+                self._pending.append(row)
+            if len(self._pending) >= VERDICT_FLUSH_ROWS:
+                self._flush_locked()
+
+    def put(self, xml_digest: str, checksum: str, is_valid: bool, error_msg: Optional[str] = None) -> None:
+        with self._lock:
+            if not self._open(checksum):
+                return
+        self.add([(xml_digest, checksum, 1 if is_valid else 0, error_msg,
+                   datetime.now().strftime("%Y-%m-%d %H:%M:%S"))])
+
+    def take_pending(self) -> List[VerdictRow]:
+        """Veredictos aún sin escribir (se quitan de la cola): los procesos del pool los pasan al principal."""
+        with self._lock:
+            self._check_process()
+            pending, self._pending = self._pending, []
+            return pending
+
+    def _flush_locked(self) -> None:
+        if not self._pending or self._failed:
+            self._pending = []
+            return
+        pending, self._pending = self._pending, []
+        if not self._open(pending[-1][1]):
+            return
+        try:
+            with self._conn:
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO xsd_validaciones (xml_hash, xsd_checksum, valido, error, fecha) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    pending,
+                )
+        except sqlite3.Error as e:
+            logger.debug(f"No se pudieron guardar los veredictos XSD: {e}")
+
+    def flush(self) -> None:
+        with self._lock:
+            self._check_process()
+            self._flush_locked()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._check_process()
+            self._pending = []
+            self._known = {}
+            self._checksum = None
+            try:
+                conn = self._conn or sqlite3.connect(self.db_path, timeout=5, check_same_thread=False)
+                self._conn = conn
+                with conn:
+                    conn.execute("DELETE FROM xsd_validaciones")
+            except sqlite3.Error as e:
+                logger.debug(f"No se pudieron borrar los veredictos XSD: {e}")
+
+    def close(self) -> None:
+        with self._lock:
+            self._check_process()
+            self._flush_locked()
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+            self._checksum = None
+
+
+_STORE = VerdictStore()
+
+
+def get_verdict(xml_digest: str, checksum: str) -> Optional[Verdict]:
+    """(es_valido, mensaje_error) guardado para este XML y XSD, o None."""
+    if not _env_enabled("FACTUNABO_XSD_VERDICTS"):
+        return None
+    return _STORE.get(xml_digest, checksum)
+
+
+def store_verdict(xml_digest: str, checksum: str, is_valid: bool, error_msg: Optional[str] = None) -> None:
+    """Anota el veredicto; se escribe con los demás en flush_verdicts() (o al juntar VERDICT_FLUSH_ROWS)."""
+    if not _env_enabled("FACTUNABO_XSD_VERDICTS"):
+        return
+    _STORE.put(xml_digest, checksum, is_valid, error_msg)
+
+
+def take_pending_verdicts() -> List[VerdictRow]:
+    return _STORE.take_pending()
+
+
+def add_pending_verdicts(rows: Iterable[VerdictRow]) -> None:
+    if rows and _env_enabled("FACTUNABO_XSD_VERDICTS"):
+        _STORE.add(rows)
+
+
+def flush_verdicts() -> None:
+    """Escribe los veredictos pendientes en una sola transacción."""
+    _STORE.flush()
+
+
+def clear_verdicts() -> None:
+    """Borra todos los veredictos guardados."""
+    _STORE.clear()
+
+
+atexit.register(_STORE.close)
+
+
+__all__ = ["XSD_PATH", "ARTIFACT_PATH", "xml_hash", "xsd_checksum", "lxml_is_valid",
+           "build_artifact", "get_xmlschema", "warm_async",
+           "VerdictStore", "get_verdict", "store_verdict", "take_pending_verdicts", "add_pending_verdicts",
+           "flush_verdicts", "clear_verdicts"]
+
+
+if __name__ == "__main__":
+    # Genera el artefacto antes de empaquetar: python xsd_validator.py
+    logging.basicConfig(level=logging.INFO)
+    build_artifact()
+    print(f"Esquema serializado en {ARTIFACT_PATH}")